@@ -0,0 +1,64 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import solution.database as database
+from solution.controllers import (
+    PatientController,
+)
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
+
+
+def _run(profile, patient_count, batch_size, summary_count, work_dir):
+    db_path = os.path.join(work_dir, f'{profile}.db')
+    db_engine = database.create_engine(f'sqlite:///{db_path}', profile)
+    session_maker = database.get_session_maker(db_engine)
+
+    generator = BundleGenerator(patient_count)
+    bundles = [(f'synthetic:{i}', bundle) for i, bundle in enumerate(generator, 1)]
+    patient_ids = list(generator.iter_patient_ids())[:summary_count]
+
+    start_time = time.monotonic()
+    import_summary.import_bundles(session_maker, bundles, batch_size=batch_size)
+    import_secs = time.monotonic() - start_time
+
+    latencies = []
+    for patient_id in patient_ids:
+        start_time = time.monotonic()
+        with database.session_scope(session_maker) as db_session:
+            PatientController(db_session, patient_id).get_most_recent_appointment_summary()
+        latencies.append(time.monotonic() - start_time)
+
+    db_engine.dispose()
+    latencies.sort()
+
+    return dict(
+        profile=profile,
+        import_bundles_per_sec=round(len(bundles) / import_secs, 1),
+        summary_p50_msecs=round(latencies[len(latencies) // 2] * 1000, 3),
+        summary_p99_msecs=round(latencies[int(len(latencies) * 0.99)] * 1000, 3),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark - import throughput and summary latency of the '
+                                                 'database engine profiles.')
+    parser.add_argument('--patients', type=int, default=2000, help='number of patients (default: 2000).')
+    parser.add_argument('--batch-size', type=int, default=500, help='bundles per transaction (default: 500).')
+    parser.add_argument('--summaries', type=int, default=1000, help='number of timed summaries (default: 1000).')
+
+    args = vars(parser.parse_args())
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = [
+            _run(profile, args.get('patients'), args.get('batch_size'), args.get('summaries'), work_dir)
+            for profile in database.ENGINE_PROFILES
+        ]
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
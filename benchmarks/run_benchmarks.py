@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import platform
+import tempfile
+from sqlalchemy import event
+import solution.database as database
+from solution.controllers import (
+    PatientController,
+)
+from benchmarks.synthetic_data import (
+    SCALES,
+    BundleGenerator,
+)
+import import_summary
+
+
+# metrics compared against a baseline, and whether higher values are better
+_METRIC_DIRECTIONS = {
+    'import_bundles_per_sec': True,
+    'import_statements_per_bundle': False,
+    'summary_p50_msecs': False,
+    'summary_p99_msecs': False,
+    'summary_statements': False,
+    'batch_summaries_per_sec': True,
+    'batch_summary_statements_per_1k': False,
+    'peak_rss_mb': False,
+}
+
+
+class _StatementCounter:
+    def __init__(self, db_engine):
+        self.count = 0
+        event.listen(db_engine, 'before_cursor_execute', self._before_cursor_execute)
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith('BEGIN'):
+            self.count += 1
+
+
+def _percentile(sorted_values, percentile):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * percentile))]
+
+
+def run_benchmarks(patient_count, seed=0, profile='bulk_load', batch_size=500, summary_count=1000, work_dir=None):
+    """
+    Import synthetic bundles into a new database and time the import and summary paths
+    :return: dict of metrics
+    """
+    db_engine = database.create_engine(f'sqlite:///{os.path.join(work_dir, "benchmark.db")}', profile)
+    session_maker = database.get_session_maker(db_engine)
+    statement_counter = _StatementCounter(db_engine)
+
+    generator = BundleGenerator(patient_count, seed=seed)
+    bundle_count = 0
+
+    def _bundles():
+        nonlocal bundle_count
+        for bundle in generator:
+            bundle_count += 1
+            yield f'synthetic:{bundle_count}', bundle
+
+    start_time = time.monotonic()
+    import_summary.import_bundles(session_maker, _bundles(), batch_size=batch_size)
+    import_secs = time.monotonic() - start_time
+    import_statement_count = statement_counter.count
+
+    patient_ids = list(generator.iter_patient_ids())
+    sample_patient_ids = random.Random(seed).sample(patient_ids, min(summary_count, len(patient_ids)))
+
+    latencies = []
+    statement_counter.count = 0
+    for patient_id in sample_patient_ids:
+        start_time = time.monotonic()
+        with database.session_scope(session_maker) as db_session:
+            PatientController(db_session, patient_id).get_most_recent_appointment_summary()
+        latencies.append(time.monotonic() - start_time)
+    summary_statement_count = statement_counter.count
+    latencies.sort()
+
+    statement_counter.count = 0
+    start_time = time.monotonic()
+    with database.session_scope(session_maker) as db_session:
+        for _ in PatientController.iter_most_recent_appointment_summaries(db_session, sample_patient_ids):
+            pass
+    batch_summary_secs = time.monotonic() - start_time
+    batch_summary_statement_count = statement_counter.count
+
+    db_engine.dispose()
+
+    return dict(
+        patients=patient_count,
+        bundles=bundle_count,
+        profile=profile,
+        import_bundles_per_sec=round(bundle_count / import_secs, 1),
+        import_statements_per_bundle=round(import_statement_count / bundle_count, 2),
+        summary_p50_msecs=round(_percentile(latencies, 0.5) * 1000, 3),
+        summary_p99_msecs=round(_percentile(latencies, 0.99) * 1000, 3),
+        summary_statements=round(summary_statement_count / len(sample_patient_ids), 2),
+        batch_summaries_per_sec=round(len(sample_patient_ids) / batch_summary_secs, 1),
+        batch_summary_statements_per_1k=round(batch_summary_statement_count * 1000 / len(sample_patient_ids), 1),
+        # ru_maxrss is in KiB on Linux, bytes on macOS
+        peak_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                          (1024 ** 2 if platform.system() == 'Darwin' else 1024), 1),
+    )
+
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Compare the metrics against a baseline run
+    :param tolerance: allowed relative change for the worse (e.g. 0.2 = 20%)
+    :return: list of (metric, baseline value, value) tuples of the regressed metrics
+    """
+    result = []
+    for metric, is_higher_better in _METRIC_DIRECTIONS.items():
+        baseline_value = baseline.get(metric)
+        value = results.get(metric)
+        if not baseline_value or value is None:
+            continue
+
+        change = (value - baseline_value) / baseline_value
+        if (-change if is_higher_better else change) > tolerance:
+            result.append((metric, baseline_value, value))
+
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Suite - import throughput, summary latency, queries per '
+                                                 'operation and peak memory on synthetic data.')
+    parser.add_argument('--scale', choices=sorted(SCALES), help='named number of patients.')
+    parser.add_argument('--patients', type=int, default=1000, help='number of patients (default: 1000).')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0).')
+    parser.add_argument('--profile', default='bulk_load', choices=sorted(database.ENGINE_PROFILES),
+                        help='database engine profile (default: bulk_load).')
+    parser.add_argument('--batch-size', type=int, default=500, help='bundles per transaction (default: 500).')
+    parser.add_argument('--summaries', type=int, default=1000, help='number of timed summaries (default: 1000).')
+    parser.add_argument('--output', help='path of the JSON results file (default: stdout).')
+    parser.add_argument('--baseline', help='path of the JSON results of a baseline run, fails on regressions.')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative regression against the baseline (default: 0.2).')
+
+    args = vars(parser.parse_args())
+    patient_count = SCALES[args.get('scale')] if args.get('scale') else args.get('patients')
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = run_benchmarks(
+            patient_count,
+            seed=args.get('seed'),
+            profile=args.get('profile'),
+            batch_size=args.get('batch_size'),
+            summary_count=args.get('summaries'),
+            work_dir=work_dir,
+        )
+
+    results_json = json.dumps(results, indent=4)
+    if args.get('output'):
+        with open(args.get('output'), 'w') as f:
+            f.write(results_json + '\n')
+    else:
+        print(results_json)
+
+    if args.get('baseline'):
+        with open(args.get('baseline'), 'r') as f:
+            baseline = json.load(f)
+
+        regressions = find_regressions(results, baseline, args.get('tolerance'))
+        for metric, baseline_value, value in regressions:
+            print(f'regression: {metric} {baseline_value} -> {value}', file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+import sys
+import json
+import uuid
+import random
+import argparse
+from datetime import (
+    datetime,
+    timedelta,
+    timezone,
+)
+
+
+# number of patients of the named scales
+SCALES = {
+    '1k': 1000,
+    '100k': 100000,
+    '1m': 1000000,
+}
+
+_FIRST_NAMES = ['Tendo', 'Adam', 'Maria', 'Wei', 'Aisha', 'Lucas', 'Olga', 'Kenji', 'Fatima', 'Liam', 'Sofia',
+                'Mateo', 'Amara', 'Noah', 'Priya', 'Elena', 'Omar', 'Hana', 'Diego', 'Zoe']
+_FAMILY_NAMES = ['Tenderson', 'Careful', 'Garcia', 'Chen', 'Okafor', 'Silva', 'Ivanova', 'Tanaka', 'Haddad',
+                 'Murphy', 'Rossi', 'Lopez', 'Mensah', 'Smith', 'Patel', 'Novak', 'Khan', 'Kim', 'Moreno', 'Dubois']
+_REASONS = ['Endocrinologist visit', 'Annual physical', 'Follow-up visit', 'Cardiology consultation',
+            'Dermatology screening', 'Vaccination', 'Lab results review', 'Urgent care visit']
+_APPOINTMENT_STATUSES = ['finished'] * 8 + ['scheduled', 'missed']
+_DIAGNOSIS_STATUSES = ['final'] * 6 + ['verify', 'thesis']
+
+# appointments per patient and codes per diagnosis (value, weight)
+_APPOINTMENT_COUNT_WEIGHTS = [(1, 40), (2, 25), (3, 15), (5, 10), (10, 7), (30, 3)]
+_CODE_COUNT_WEIGHTS = [(1, 60), (2, 25), (3, 10), (4, 5)]
+
+_DIAGNOSIS_CODE_COUNT = 2000
+_START_DATETIME = datetime(2019, 1, 1, tzinfo=timezone.utc)
+
+
+def _iso_datetime_str(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _weighted_choice(rng, value_weights):
+    return rng.choices([value for value, _ in value_weights], [weight for _, weight in value_weights])[0]
+
+
+class BundleGenerator:
+    """
+    Deterministic generator of appointment summary bundles shaped like input_data.json (one bundle per
+    appointment: patient, doctor, appointment and diagnosis)
+    """
+
+    def __init__(self, patient_count, seed=0, doctor_count=None):
+        self._patient_count = patient_count
+        self._seed = seed
+
+        rng = random.Random(f'{seed}:reference')
+        self._doctors = [
+            self._make_user('Doctor', self._make_id(rng), rng)
+            for _ in range(doctor_count or max(1, patient_count // 100))
+        ]
+        self._diagnosis_codes = [
+            dict(
+                system='http://hl7.org/fhir/sid/icd-10',
+                code=f'{chr(ord("A") + i % 26)}{i // 26:02d}.{i % 10}',
+                name=f'Synthetic condition {i}',
+            )
+            for i in range(_DIAGNOSIS_CODE_COUNT)
+        ]
+
+    @staticmethod
+    def _make_id(rng):
+        return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+    def _make_user(self, resource_type, user_id, rng):
+        first_name = rng.choice(_FIRST_NAMES)
+        family_name = rng.choice(_FAMILY_NAMES)
+        result = dict(
+            resourceType=resource_type,
+            id=user_id,
+            name=[dict(text=f'{first_name} {family_name}', family=family_name, given=[first_name])],
+        )
+
+        if resource_type == 'Patient':
+            result.update(dict(
+                active=rng.random() < 0.95,
+                contact=[
+                    dict(system='phone', value=f'555-{rng.randrange(1000):03d}-{rng.randrange(10000):04d}',
+                         use='mobile'),
+                    dict(system='email', value=f'{first_name}.{family_name}{rng.randrange(10000)}@example.com'
+                         .lower(), use='home'),
+                ],
+                gender=rng.choice(['female', 'male']),
+                birthDate=(datetime(1930, 1, 1) + timedelta(days=rng.randrange(85 * 365))).strftime('%Y-%m-%d'),
+            ))
+
+        return result
+
+    def _make_bundle(self, rng, patient, start_dt):
+        doctor = rng.choice(self._doctors)
+        appt_id = self._make_id(rng)
+        end_dt = start_dt + timedelta(minutes=rng.choice([15, 30, 30, 45, 60]))
+        codes = rng.sample(self._diagnosis_codes, _weighted_choice(rng, _CODE_COUNT_WEIGHTS))
+
+        return dict(
+            resourceType='Bundle',
+            id=self._make_id(rng),
+            timestamp=_iso_datetime_str(end_dt + timedelta(minutes=10)),
+            entry=[
+                dict(resource=patient),
+                dict(resource=doctor),
+                dict(resource=dict(
+                    resourceType='Appointment',
+                    id=appt_id,
+                    status=rng.choice(_APPOINTMENT_STATUSES),
+                    type=[dict(text=rng.choice(_REASONS))],
+                    subject=dict(reference=f'Patient/{patient["id"]}'),
+                    actor=dict(reference=f'Doctor/{doctor["id"]}'),
+                    period=dict(start=_iso_datetime_str(start_dt), end=_iso_datetime_str(end_dt)),
+                )),
+                dict(resource=dict(
+                    resourceType='Diagnosis',
+                    id=self._make_id(rng),
+                    meta=dict(lastUpdated=_iso_datetime_str(end_dt - timedelta(minutes=5))),
+                    status=rng.choice(_DIAGNOSIS_STATUSES),
+                    code=dict(coding=codes),
+                    appointment=dict(reference=f'Appointment/{appt_id}'),
+                )),
+            ],
+        )
+
+    def _patient_rng(self, i):
+        # every patient has its own random sequence, so patients can be generated independently
+        return random.Random(f'{self._seed}:patient:{i}')
+
+    def iter_patient_ids(self):
+        for i in range(self._patient_count):
+            yield self._make_id(self._patient_rng(i))
+
+    def __iter__(self):
+        """
+        Generate the bundles, patient by patient (memory use does not depend on the number of patients)
+        """
+        for i in range(self._patient_count):
+            rng = self._patient_rng(i)
+            patient = self._make_user('Patient', self._make_id(rng), rng)
+
+            appt_count = _weighted_choice(rng, _APPOINTMENT_COUNT_WEIGHTS)
+            start_times = sorted(rng.randrange(5 * 365 * 24 * 4) for _ in range(appt_count))
+            for start_time in start_times:
+                yield self._make_bundle(rng, patient, _START_DATETIME + timedelta(minutes=15 * start_time))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Synthetic Data - generate appointment summary bundles (NDJSON, '
+                                                 'one bundle per line) shaped like input_data.json.')
+    parser.add_argument('--scale', choices=sorted(SCALES), help='named number of patients.')
+    parser.add_argument('--patients', type=int, default=1000, help='number of patients (default: 1000).')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0).')
+    parser.add_argument('--output', help='path of the NDJSON file (default: stdout).')
+
+    args = vars(parser.parse_args())
+    patient_count = SCALES[args.get('scale')] if args.get('scale') else args.get('patients')
+
+    f = open(args.get('output'), 'w') if args.get('output') else sys.stdout
+    try:
+        for bundle in BundleGenerator(patient_count, seed=args.get('seed')):
+            f.write(json.dumps(bundle) + '\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
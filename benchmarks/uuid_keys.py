@@ -0,0 +1,99 @@
+import os
+import json
+import time
+import uuid
+import random
+import argparse
+import tempfile
+import sqlalchemy as sa
+from solution.column_types import UUID
+
+
+def _create_tables(id_type):
+    metadata = sa.MetaData()
+    user_table = sa.Table(
+        'User', metadata,
+        sa.Column('id', id_type, primary_key=True),
+    )
+    appt_table = sa.Table(
+        'Appointment', metadata,
+        sa.Column('id', id_type, primary_key=True),
+        sa.Column('subject_id', id_type, sa.ForeignKey(user_table.c.id), index=True),
+        sa.Column('start_time_ts', sa.Integer, nullable=False),
+    )
+
+    return metadata, user_table, appt_table
+
+
+def _index_sizes(connection):
+    # page usage per table/index, dbstat is not compiled into every SQLite build
+    try:
+        return dict(connection.exec_driver_sql('SELECT name, sum(pgsize) FROM dbstat GROUP BY name').fetchall())
+    except sa.exc.OperationalError:
+        return {}
+
+
+def _run(id_type_name, id_type, user_ids, appts_per_user, lookup_count, work_dir):
+    db_path = os.path.join(work_dir, f'{id_type_name}.db')
+    db_engine = sa.create_engine(f'sqlite:///{db_path}')
+    metadata, user_table, appt_table = _create_tables(id_type)
+    metadata.create_all(db_engine)
+
+    start_time = time.monotonic()
+    with db_engine.begin() as connection:
+        connection.execute(user_table.insert(), [dict(id=user_id) for user_id in user_ids])
+        connection.execute(appt_table.insert(), [
+            dict(id=str(uuid.uuid1()), subject_id=user_id, start_time_ts=i)
+            for user_id in user_ids for i in range(appts_per_user)
+        ])
+    insert_secs = time.monotonic() - start_time
+
+    lookup_ids = random.Random(0).choices(user_ids, k=lookup_count)
+    with db_engine.connect() as connection:
+        pk_stmt = sa.select(user_table.c.id).where(user_table.c.id == sa.bindparam('id'))
+        start_time = time.monotonic()
+        for user_id in lookup_ids:
+            connection.execute(pk_stmt, dict(id=user_id)).scalar()
+        pk_lookup_secs = time.monotonic() - start_time
+
+        fk_stmt = sa.select(appt_table.c.id).where(appt_table.c.subject_id == sa.bindparam('id'))
+        start_time = time.monotonic()
+        for user_id in lookup_ids:
+            connection.execute(fk_stmt, dict(id=user_id)).fetchall()
+        fk_lookup_secs = time.monotonic() - start_time
+
+        index_sizes = _index_sizes(connection)
+
+    db_engine.dispose()
+
+    return dict(
+        id_type=id_type_name,
+        file_size_bytes=os.path.getsize(db_path),
+        table_and_index_bytes=index_sizes,
+        insert_secs=round(insert_secs, 4),
+        pk_lookup_usecs=round(pk_lookup_secs / lookup_count * 1e6, 2),
+        fk_lookup_usecs=round(fk_lookup_secs / lookup_count * 1e6, 2),
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark - index size and lookup time of String(36) vs '
+                                                 '16-byte binary UUID keys.')
+    parser.add_argument('--users', type=int, default=100000, help='number of users (default: 100000).')
+    parser.add_argument('--appointments-per-user', type=int, default=3, help='default: 3.')
+    parser.add_argument('--lookups', type=int, default=20000, help='number of timed lookups (default: 20000).')
+
+    args = vars(parser.parse_args())
+
+    user_ids = [str(uuid.uuid1()) for _ in range(args.get('users'))]
+    with tempfile.TemporaryDirectory() as work_dir:
+        results = [
+            _run(id_type_name, id_type, user_ids, args.get('appointments_per_user'), args.get('lookups'), work_dir)
+            for id_type_name, id_type in (('string36', sa.String(36)), ('binary16', UUID()))
+        ]
+
+    print(json.dumps(results, indent=4))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,2 +1,26 @@
 DATABASE_URL = 'sqlite:///solution_data.db'
 PATIENT_ID = '6739ec3e-93bd-11eb-a8b3-0242ac130003'
+DIAGNOSIS_CODE_CACHE_SIZE = 100000
+
+# sharded storage (see solution.sharding): number of shard databases the patients are split across (0 keeps everything
+# in DATABASE_URL), URL of the shards (formatted with the shard index) and URL of the reference database (doctors and
+# diagnosis codes)
+SHARD_COUNT = 0
+SHARD_DATABASE_URL = 'sqlite:///solution_data.shard{shard}.db'
+REFERENCE_DATABASE_URL = 'sqlite:///solution_data.reference.db'
+
+# database engine performance profiles (see solution.database.ENGINE_PROFILES) and overrides of their settings
+IMPORT_ENGINE_PROFILE = 'bulk_load'
+SERVING_ENGINE_PROFILE = 'serving'
+ENGINE_SETTINGS = {}
+
+# path of a file that receives the per-phase statement counts and timings (see solution.instrumentation), the
+# instrumentation is disabled if not set
+METRICS_PATH = None
+
+# in-process cache of the appointment summaries read by patient_survey.py (see solution.summary_cache): max number of
+# summaries, max age (bounds the staleness from imports run by other processes) and optional file that persists the
+# cache between runs
+SUMMARY_CACHE_SIZE = 10000
+SUMMARY_CACHE_TTL_SECS = 60
+SUMMARY_CACHE_PATH = None
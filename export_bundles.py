@@ -0,0 +1,44 @@
+import sys
+import time
+import argparse
+import solution.database as database
+import solution.bundle_writer as bundle_writer
+import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export Appointment Data - utility to export every appointment of the '
+                                                 'system''s database as an appointment summary bundle (NDJSON, one '
+                                                 'bundle per line), in the format import_summary.py imports.')
+    parser.add_argument('--output', default='-',
+                        help='path of the NDJSON file, gzip compressed if the extension is .gz (default: stdout).')
+    parser.add_argument('--database-url', default=config.DATABASE_URL,
+                        help=f'database to export (default: {config.DATABASE_URL}).')
+    parser.add_argument('--chunk-size', type=int, default=bundle_writer.DEFAULT_CHUNK_SIZE,
+                        help=f'number of appointments read per query (default: {bundle_writer.DEFAULT_CHUNK_SIZE}).')
+
+    args = vars(parser.parse_args())
+
+    db_engine = database.create_engine(args.get('database_url'), config.SERVING_ENGINE_PROFILE,
+                                       **config.ENGINE_SETTINGS)
+    session_maker = database.get_session_maker(db_engine)
+
+    start_time = time.monotonic()
+    f = bundle_writer.open_export_file(args.get('output'))
+    try:
+        # a single (read) transaction, so the export is a consistent snapshot
+        with database.session_scope(session_maker) as db_session:
+            bundle_count = bundle_writer.write_bundles(
+                f, bundle_writer.iter_bundles(db_session, chunk_size=max(1, args.get('chunk_size'))))
+    finally:
+        f.flush()
+        if args.get('output') != '-':
+            f.close()
+    elapsed_secs = time.monotonic() - start_time
+
+    print(f'{bundle_count} bundle(s) exported ({elapsed_secs:.2f}s, '
+          f'{bundle_count / elapsed_secs if elapsed_secs else 0:.1f} bundles/sec)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+import os
+import sys
+import enum
+import json
+import argparse
+import solution.database as database
+import solution.change_log as change_log
+import config
+
+
+def _json_default(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+
+    return str(value)
+
+
+def _read_cursor(file_path):
+    if not os.path.exists(file_path):
+        return 0
+
+    with open(file_path) as f:
+        return int(f.read().strip() or 0)
+
+
+def _write_cursor(file_path, cursor):
+    tmp_file_path = f'{file_path}.tmp'
+    with open(tmp_file_path, 'w') as f:
+        f.write(f'{cursor}\n')
+    os.replace(tmp_file_path, file_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export Changes - utility to export the entities (users, '
+                                                 'appointments, diagnoses and surveys) changed after a cursor, as '
+                                                 'NDJSON (one entity per line).')
+    parser.add_argument('--cursor', type=int,
+                        help='sequence number of the last change already exported (default: 0, all the changes).')
+    parser.add_argument('--cursor-file',
+                        help='path of a file that holds the cursor: the export resumes after the cursor, and the file '
+                             'is updated once the changes are exported (incremental syncs).')
+    parser.add_argument('--output', help='path of the NDJSON file (default: stdout).')
+    parser.add_argument('--batch-size', type=int, default=change_log.DEFAULT_BATCH_SIZE,
+                        help=f'number of changes read per query (default: {change_log.DEFAULT_BATCH_SIZE}).')
+    parser.add_argument('--database-url', default=config.DATABASE_URL,
+                        help=f'database to export (default: {config.DATABASE_URL}).')
+
+    args = vars(parser.parse_args())
+
+    cursor = args.get('cursor')
+    if cursor is None:
+        cursor = _read_cursor(args.get('cursor_file')) if args.get('cursor_file') else 0
+
+    db_engine = database.create_engine(args.get('database_url'), config.SERVING_ENGINE_PROFILE,
+                                       **config.ENGINE_SETTINGS)
+    session_maker = database.get_session_maker(db_engine)
+
+    entity_count = 0
+    f = open(args.get('output'), 'w', encoding='utf-8') if args.get('output') else sys.stdout
+    try:
+        with database.session_scope(session_maker) as db_session:
+            for cursor, entities in change_log.iter_changed_entities(
+                    db_session, cursor, batch_size=max(1, args.get('batch_size'))):
+                for entity in entities:
+                    f.write(json.dumps(entity, default=_json_default, ensure_ascii=False) + '\n')
+                entity_count += len(entities)
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+    if args.get('cursor_file'):
+        _write_cursor(args.get('cursor_file'), cursor)
+
+    print(f'{entity_count} changed entit{"y" if entity_count == 1 else "ies"} exported, cursor: {cursor}',
+          file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,23 @@
+import os
+import sys
+import glob
 import json
+import time
+import hashlib
+import collections
+import concurrent.futures
 from datetime import (
     datetime,
     timezone,
 )
 import argparse
-from sqlalchemy import create_engine
 import solution.database as database
+import solution.code_cache as code_cache
+import solution.batching as batching
+import solution.bundle_reader as bundle_reader
+import solution.instrumentation as instrumentation
+import solution.models as models
+import solution.sharding as sharding
 from solution.enums import (
     UserType,
     Gender,
@@ -26,112 +38,91 @@ def _convert_iso_date_to_datetime(date_string):
 
 
 def _get_reference_object_id(reference_obj_dict):
-    return reference_obj_dict.get('reference').split('/')[1]
-
-
-def _create_user_object(db_session, user_type, obj_dict):
-    user_obj_builder = UserObjectBuilder(db_session, object_id=obj_dict.get('id'))
-
-    # user is either a patient or doctor
-    user_obj_builder.set_user_type(user_type)
+    reference = reference_obj_dict.get('reference')
+    return reference.split('/')[1] if reference else None
+
+
+def _parse_user(user_type, obj_dict):
+    result = dict(
+        id=obj_dict.get('id'),
+        # user is either a patient or doctor
+        user_type=user_type,
+        # set the active status (default to True if not specified in input)
+        is_active=obj_dict.get('active', True),
+        names=[
+            dict(
+                family_name=name_obj_dict.get('family'),
+                name_text=name_obj_dict.get('text'),
+                given_names=name_obj_dict.get('given', []),
+            )
+            for name_obj_dict in obj_dict.get('name', [])
+        ],
+        # convert contact system strings to ContactSystem enums
+        contact_infos=[
+            dict(
+                system=ContactSystem[contact_info_dict.get('system')],
+                name=contact_info_dict.get('use'),
+                value=contact_info_dict.get('value'),
+            )
+            for contact_info_dict in obj_dict.get('contact', [])
+        ],
+    )
 
     # convert date string to date object
     if 'birthDate' in obj_dict:
-        user_obj_builder.set_birth_date(datetime.strptime(obj_dict.get('birthDate'), '%Y-%m-%d').date())
+        result['birth_date'] = datetime.strptime(obj_dict.get('birthDate'), '%Y-%m-%d').date()
 
     # convert gender string to Gender enum
     if 'gender' in obj_dict:
-        user_obj_builder.set_gender(Gender[obj_dict.get('gender')])
-
-    # set the active status (default to True if not specified in input)
-    if 'active' in obj_dict:
-        user_obj_builder.set_is_active(obj_dict.get('active'))
-    else:
-        user_obj_builder.set_is_active(True)
-
-    # add/update user names
-    user_obj_builder.clear_names()
-    for name_obj_dict in obj_dict.get('name', []):
-        user_obj_builder.add_name(
-            family_name=name_obj_dict.get('family'),
-            name_text=name_obj_dict.get('text'),
-            given_names=name_obj_dict.get('given', []),
-        )
-
-    # add/update user contact info
-    user_obj_builder.clear_contact_info()
-    for contact_info_dict in obj_dict.get('contact', []):
-        user_obj_builder.add_contact_info(
-            system=ContactSystem[contact_info_dict.get('system')],
-            name=contact_info_dict.get('use'),
-            value=contact_info_dict.get('value'),
-        )
-
-    return user_obj_builder.object
+        result['gender'] = Gender[obj_dict.get('gender')]
 
+    return result
 
-def _create_appointment_object(db_session, obj_dict):
-    appt_obj_builder = AppointmentObjectBuilder(db_session, object_id=obj_dict.get('id'))
-
-    # parse out actor and subject objects
-    # assumption: the referenced objects exists in the DB
-    doctor_id = _get_reference_object_id(obj_dict.get('actor', {}))
-    appt_obj_builder.set_doctor_id(doctor_id)
-
-    patient_id = _get_reference_object_id(obj_dict.get('subject', {}))
-    appt_obj_builder.set_patient_id(patient_id)
 
+def _parse_appointment(obj_dict):
     # convert period object into timestamp and duration
     period_obj_dict = obj_dict.get('period')
     start_dt = _convert_iso_date_to_datetime(period_obj_dict.get('start'))
     end_dt = _convert_iso_date_to_datetime(period_obj_dict.get('end'))
 
-    start_time_ts = int(start_dt.timestamp())
-    duration_secs = int((end_dt - start_dt).total_seconds())
-
-    appt_obj_builder.set_appointment_time(
-        start_time_ts=start_time_ts,
-        duration_secs=duration_secs,
+    return dict(
+        id=obj_dict.get('id'),
+        # parse out actor and subject objects
+        # assumption: the referenced objects exists in the DB
+        doctor_id=_get_reference_object_id(obj_dict.get('actor', {})),
+        patient_id=_get_reference_object_id(obj_dict.get('subject', {})),
+        start_time_ts=int(start_dt.timestamp()),
+        duration_secs=int((end_dt - start_dt).total_seconds()),
+        reason_texts=[reason_obj_dict.get('text') for reason_obj_dict in obj_dict.get('type', [])],
+        status=AppointmentStatus[obj_dict.get('status')],
     )
 
-    # add/update appointment reasons
-    appt_obj_builder.clear_reasons()
-    for reason_obj_dict in obj_dict.get('type', []):
-        appt_obj_builder.add_reason(reason_obj_dict.get('text'))
-
-    appt_obj_builder.set_status(AppointmentStatus[obj_dict.get('status')])
-
-    return appt_obj_builder.object
-
-
-def _create_diagnosis_object(db_session, obj_dict):
-    diagnosis_obj_builder = DiagnosisObjectBuilder(db_session, object_id=obj_dict.get('id'))
-
-    # parse out the appointment object
-    appt_id = _get_reference_object_id(obj_dict.get('appointment', {}))
-    diagnosis_obj_builder.set_appointment_id(appt_id)
 
-    # parse out the last updated timestamp
-    last_updated_ts = _convert_iso_date_to_datetime(obj_dict.get('meta', {}).get('lastUpdated')).timestamp()
-    diagnosis_obj_builder.set_last_updated_ts(
-        ts=last_updated_ts
+def _parse_diagnosis(obj_dict):
+    return dict(
+        id=obj_dict.get('id'),
+        # parse out the appointment object
+        appointment_id=_get_reference_object_id(obj_dict.get('appointment', {})),
+        # parse out the last updated timestamp
+        last_updated_ts=_convert_iso_date_to_datetime(obj_dict.get('meta', {}).get('lastUpdated')).timestamp(),
+        details=[
+            dict(
+                code=code_obj_dict.get('code'),
+                name=code_obj_dict.get('name'),
+                system=code_obj_dict.get('system'),
+            )
+            for code_obj_dict in obj_dict.get('code', {}).get('coding', [])
+        ],
+        status=DiagnosisStatus[obj_dict.get('status')],
     )
 
-    # add/update diagnosis details
-    diagnosis_obj_builder.clear_details()
-    for code_obj_dict in obj_dict.get('code', {}).get('coding', []):
-        diagnosis_obj_builder.add_detail(
-            code=code_obj_dict.get('code'),
-            name=code_obj_dict.get('name'),
-            system=code_obj_dict.get('system'),
-        )
-
-    diagnosis_obj_builder.set_status(DiagnosisStatus[obj_dict.get('status')])
 
-    return diagnosis_obj_builder.object
-
-
-def _import_appointment_summary(db_session, summary_dict):
+def _parse_appointment_summary(summary_dict):
+    """
+    Parse an appointment summary bundle into the (plain, picklable) values of its objects, without any database
+    access
+    :return: dict with the patient, doctor, appointment and diagnosis values
+    """
     # by studying the "bundle" data, I see an appointment "bundle"
     # consists of four parts: 1) patient, 2) doctor, 3) appointment, 4) diagnosis
     # furthermore, I see appointment references patient and doctor, and diagnosis references appointment
@@ -160,38 +151,686 @@ def _import_appointment_summary(db_session, summary_dict):
         else:
             print(f'unexpected resource type: {resource_type}')
 
+    # (an appointment may have no patient, doctor or diagnosis, e.g. in the bundles of export_bundles.py)
+    return dict(
+        patient=_parse_user(UserType.patient, patient_obj_dict) if patient_obj_dict else None,
+        doctor=_parse_user(UserType.doctor, doctor_obj_dict) if doctor_obj_dict else None,
+        appointment=_parse_appointment(appt_obj_dict),
+        diagnosis=_parse_diagnosis(diagnosis_obj_dict) if diagnosis_obj_dict else None,
+    )
+
+
+@instrumentation.instrumented(instrumentation.USER_UPSERT)
+def _create_user_object(db_session, user):
+    user_obj_builder = UserObjectBuilder(db_session, object_id=user.get('id'))
+    user_obj_builder.set_user_type(user.get('user_type'))
+
+    if 'birth_date' in user:
+        user_obj_builder.set_birth_date(user.get('birth_date'))
+
+    if 'gender' in user:
+        user_obj_builder.set_gender(user.get('gender'))
+
+    user_obj_builder.set_is_active(user.get('is_active'))
+
+    # add/update user names and contact info (only the changes are written)
+    user_obj_builder.set_names(user.get('names'))
+    user_obj_builder.set_contact_info(user.get('contact_infos'))
+
+    return user_obj_builder.object
+
+
+@instrumentation.instrumented(instrumentation.APPOINTMENT)
+def _create_appointment_object(db_session, appt):
+    appt_obj_builder = AppointmentObjectBuilder(db_session, object_id=appt.get('id'))
+    appt_obj_builder.set_doctor_id(appt.get('doctor_id'))
+    appt_obj_builder.set_patient_id(appt.get('patient_id'))
+    appt_obj_builder.set_appointment_time(
+        start_time_ts=appt.get('start_time_ts'),
+        duration_secs=appt.get('duration_secs'),
+    )
+
+    # add/update appointment reasons
+    appt_obj_builder.set_reasons(appt.get('reason_texts'))
+
+    appt_obj_builder.set_status(appt.get('status'))
+
+    return appt_obj_builder.object
+
+
+@instrumentation.instrumented(instrumentation.DIAGNOSIS)
+def _create_diagnosis_object(db_session, diagnosis):
+    diagnosis_obj_builder = DiagnosisObjectBuilder(db_session, object_id=diagnosis.get('id'))
+    diagnosis_obj_builder.set_appointment_id(diagnosis.get('appointment_id'))
+    diagnosis_obj_builder.set_last_updated_ts(
+        ts=diagnosis.get('last_updated_ts')
+    )
+
+    # add/update diagnosis details
+    diagnosis_obj_builder.set_details(diagnosis.get('details'))
+
+    diagnosis_obj_builder.set_status(diagnosis.get('status'))
+
+    return diagnosis_obj_builder.object
+
+
+def _import_appointment_summary(db_session, summary):
+    """
+    :param summary: parsed appointment summary (see _parse_appointment_summary)
+    """
     # create patient and doctor objects first
-    _create_user_object(db_session, UserType.patient, patient_obj_dict)
-    _create_user_object(db_session, UserType.doctor, doctor_obj_dict)
+    for user in (summary.get('patient'), summary.get('doctor')):
+        if user:
+            _create_user_object(db_session, user)
 
     # create appointment object (references patient and doctor objects)
-    _create_appointment_object(db_session, appt_obj_dict)
+    _create_appointment_object(db_session, summary.get('appointment'))
 
     # create diagnosis object (references appointment object)
-    _create_diagnosis_object(db_session, diagnosis_obj_dict)
+    if summary.get('diagnosis'):
+        _create_diagnosis_object(db_session, summary.get('diagnosis'))
+
+
+def _get_bundle_content_hash(summary_dict):
+    # the bundle timestamp is when the bundle was assembled (differs between re-deliveries), it is not content
+    content = {key: value for key, value in summary_dict.items() if key != 'timestamp'}
+    canonical_json = json.dumps(content, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+    return hashlib.sha256(canonical_json.encode('utf-8')).hexdigest()
+
+
+def _prepare_bundle(summary_dict):
+    """
+    Parse a bundle and compute its content hash (CPU only, runs in the worker processes of a parallel import)
+    :return: tuple of (bundle id, prepared bundle, error), the prepared bundle is None if parsing failed
+    """
+    bundle_id = summary_dict.get('id') if isinstance(summary_dict, dict) else None
+    try:
+        # (quarantined with the entries the reader kept)
+        if isinstance(summary_dict, bundle_reader.OversizedBundle):
+            raise ValueError(f'oversized bundle of {summary_dict.entry_count} entries')
+        if isinstance(summary_dict, bundle_reader.MalformedBundle):
+            raise ValueError(f'malformed bundle at byte {summary_dict.offset}: {summary_dict.error_message}')
+
+        with instrumentation.phase(instrumentation.PARSE):
+            prepared_bundle = dict(
+                bundle_id=bundle_id,
+                content_hash=_get_bundle_content_hash(summary_dict) if bundle_id else None,
+                summary=_parse_appointment_summary(summary_dict),
+            )
+        return bundle_id, prepared_bundle, None
+    except Exception:
+        return bundle_id, None, sys.exc_info()[1]
+
+
+def _prepare_bundles(summary_dicts):
+    """
+    Prepare a chunk of bundles in a worker process, whose instrumentation (if any) is not reported
+    :return: tuple of (list of _prepare_bundle results, time spent in secs), the time is added to the PARSE phase of
+             the calling process
+    """
+    start_time = time.perf_counter()
+    result = [_prepare_bundle(summary_dict) for summary_dict in summary_dicts]
+    return result, time.perf_counter() - start_time
+
+
+def _import_bundle(db_session, prepared_bundle, force=False):
+    """
+    Import an appointment summary bundle unless the import ledger shows the same bundle (same id and content) has
+    been imported before
+    :param prepared_bundle: see _prepare_bundle
+    :param force: import the bundle even if it is unchanged
+    :return: True if the bundle was imported, False if it was skipped
+    """
+    bundle_id = prepared_bundle.get('bundle_id')
+    if not bundle_id:
+        _import_appointment_summary(db_session, prepared_bundle.get('summary'))
+        return True
+
+    content_hash = prepared_bundle.get('content_hash')
+    ledger_obj = db_session.get(models.ImportLedger, bundle_id)
+    if ledger_obj and ledger_obj.content_hash == content_hash and not force:
+        return False
+
+    _import_appointment_summary(db_session, prepared_bundle.get('summary'))
+
+    # recorded in the same transaction, i.e. only once the import succeeds
+    if not ledger_obj:
+        ledger_obj = models.ImportLedger(bundle_id=bundle_id)
+        db_session.add(ledger_obj)
+    ledger_obj.content_hash = content_hash
+    ledger_obj.imported_ts = int(time.time())
+
+    return True
+
+
+# file extensions of appointment summary files (JSON or NDJSON, optionally gzip compressed)
+_BUNDLE_FILE_EXTENSIONS = ('.json', '.ndjson', '.jsonl', '.json.gz', '.ndjson.gz', '.jsonl.gz')
+_NDJSON_FILE_EXTENSIONS = ('.ndjson', '.jsonl', '.ndjson.gz', '.jsonl.gz')
+
+
+def _iter_bundle_file_paths(path):
+    if path == '-':
+        yield path
+    elif os.path.isdir(path):
+        for file_name in sorted(os.listdir(path)):
+            if file_name.lower().endswith(_BUNDLE_FILE_EXTENSIONS):
+                yield os.path.join(path, file_name)
+    elif glob.has_magic(path):
+        yield from sorted(glob.glob(path))
+    else:
+        yield path
+
+
+def _iter_bundles(paths, checkpoint=None):
+    """
+    Iterate over the appointment summary bundles found in the given paths, the files are read incrementally (see
+    solution.bundle_reader)
+    :param paths: JSON/NDJSON files (optionally gzip compressed), directories or glob patterns ('-' reads stdin)
+    :param checkpoint: optional ImportCheckpoint, the reading resumes after the bundles imported before
+    :return: generator of (source, bundle) tuples, where source identifies the file (and position) of the bundle
+    """
+    source_names = ['<stdin>' if file_path == '-' else file_path
+                    for path in paths for file_path in _iter_bundle_file_paths(path)]
+    start = checkpoint.get_start(source_names) if checkpoint else (0, 0, 0, 0)
+    start_file_index, bundle_count, offset, skip_count = start
+
+    for file_index in range(start_file_index, len(source_names)):
+        source_name = source_names[file_index]
+        if file_index > start_file_index:
+            bundle_count, offset, skip_count = 0, 0, 0
+
+        file_path = '-' if source_name == '<stdin>' else source_name
+        f = bundle_reader.open_bundle_file(file_path, offset=offset)
+        try:
+            # (a malformed line of an NDJSON file is quarantined, see bundle_reader.MalformedBundle)
+            reader = bundle_reader.BundleReader(
+                f, offset=offset, is_ndjson=file_path.lower().endswith(_NDJSON_FILE_EXTENSIONS))
+            # todo: validate JSON schema validation in the future
+            for i, summary_dict in enumerate(reader, bundle_count - skip_count + 1):
+                if i > bundle_count:
+                    source = f'{source_name}:{i}'
+                    if checkpoint:
+                        checkpoint.add_position(source, file_index, reader.position)
+                    yield source, summary_dict
+        finally:
+            if file_path != '-':
+                f.close()
+
+
+def _iter_chunks(items, chunk_size):
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _iter_prepared_bundles(bundles, workers=1, chunk_size=100):
+    """
+    Prepare the bundles (see _prepare_bundle), in a pool of worker processes if workers > 1
+    :return: generator of (source, bundle, bundle id, prepared bundle, error) tuples, in the order of bundles
+    """
+    if workers <= 1:
+        for source, summary_dict in bundles:
+            yield (source, summary_dict) + _prepare_bundle(summary_dict)
+        return
+
+    def _results(chunk, future):
+        # the bundles stay in this process (for the quarantine), only the prepared bundles are sent back
+        prepared_bundles, parse_secs = future.result()
+        instrumentation.add_phase_time(instrumentation.PARSE, parse_secs, calls=len(chunk))
+        for (source, summary_dict), prepared in zip(chunk, prepared_bundles):
+            yield (source, summary_dict) + prepared
+
+    # backpressure: at most 2 chunks per worker are in flight, the bundles are read only as fast as they are written
+    max_pending_count = 2 * workers
+    pending_chunks = collections.deque()
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        for chunk in _iter_chunks(bundles, chunk_size):
+            future = executor.submit(_prepare_bundles, [summary_dict for _, summary_dict in chunk])
+            pending_chunks.append((chunk, future))
+            if len(pending_chunks) >= max_pending_count:
+                yield from _results(*pending_chunks.popleft())
+
+        while pending_chunks:
+            yield from _results(*pending_chunks.popleft())
+
+
+def _quarantine_bundle(db_session, source, summary_dict, bundle_id, error):
+    db_session.add(models.QuarantinedBundle(
+        bundle_id=bundle_id,
+        source=source,
+        error=repr(error),
+        bundle_json=json.dumps(summary_dict, default=str),
+    ))
+
+
+def _import_batch_items(session_maker, batch, force, use_savepoints):
+    result = []
+    with database.session_scope(session_maker) as db_session:
+        for source, summary_dict, bundle_id, prepared_bundle, error in batch:
+            if error is None:
+                try:
+                    if use_savepoints:
+                        with batching.savepoint(db_session):
+                            is_imported = _import_bundle(db_session, prepared_bundle, force=force)
+                    else:
+                        is_imported = _import_bundle(db_session, prepared_bundle, force=force)
+
+                    result.append((source, bundle_id, 'imported' if is_imported else 'skipped', None))
+                    continue
+                except Exception:
+                    if not use_savepoints:
+                        raise
+                    error = sys.exc_info()[1]
+
+            _quarantine_bundle(db_session, source, summary_dict, bundle_id, error)
+            result.append((source, bundle_id, 'failed', error))
+
+    return result
+
+
+@instrumentation.instrumented(instrumentation.IMPORT_BATCH)
+def _import_batch(session_maker, batch, force=False):
+    """
+    Import a batch of prepared bundles in a single transaction; when the batch fails, it is imported again with a
+    SAVEPOINT per bundle, so the bad bundles are rolled back on their own and quarantined (see QuarantinedBundle)
+    :return: list of (source, bundle id, status, error) tuples, status is one of imported, skipped or failed
+    """
+    try:
+        # optimistic: without savepoints the rows of the whole batch are written together
+        return _import_batch_items(session_maker, batch, force, use_savepoints=False)
+    except Exception:
+        return _import_batch_items(session_maker, batch, force, use_savepoints=True)
+
+
+class ImportCheckpoint:
+    """
+    Position of an import in its input files, saved (atomically) to a JSON file after every committed batch, so an
+    interrupted import resumes after the last committed bundle: the input files before the current one are not read
+    again, the current file is read again from the byte offset that follows the bundle (see BundleReader.position);
+    the input files must not change in between, and the database must commit durably (see main)
+    """
+
+    def __init__(self, file_path):
+        self._file_path = file_path
+        # index of the current file in the input files (see _iter_bundles), the files before it have been imported
+        self.file_index = 0
+        self.current_file_path = None
+        self.bundle_count = 0
+        self.offset = 0
+        self.skip_count = 0
+        # source -> (file index, reader position) of the bundles read but not committed yet, see add_position
+        self._positions = collections.OrderedDict()
+
+        if os.path.exists(file_path):
+            with open(file_path, 'r') as f:
+                checkpoint = json.load(f)
+            # (None for a checkpoint without file index, the file is then found by its path, see get_start)
+            self.file_index = checkpoint.get('file_index')
+            self.current_file_path = checkpoint.get('current_file_path')
+            self.bundle_count = checkpoint.get('bundle_count', 0)
+            self.offset = checkpoint.get('offset', 0)
+            # (a checkpoint without offset skips the bundles from the start of the file)
+            self.skip_count = checkpoint.get('skip_count', 0 if 'offset' in checkpoint else self.bundle_count)
+
+    def get_start(self, file_paths):
+        """
+        :param file_paths: the input files, in the order they are read
+        :return: tuple of (index of the file to start reading from, number of bundles of the file imported before,
+                 byte offset to read the file from, number of bundles to skip from there)
+        """
+        if self.current_file_path is None:
+            return 0, 0, 0, 0
+
+        file_index = self.file_index
+        if file_index is None and self.current_file_path in file_paths:
+            file_index = file_paths.index(self.current_file_path)
+        if file_index is None or file_paths[file_index:file_index + 1] != [self.current_file_path]:
+            raise ValueError(f'the input files changed since the checkpoint was saved (after bundle '
+                             f'{self.bundle_count} of {self.current_file_path})')
+
+        return file_index, self.bundle_count, self.offset, self.skip_count
+
+    def add_position(self, source, file_index, position):
+        """
+        Record the file index and the reader position (see BundleReader.position) that follows the bundle of the
+        given source
+        """
+        self._positions[source] = (file_index, position)
+
+    def save(self, source):
+        """
+        Record that the bundles up to (and including) the one of the given source have been committed
+        """
+        while True:
+            position_source, (file_index, position) = self._positions.popitem(last=False)
+            if position_source == source:
+                break
+
+        file_path, bundle_count = source.rsplit(':', 1)
+        self.file_index = file_index
+        self.current_file_path = file_path
+        self.bundle_count = int(bundle_count)
+        self.offset, self.skip_count = position
+
+        tmp_file_path = f'{self._file_path}.tmp'
+        with open(tmp_file_path, 'w') as f:
+            json.dump(dict(
+                file_index=self.file_index,
+                current_file_path=self.current_file_path,
+                bundle_count=self.bundle_count,
+                offset=self.offset,
+                skip_count=self.skip_count,
+            ), f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file_path, self._file_path)
+
+    def remove(self):
+        if os.path.exists(self._file_path):
+            os.remove(self._file_path)
+
+
+def _write_import_results(results, status_counts, report_file):
+    """
+    Count the import results of a batch and write them to the report
+    :param results: list of (source, bundle id, status, error) tuples (see _import_batch)
+    """
+    for source, bundle_id, status, error in results:
+        status_counts[status] += 1
+        if error is not None:
+            print(f'failed to import bundle {bundle_id} ({source}): {error!r}')
+
+        if report_file:
+            report_file.write(json.dumps(dict(
+                source=source,
+                bundle_id=bundle_id,
+                status=status,
+                error=repr(error) if error is not None else None,
+            )) + '\n')
+
+
+def import_bundles(session_maker, bundles, batch_size=500, report_file=None, force=False, workers=1, checkpoint=None):
+    """
+    Import many appointment summary bundles, committing every batch_size bundles
+    :param session_maker: DB Session factory
+    :param bundles: iterable of (source, bundle) tuples
+    :param batch_size: number of bundles imported per transaction
+    :param report_file: optional file object, receives one JSON line (per bundle) with the import status
+    :param force: import bundles even if the import ledger shows they are unchanged
+    :param workers: number of processes that parse the bundles, the bundles are written (in order) by the calling
+                    process
+    :param checkpoint: optional ImportCheckpoint, saved after every committed batch (the bundles must come from
+                       _iter_bundles with the same checkpoint)
+    :return: tuple of (imported count, skipped count, failed count)
+    """
+    status_counts = dict(imported=0, skipped=0, failed=0)
+
+    for batch in _iter_chunks(_iter_prepared_bundles(bundles, workers=workers), batch_size):
+        _write_import_results(_import_batch(session_maker, batch, force=force), status_counts, report_file)
+
+        if checkpoint:
+            checkpoint.save(batch[-1][0])
+
+    return status_counts['imported'], status_counts['skipped'], status_counts['failed']
+
+
+# DB Session factory of the shard written by a shard writer process
+_shard_session_maker = None
+
+
+def _init_shard_writer(database_url, profile, settings):
+    global _shard_session_maker
+    _shard_session_maker = database.get_session_maker(database.create_engine(database_url, profile, **settings))
+
+
+class _ImportError(Exception):
+    """
+    Error of a bundle imported by a shard writer process (the original error may not be picklable)
+    """
+
+    def __repr__(self):
+        return self.args[0]
+
+
+def _import_shard_batch(batch, force, code_rows):
+    """
+    :param code_rows: diagnosis codes of the batch with their ids in the reference database (see
+                      _import_reference_data), written first so a code has the same id in every shard
+    """
+    with database.session_scope(_shard_session_maker) as db_session:
+        code_cache.get_diagnosis_code_cache(db_session, config.DIAGNOSIS_CODE_CACHE_SIZE).resolve(db_session, code_rows)
+
+    return [
+        (source, bundle_id, status, _ImportError(repr(error)) if error is not None else None)
+        for source, bundle_id, status, error in _import_batch(_shard_session_maker, batch, force=force)
+    ]
+
+
+def _write_reference_data(db_session, prepared_bundles):
+    """
+    :return: list of the diagnosis codes of the bundles (dicts with the code, name, system and reference database id)
+    """
+    doctors = {}
+    code_rows = {}
+    for prepared_bundle in prepared_bundles:
+        summary = prepared_bundle.get('summary')
+        if summary['doctor']:
+            doctors[summary['doctor'].get('id')] = summary['doctor']
+        if summary['diagnosis']:
+            for code_row in summary['diagnosis'].get('details'):
+                code_rows.setdefault(code_row['code'], code_row)
+
+    for doctor in doctors.values():
+        _create_user_object(db_session, doctor)
+    code_ids = code_cache.get_diagnosis_code_cache(db_session, config.DIAGNOSIS_CODE_CACHE_SIZE).resolve(
+        db_session, list(code_rows.values()))
+
+    return [dict(code_row, id=code_ids[code]) for code, code_row in code_rows.items()]
+
+
+@instrumentation.instrumented(instrumentation.IMPORT_BATCH)
+def _import_reference_data(session_maker, batch):
+    """
+    Write the doctors and diagnosis codes of a batch of prepared bundles to the reference database of a sharded
+    import (see solution.sharding); when the batch fails, it is written again with a SAVEPOINT per bundle, and the
+    bundles whose reference data fails are marked as failed (so their shard quarantines them)
+    :return: tuple of (batch, with the errors of the failed bundles, list of the diagnosis codes of the batch with
+             their reference database ids)
+    """
+    try:
+        with database.session_scope(session_maker) as db_session:
+            return batch, _write_reference_data(
+                db_session, [prepared_bundle for _, _, _, prepared_bundle, error in batch if error is None])
+    except Exception:
+        pass
+
+    result = []
+    code_rows = {}
+    with database.session_scope(session_maker) as db_session:
+        for source, summary_dict, bundle_id, prepared_bundle, error in batch:
+            if error is None:
+                try:
+                    with batching.savepoint(db_session):
+                        bundle_code_rows = _write_reference_data(db_session, [prepared_bundle])
+                    code_rows.update((code_row['code'], code_row) for code_row in bundle_code_rows)
+                except Exception:
+                    prepared_bundle, error = None, sys.exc_info()[1]
+
+            result.append((source, summary_dict, bundle_id, prepared_bundle, error))
+
+    return result, list(code_rows.values())
+
+
+def import_sharded_bundles(sharded_db, bundles, batch_size=500, report_file=None, force=False, workers=1):
+    """
+    Import many appointment summary bundles into a sharded database (see solution.sharding): the bundles are routed
+    to the shard of their patient and every shard is written by its own process, in parallel (the bundles of a
+    shard are imported in order, batch_size bundles per transaction); the doctors and diagnosis codes are also
+    written to the reference database
+    :param sharded_db: solution.sharding.ShardedDatabase object
+    :param workers: number of processes that parse the bundles (see import_bundles)
+    :return: tuple of (imported count, skipped count, failed count)
+    """
+    status_counts = dict(imported=0, skipped=0, failed=0)
+
+    # one single process executor per shard, so the batches of a shard are imported in order; at most 2 batches per
+    # shard are in flight (backpressure)
+    shard_executors = [
+        concurrent.futures.ProcessPoolExecutor(
+            1, initializer=_init_shard_writer, initargs=(url, sharded_db.profile, sharded_db.settings))
+        for url in sharded_db.shard_urls
+    ]
+    shard_batches = [[] for _ in shard_executors]
+    pending_futures = [collections.deque() for _ in shard_executors]
+
+    def _submit(shard_index):
+        batch = shard_batches[shard_index]
+        shard_batches[shard_index] = []
+        batch, code_rows = _import_reference_data(sharded_db.reference_session_maker, batch)
+
+        pending_futures[shard_index].append(
+            shard_executors[shard_index].submit(_import_shard_batch, batch, force, code_rows))
+        if len(pending_futures[shard_index]) > 2:
+            _write_import_results(pending_futures[shard_index].popleft().result(), status_counts, report_file)
+
+    try:
+        for item in _iter_prepared_bundles(bundles, workers=workers):
+            prepared_bundle = item[3]
+            # (a bundle that failed to parse is quarantined in the first shard, an appointment without patient goes
+            # to the shard of its id)
+            shard_index = sharded_db.get_shard_index(
+                (prepared_bundle.get('summary')['patient'] or prepared_bundle.get('summary')['appointment'])
+                .get('id')) if prepared_bundle else 0
+
+            shard_batches[shard_index].append(item)
+            if len(shard_batches[shard_index]) >= batch_size:
+                _submit(shard_index)
+
+        for shard_index, batch in enumerate(shard_batches):
+            if batch:
+                _submit(shard_index)
+
+        for futures in pending_futures:
+            while futures:
+                _write_import_results(futures.popleft().result(), status_counts, report_file)
+    finally:
+        for executor in shard_executors:
+            executor.shutdown(cancel_futures=True)
+
+    return status_counts['imported'], status_counts['skipped'], status_counts['failed']
 
 
 def main():
     parser = argparse.ArgumentParser(description='Import Appointment Data - utility to import data related to a '
                                                  'medical appointment (in JSON format) into the system''s database.')
-    parser.add_argument('json_file_path', help='path to the appointment summary data in JSON format.')
+    parser.add_argument('json_file_paths', nargs='+',
+                        help='path(s) to the appointment summary data: JSON files, NDJSON files (one bundle per '
+                             'line), optionally gzip compressed, directories or glob patterns; use "-" to read stdin.')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='number of bundles committed per transaction (default: 500).')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes that parse the bundles, 0 for one per CPU (default: 1).')
+    parser.add_argument('--report', help='path of a file that receives a per-bundle import report (NDJSON).')
+    parser.add_argument('--checkpoint',
+                        help='path of a file that records the progress of the import, an interrupted import that is '
+                             'run again with the same checkpoint resumes after the last committed bundle.')
+    parser.add_argument('--force', action='store_true',
+                        help='import bundles even if the same bundle (id and content) has been imported before.')
+    parser.add_argument('--metrics',
+                        help='path of a file that receives the per-phase statement counts and timings (Prometheus '
+                             'text format if the extension is .prom, JSON otherwise).')
+    parser.add_argument('--diagnosis-codes',
+                        help='path of a CSV file (with a "code,name,system" header) of diagnosis codes to preload.')
+    parser.add_argument('--shards', type=int, default=config.SHARD_COUNT,
+                        help='number of shard databases the patients are split across, written in parallel (see '
+                             f'config.SHARD_DATABASE_URL), 0 for a single database (default: {config.SHARD_COUNT}).')
 
     args = vars(parser.parse_args())
-    file_path = args.get('json_file_path')
+    if args.get('shards') and args.get('checkpoint'):
+        parser.error('--checkpoint is not supported by sharded imports')
+
+    sharded_db = None
+    if args.get('shards'):
+        sharded_db = sharding.ShardedDatabase.from_url_template(
+            config.SHARD_DATABASE_URL, args.get('shards'), config.REFERENCE_DATABASE_URL, config.IMPORT_ENGINE_PROFILE,
+            **config.ENGINE_SETTINGS)
+
+        # the doctors and diagnosis codes are written to the reference database by this process
+        db_engine = sharded_db.reference_engine
+        session_maker = sharded_db.reference_session_maker
+    else:
+        engine_settings = dict(config.ENGINE_SETTINGS)
+        if args.get('checkpoint'):
+            # the checkpoint is saved once a batch is committed, the commit must be durable by then (rather than
+            # synchronous=OFF of the bulk_load profile; NORMAL does not sync the WAL at commit either)
+            engine_settings['synchronous'] = 'FULL'
 
-    with open(file_path, 'r') as f:
-        # todo: validate JSON schema validation in the future
-        summary_dict = json.loads(f.read())
+        # initialize database connection
+        db_engine = database.create_engine(config.DATABASE_URL, config.IMPORT_ENGINE_PROFILE, **engine_settings)
 
-    # initialize database connection
-    db_engine = create_engine(config.DATABASE_URL)
+        # get DB Session factory and initialize DB schema if needed
+        session_maker = database.get_session_maker(db_engine)
 
-    # get DB Session factory and initialize DB schema if needed
-    session_maker = database.get_session_maker(db_engine)
+    metrics_path = args.get('metrics') or config.METRICS_PATH
+    if metrics_path:
+        instrumentation.enable(db_engine)
 
+    # preload the diagnosis code ids, so diagnosis details rarely need to look up their code
     with database.session_scope(session_maker) as db_session:
-        _import_appointment_summary(db_session, summary_dict)
-        print('data successfully imported!')
+        diagnosis_code_cache = code_cache.get_diagnosis_code_cache(db_session, config.DIAGNOSIS_CODE_CACHE_SIZE)
+        diagnosis_code_cache.warm_from_database(db_session)
+        if args.get('diagnosis_codes'):
+            diagnosis_code_cache.warm_from_file(db_session, args.get('diagnosis_codes'))
+
+    checkpoint = ImportCheckpoint(args.get('checkpoint')) if args.get('checkpoint') else None
+    if checkpoint and checkpoint.current_file_path:
+        print(f'resuming after bundle {checkpoint.bundle_count} of {checkpoint.current_file_path}')
+
+    report_file = open(args.get('report'), 'a' if checkpoint else 'w') if args.get('report') else None
+    try:
+        start_time = time.monotonic()
+        if sharded_db:
+            imported_count, skipped_count, failed_count = import_sharded_bundles(
+                sharded_db,
+                _iter_bundles(args.get('json_file_paths')),
+                batch_size=max(1, args.get('batch_size')),
+                report_file=report_file,
+                force=args.get('force'),
+                workers=args.get('workers') or os.cpu_count(),
+            )
+        else:
+            imported_count, skipped_count, failed_count = import_bundles(
+                session_maker,
+                _iter_bundles(args.get('json_file_paths'), checkpoint=checkpoint),
+                batch_size=max(1, args.get('batch_size')),
+                report_file=report_file,
+                force=args.get('force'),
+                workers=args.get('workers') or os.cpu_count(),
+                checkpoint=checkpoint,
+            )
+        elapsed_secs = time.monotonic() - start_time
+
+        # the import is complete, a new run starts over
+        if checkpoint:
+            checkpoint.remove()
+    finally:
+        if report_file:
+            report_file.close()
+        if metrics_path:
+            instrumentation.write_stats(metrics_path)
+
+    bundle_count = imported_count + skipped_count + failed_count
+    print(f'{imported_count} bundle(s) successfully imported, {skipped_count} unchanged, {failed_count} failed and '
+          f'quarantined ({elapsed_secs:.2f}s, {bundle_count / elapsed_secs if elapsed_secs else 0:.1f} bundles/sec)')
+    if failed_count:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,22 @@
+import argparse
+import solution.database as database
+import solution.migrations as migrations
+import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate Database - utility to bring an existing database up to '
+                                                 'date with the current DB Schema.')
+    parser.add_argument('--database-url', default=config.DATABASE_URL,
+                        help=f'database to migrate (default: {config.DATABASE_URL}).')
+    parser.add_argument('--vacuum', action='store_true', help='reclaim the space freed by the migrations.')
+
+    args = vars(parser.parse_args())
+
+    db_engine = database.create_engine(args.get('database_url'), **config.ENGINE_SETTINGS)
+    for name, row_count in migrations.upgrade(db_engine, vacuum=args.get('vacuum')):
+        print(f'{name}: {row_count} row(s) migrated')
+
+
+if __name__ == '__main__':
+    main()
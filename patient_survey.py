@@ -1,6 +1,8 @@
 import json
-from sqlalchemy import create_engine
 import solution.database as db
+import solution.instrumentation as instrumentation
+import solution.summary_cache as summary_cache
+import solution.sharding as sharding
 from solution.controllers import (
     PatientController,
     PostAppointmentSurveyObjectBuilder,
@@ -74,22 +76,49 @@ def _conduct_patient_survey(db_session, appointment_summary):
 
 
 def main():
-    # initialize database connection
-    db_engine = create_engine(config.DATABASE_URL)
-
-    # get DB Session factory and initialize DB schema if needed
-    session_maker = db.get_session_maker(db_engine)
+    if config.SHARD_COUNT:
+        # the patient (and their appointments and surveys) lives in one of the shards
+        sharded_db = sharding.ShardedDatabase.from_url_template(
+            config.SHARD_DATABASE_URL, config.SHARD_COUNT, config.REFERENCE_DATABASE_URL,
+            config.SERVING_ENGINE_PROFILE, **config.ENGINE_SETTINGS)
+        shard_index = sharded_db.get_shard_index(config.PATIENT_ID)
+        db_engine = sharded_db.shard_engines[shard_index]
+        session_maker = sharded_db.shard_session_makers[shard_index]
+    else:
+        # initialize database connection
+        db_engine = db.create_engine(config.DATABASE_URL, config.SERVING_ENGINE_PROFILE, **config.ENGINE_SETTINGS)
+
+        # get DB Session factory and initialize DB schema if needed
+        session_maker = db.get_session_maker(db_engine)
+
+    if config.METRICS_PATH:
+        instrumentation.enable(db_engine)
+
+    appt_summary_cache = summary_cache.configure(
+        db_engine,
+        max_size=config.SUMMARY_CACHE_SIZE,
+        ttl_secs=config.SUMMARY_CACHE_TTL_SECS,
+        file_path=config.SUMMARY_CACHE_PATH,
+    )
 
     with db.session_scope(session_maker) as db_session:
         patient_controller = PatientController(db_session, config.PATIENT_ID)
         appt_summary = patient_controller.get_most_recent_appointment_summary()
         if not appt_summary.get('survey'):
             _conduct_patient_survey(db_session, appt_summary)
+            with instrumentation.phase(instrumentation.SURVEY_WRITE):
+                db_session.flush()
             appt_summary = patient_controller.get_most_recent_appointment_summary()
 
     print(f'\nThis is your survey response for your last appointment:\n'
           f'{json.dumps(appt_summary, sort_keys=True, indent=4, default=str)}')
 
+    if config.SUMMARY_CACHE_PATH:
+        appt_summary_cache.save(config.SUMMARY_CACHE_PATH)
+
+    if config.METRICS_PATH:
+        instrumentation.write_stats(config.METRICS_PATH)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,60 @@
+import sys
+import enum
+import json
+import time
+import argparse
+import solution.database as database
+import solution.search as search
+import config
+
+
+def _json_default(value):
+    if isinstance(value, enum.Enum):
+        return value.name
+
+    return str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Search Records - utility to search the appointments (by reason), '
+                                                 'patients (by name) and surveys (by feedback), and to rebuild the '
+                                                 'full-text indexes of an existing database.')
+    parser.add_argument('target', choices=['appointments', 'patients', 'surveys', 'rebuild'],
+                        help='records to search, or rebuild to rebuild the full-text indexes.')
+    parser.add_argument('text', nargs='?', default='',
+                        help='words the records must contain (as word prefixes, case and accent insensitive).')
+    parser.add_argument('--days', type=int, help='only the appointments of the last DAYS days.')
+    parser.add_argument('--page', type=int, default=1, help='page of the results (default: 1).')
+    parser.add_argument('--page-size', type=int, default=search.DEFAULT_PAGE_SIZE,
+                        help=f'number of results per page (default: {search.DEFAULT_PAGE_SIZE}).')
+    parser.add_argument('--database-url', default=config.DATABASE_URL,
+                        help=f'database to search (default: {config.DATABASE_URL}).')
+
+    args = vars(parser.parse_args())
+
+    db_engine = database.create_engine(args.get('database_url'), config.SERVING_ENGINE_PROFILE,
+                                       **config.ENGINE_SETTINGS)
+    session_maker = database.get_session_maker(db_engine)
+
+    if args.get('target') == 'rebuild':
+        with db_engine.begin() as connection:
+            for name, row_count in search.rebuild_indexes(connection).items():
+                print(f'{name}: {row_count} row(s) indexed')
+        return
+
+    page_args = dict(page=max(1, args.get('page')), page_size=max(1, args.get('page_size')))
+    with database.session_scope(session_maker) as db_session:
+        if args.get('target') == 'appointments':
+            since_ts = int(time.time()) - args.get('days') * 86400 if args.get('days') else None
+            results = search.search_appointments(db_session, args.get('text'), since_ts=since_ts, **page_args)
+        elif args.get('target') == 'patients':
+            results = search.search_patients(db_session, args.get('text'), **page_args)
+        else:
+            results = search.search_surveys(db_session, args.get('text'), **page_args)
+
+    for result in results:
+        sys.stdout.write(json.dumps(result, default=_json_default, ensure_ascii=False) + '\n')
+
+
+if __name__ == '__main__':
+    main()
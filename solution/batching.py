@@ -0,0 +1,245 @@
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+from contextlib import contextmanager
+from solution.database import Base
+
+
+_PENDING_WRITES_KEY = 'pending_writes'
+
+# db_session.info key -> copy function, of the states of the current transaction (see register_transaction_state)
+_transaction_states = {}
+# snapshots of the transaction states taken when each (active) SAVEPOINT began
+_TRANSACTION_STATE_SNAPSHOTS_KEY = 'transaction_state_snapshots'
+
+# max number of ids per "id IN (...)" delete statement
+_DELETE_CHUNK_SIZE = 500
+
+
+class PendingWrites:
+    """
+    Child rows collected by the object builders of a DB Session; the rows are written with one (executemany)
+    statement per table (and column set) right before the session runs its next statement or commits
+    """
+
+    def __init__(self):
+        self.rows = {}
+        self.updated_rows = {}
+        self.deleted_ids = {}
+        self.next_ids = {}
+        self.before_write = {}
+        self.is_writing = False
+
+    def is_empty(self):
+        return not self.rows and not self.updated_rows and not self.deleted_ids and not self.before_write
+
+
+def get_pending_writes(db_session):
+    result = db_session.info.get(_PENDING_WRITES_KEY)
+    if result is None:
+        result = db_session.info[_PENDING_WRITES_KEY] = PendingWrites()
+
+    return result
+
+
+def add_row(db_session, model, **values):
+    """
+    Queue a row to be inserted into the model's table
+    :param db_session: a connection to a database
+    :param model: mapped class of the row
+    :param values: column values of the row
+    :return: the queued row (values may be completed until the row is written, see add_before_write)
+    """
+    get_pending_writes(db_session).rows.setdefault(model.__table__, []).append(values)
+
+    return values
+
+
+def update_row(db_session, model, row_id, **values):
+    """
+    Queue an update of the row (of a model with an integer primary key) with the given id
+    :return: the queued values (may be completed until the row is written, see add_before_write)
+    """
+    values['_id'] = row_id
+    get_pending_writes(db_session).updated_rows.setdefault(model.__table__, []).append(values)
+
+    return values
+
+
+def delete_rows(db_session, model, row_ids):
+    """
+    Queue the deletion of the rows (of a model with an integer primary key) with the given ids
+    """
+    get_pending_writes(db_session).deleted_ids.setdefault(model.__table__, set()).update(row_ids)
+
+
+def add_before_write(db_session, key, callback):
+    """
+    Register a callback that runs (once) right before the queued rows are written, e.g. to resolve foreign keys
+    of queued rows in bulk
+    :param key: identifies the callback, registering the same key again replaces the callback
+    :param callback: function that takes the DB Session
+    """
+    get_pending_writes(db_session).before_write[key] = callback
+
+
+def allocate_ids(db_session, model, count):
+    """
+    Reserve primary keys for rows of a model with an integer primary key, so rows referencing them can be
+    queued before the rows are written. On PostgreSQL the ids are taken from the table's sequence; on SQLite the
+    transaction first takes the write lock (so no concurrent transaction inserts rows until it ends) and reads the
+    current max id once
+    (note: on SQLite, only valid if all rows of the model are inserted with allocated ids)
+    :return: list of the reserved ids
+    """
+    table = model.__table__
+    if db_session.get_bind().dialect.name == 'postgresql':
+        return list(db_session.execute(
+            sa.select(sa.func.nextval(sa.func.pg_get_serial_sequence(f'"{table.name}"', 'id')))
+            .select_from(sa.func.generate_series(1, count))
+        ).scalars())
+
+    pending = get_pending_writes(db_session)
+    next_id = pending.next_ids.get(table)
+    if next_id is None:
+        # (a statement that writes no rows, it takes the write lock of a deferred transaction before the max id
+        # is read)
+        db_session.execute(table.delete().where(sa.false()))
+        next_id = (db_session.execute(sa.select(sa.func.max(table.c.id))).scalar() or 0) + 1
+
+    pending.next_ids[table] = next_id + count
+
+    return list(range(next_id, next_id + count))
+
+
+def _group_by_columns(rows):
+    result = {}
+    for row in rows:
+        result.setdefault(tuple(row), []).append(row)
+
+    return result.values()
+
+
+def write_pending(db_session):
+    """
+    Write all queued rows using one statement per table and column set: deletes (child tables first), then
+    inserts (parent tables first) and updates
+    """
+    pending = db_session.info.get(_PENDING_WRITES_KEY)
+    if pending is None or pending.is_writing or pending.is_empty():
+        return
+
+    pending.is_writing = True
+    try:
+        # queued rows reference objects that may only exist in the session so far
+        db_session.flush()
+
+        while pending.before_write:
+            pending.before_write.pop(next(iter(pending.before_write)))(db_session)
+
+        for table in reversed(Base.metadata.sorted_tables):
+            row_ids = sorted(pending.deleted_ids.pop(table, ()))
+            for i in range(0, len(row_ids), _DELETE_CHUNK_SIZE):
+                db_session.execute(table.delete().where(table.c.id.in_(row_ids[i:i + _DELETE_CHUNK_SIZE])))
+
+        for table in Base.metadata.sorted_tables:
+            for rows in _group_by_columns(pending.rows.pop(table, ())):
+                db_session.execute(table.insert(), rows)
+
+        for table in Base.metadata.sorted_tables:
+            for rows in _group_by_columns(pending.updated_rows.pop(table, ())):
+                db_session.execute(table.update().where(table.c.id == sa.bindparam('_id')), rows)
+    finally:
+        pending.is_writing = False
+
+
+def discard_pending(db_session):
+    """
+    Drop the queued rows, e.g. after the transaction (or savepoint) they belong to has been rolled back
+    """
+    pending = db_session.info.get(_PENDING_WRITES_KEY)
+    if pending is not None:
+        pending.rows.clear()
+        pending.updated_rows.clear()
+        pending.deleted_ids.clear()
+        pending.before_write.clear()
+
+
+@contextmanager
+def savepoint(db_session):
+    """
+    Run a block in a SAVEPOINT: the rows queued before the block are written first, the rows queued in the block
+    are written before the savepoint is released (so write errors roll back the savepoint) or discarded if the
+    block fails
+    """
+    write_pending(db_session)
+    with db_session.begin_nested():
+        try:
+            yield
+            write_pending(db_session)
+        except Exception:
+            discard_pending(db_session)
+            raise
+
+
+def register_transaction_state(key, copy):
+    """
+    Register a db_session.info key holding state of the current transaction (e.g. the objects it changed, handled
+    when it commits): the state is restored when a SAVEPOINT is rolled back, and dropped when the transaction ends
+    :param copy: function that copies the state, so that the snapshot taken when a savepoint begins doesn't change
+                 along with the state
+    """
+    _transaction_states[key] = copy
+
+
+@event.listens_for(orm.Session, 'after_transaction_create')
+def _snapshot_transaction_states_before_savepoint(db_session, transaction):
+    if transaction.nested:
+        db_session.info.setdefault(_TRANSACTION_STATE_SNAPSHOTS_KEY, []).append({
+            key: copy(db_session.info[key]) for key, copy in _transaction_states.items() if key in db_session.info
+        })
+
+
+@event.listens_for(orm.Session, 'after_rollback')
+def _restore_transaction_states_after_savepoint_rollback(db_session):
+    snapshots = db_session.info.get(_TRANSACTION_STATE_SNAPSHOTS_KEY)
+    if db_session.in_nested_transaction() and snapshots:
+        snapshot = snapshots.pop()
+        for key in _transaction_states:
+            if key in snapshot:
+                db_session.info[key] = snapshot[key]
+            else:
+                db_session.info.pop(key, None)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _drop_snapshot_after_savepoint_release(db_session):
+    # (the states of a released savepoint belong to the enclosing transaction)
+    snapshots = db_session.info.get(_TRANSACTION_STATE_SNAPSHOTS_KEY)
+    if db_session.in_nested_transaction() and snapshots:
+        snapshots.pop()
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def _drop_transaction_states_after_transaction(db_session, transaction):
+    if transaction.parent is None:
+        for key in _transaction_states:
+            db_session.info.pop(key, None)
+        db_session.info.pop(_TRANSACTION_STATE_SNAPSHOTS_KEY, None)
+
+
+@event.listens_for(orm.Session, 'do_orm_execute')
+def _write_pending_before_execute(orm_execute_state):
+    write_pending(orm_execute_state.session)
+
+
+@event.listens_for(orm.Session, 'before_commit')
+def _write_pending_before_commit(db_session):
+    write_pending(db_session)
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def _reset_pending_after_transaction(db_session, transaction):
+    if transaction.parent is None and _PENDING_WRITES_KEY in db_session.info:
+        # allocated ids are only valid within the transaction that read the max id
+        db_session.info.pop(_PENDING_WRITES_KEY)
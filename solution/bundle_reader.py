@@ -0,0 +1,310 @@
+import io
+import sys
+import gzip
+import json
+
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_WHITESPACE = ' \t\n\r'
+
+# characters read from the stream at a time
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# max number of entries (other than nested bundles) kept per bundle, an appointment summary has 4
+DEFAULT_MAX_ENTRIES = 1000
+
+# max number of characters of a JSON value read at once (an entry of a bundle, or a field other than its entries)
+DEFAULT_MAX_VALUE_CHARS = 16 * 1024 * 1024
+
+# a value that fails to decode this close to the end of the buffer may only be cut by the end of the buffer (e.g. a
+# literal such as 'tr' or a \uXXXX escape), farther from it the value itself is malformed
+_MAX_TOKEN_CHARS = 16
+
+
+def _skip_bytes(f, size):
+    if f.seekable():
+        f.seek(size, io.SEEK_CUR)
+        return
+
+    while size > 0:
+        data = f.read(min(size, DEFAULT_CHUNK_SIZE))
+        if not data:
+            return
+        size -= len(data)
+
+
+def open_bundle_file(file_path, offset=0):
+    """
+    Open a bundle file (gzip compressed or not) as text
+    :param file_path: path of the file, '-' for stdin
+    :param offset: byte offset (of the uncompressed content) to start reading at, see BundleReader.position
+    :return: text file object
+    """
+    f = sys.stdin.buffer if file_path == '-' else open(file_path, 'rb')
+
+    # detected by content (rather than file extension), so compressed stdin works as well
+    if f.peek(len(_GZIP_MAGIC))[:len(_GZIP_MAGIC)] == _GZIP_MAGIC:
+        if file_path == '-':
+            f = gzip.GzipFile(fileobj=f, mode='rb')
+        else:
+            f.close()
+            f = gzip.open(file_path, 'rb')
+
+    if offset:
+        _skip_bytes(f, offset)
+
+    # (newlines are not translated, so the positions of the reader are byte offsets of the file)
+    return io.TextIOWrapper(f, encoding='utf-8', newline='')
+
+
+class OversizedBundle(dict):
+    """
+    Bundle with more entries than the max_entries of the reader: only its first max_entries entries are kept, the
+    others are read and dropped
+    """
+
+    def __init__(self, bundle, entry_count):
+        super().__init__(bundle)
+        # number of entries of the bundle in the input
+        self.entry_count = entry_count
+
+
+class MalformedBundle(dict):
+    """
+    Placeholder of a line of NDJSON input that is not a valid bundle, the reading continues with the next line
+    """
+
+    def __init__(self, offset, error_message):
+        super().__init__()
+        # byte offset in the input of the value that failed
+        self.offset = offset
+        self.error_message = error_message
+
+
+class BundleReader:
+    """
+    Incremental reader of appointment summary bundles: the input is read in chunks and only one bundle is in
+    memory at a time, whatever the size of the input. The input is a sequence of JSON values (one per line, as in
+    NDJSON, or simply concatenated), each a bundle or an array of bundles; the entries of a bundle are read one at a
+    time, and the bundles nested in the entries of a bundle (e.g. of a 'collection' bundle) are yielded one by one,
+    so a bundle holds at most max_entries entries in memory (see OversizedBundle)
+    """
+
+    def __init__(self, f, chunk_size=DEFAULT_CHUNK_SIZE, offset=0, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_value_chars=DEFAULT_MAX_VALUE_CHARS, is_ndjson=False):
+        """
+        :param offset: byte offset of the start of f in the input (see open_bundle_file)
+        :param max_value_chars: max number of characters of a JSON value, a longer value fails the reading
+        :param is_ndjson: whether the input holds one value per line, a line that fails is then skipped and yielded
+                          as a MalformedBundle (rather than failing the reading)
+        """
+        self._f = f
+        self._chunk_size = chunk_size
+        self._max_entries = max_entries
+        self._max_value_chars = max_value_chars
+        self._is_ndjson = is_ndjson
+        # whether a top-level value of NDJSON input is being read, it must end on its line
+        self._is_in_line = False
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._pos = 0
+        self._is_eof = False
+        # byte offset of _buffer[:_offset_pos] in the input
+        self._offset = offset
+        self._offset_pos = 0
+        # byte offset of the value being read (or of the end of the last complete bundle) and number of bundles
+        # yielded since, see position
+        self._item_offset = offset
+        self._item_bundle_count = 0
+
+    @property
+    def position(self):
+        """
+        Position after the last yielded bundle: tuple of (byte offset, skip count), the bundles that follow are read
+        again by opening the input at the byte offset (see open_bundle_file) and skipping skip count bundles (only
+        the bundles of a top-level array or of a collection bundle are skipped)
+        """
+        return self._item_offset, self._item_bundle_count
+
+    def _tell(self):
+        # byte offset of the current position, the text read since the last call is encoded once
+        self._offset += len(self._buffer[self._offset_pos:self._pos].encode('utf-8'))
+        self._offset_pos = self._pos
+        return self._offset
+
+    def _fill(self, size=None):
+        if self._is_eof:
+            return False
+
+        data = self._f.read(size or self._chunk_size)
+        if not data:
+            self._is_eof = True
+            return False
+
+        self._tell()
+        self._buffer = self._buffer[self._pos:] + data
+        self._pos = 0
+        self._offset_pos = 0
+        return True
+
+    def _peek(self):
+        """
+        :return: next non-whitespace character (not consumed), '' at the end of the input
+        """
+        while True:
+            buffer = self._buffer
+            pos = self._pos
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE:
+                if buffer[pos] == '\n' and self._is_in_line:
+                    self._pos = pos
+                    raise ValueError('unexpected end of line')
+                pos += 1
+            self._pos = pos
+
+            if pos < len(buffer):
+                return buffer[pos]
+            if not self._fill():
+                return ''
+
+    def _expect(self, chars):
+        ch = self._peek()
+        if ch not in chars:
+            raise ValueError(f'expected one of {chars!r} at "{self._buffer[self._pos:self._pos + 40]}"')
+
+        self._pos += 1
+        return ch
+
+    def _read_value(self):
+        """
+        Read a complete JSON value; the buffer grows until it holds the whole value (a value that ends at the end of
+        the buffer, e.g. a number, may continue in the next chunk)
+        """
+        self._peek()
+        while True:
+            try:
+                result, end = self._decoder.raw_decode(self._buffer, self._pos)
+                if end < len(self._buffer) or self._is_eof:
+                    self._pos = end
+                    return result
+            except json.JSONDecodeError as e:
+                # (an unterminated string is only reported once the whole buffer has been scanned)
+                is_cut = e.msg.startswith('Unterminated string') or len(self._buffer) - e.pos <= _MAX_TOKEN_CHARS
+                if self._is_eof or not is_cut:
+                    raise
+
+            size = len(self._buffer) - self._pos
+            if size >= self._max_value_chars:
+                raise ValueError(f'value of more than {self._max_value_chars} characters')
+
+            # double the buffer, so a large value is decoded a logarithmic number of times
+            self._fill(max(self._chunk_size, size))
+
+    def _skip_line(self):
+        # skip the rest of the current line (without holding it in the buffer)
+        while True:
+            end = self._buffer.find('\n', self._pos)
+            if end >= 0:
+                self._pos = end + 1
+                return
+
+            self._pos = len(self._buffer)
+            if not self._fill():
+                return
+
+    def _iter_array(self, read_item):
+        self._expect('[')
+        if self._peek() == ']':
+            self._pos += 1
+            return
+
+        while True:
+            yield from read_item()
+            if self._expect(',]') == ']':
+                return
+
+    def _iter_bundle_object(self, is_top_level):
+        """
+        Read a bundle object, entry by entry
+        :param is_top_level: whether the bundle is a top-level value of the input (rather than an item of an array)
+        :return: generator of the bundle (unless it only holds nested bundles) and of its nested bundles
+        """
+        result = {}
+        entries = []
+        entry_count = 0
+        nested_bundle_count = 0
+
+        self._expect('{')
+        while self._peek() != '}':
+            if result:
+                self._expect(',')
+
+            key = self._read_value()
+            self._expect(':')
+            if key != 'entry' or self._peek() != '[':
+                result[key] = self._read_value()
+                continue
+
+            for entry in self._iter_array(lambda: [self._read_value()]):
+                resource = entry.get('resource') if isinstance(entry, dict) else None
+                if isinstance(resource, dict) and resource.get('resourceType') == 'Bundle':
+                    nested_bundle_count += 1
+                    self._item_bundle_count += 1
+                    yield resource
+                else:
+                    entry_count += 1
+                    if entry_count <= self._max_entries:
+                        entries.append(entry)
+
+            result['entry'] = entries
+
+        self._pos += 1
+        if entry_count > len(entries):
+            result = OversizedBundle(result, entry_count)
+
+        if not nested_bundle_count or entries:
+            if is_top_level:
+                # the input can be read again from the end of the bundle
+                self._item_offset = self._tell()
+                self._item_bundle_count = 0
+            else:
+                self._item_bundle_count += 1
+            yield result
+
+    def _iter_item(self, is_top_level=False):
+        ch = self._peek()
+        if ch == '{':
+            yield from self._iter_bundle_object(is_top_level)
+        elif ch == '[':
+            yield from self._iter_array(self._iter_item)
+        else:
+            raise ValueError(f'expected a bundle or an array of bundles at "{self._buffer[self._pos:self._pos + 40]}"')
+
+    def __iter__(self):
+        while self._peek():
+            self._item_offset = self._tell()
+            self._item_bundle_count = 0
+            self._is_in_line = self._is_ndjson
+            try:
+                yield from self._iter_item(is_top_level=True)
+            except ValueError as e:
+                if not self._is_ndjson:
+                    raise
+
+                # (the JSON decoder reports positions in the buffer, the offset of the value is reported instead)
+                error = MalformedBundle(self._tell(), e.msg if isinstance(e, json.JSONDecodeError) else str(e))
+                self._is_in_line = False
+                self._skip_line()
+                self._item_offset = self._tell()
+                self._item_bundle_count = 0
+                yield error
+            finally:
+                self._is_in_line = False
+
+
+def iter_bundles(f, chunk_size=DEFAULT_CHUNK_SIZE, max_entries=DEFAULT_MAX_ENTRIES,
+                 max_value_chars=DEFAULT_MAX_VALUE_CHARS, is_ndjson=False):
+    """
+    Iterate over the bundles of a text file object (see BundleReader)
+    """
+    return iter(BundleReader(f, chunk_size=chunk_size, max_entries=max_entries, max_value_chars=max_value_chars,
+                             is_ndjson=is_ndjson))
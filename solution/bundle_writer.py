@@ -0,0 +1,176 @@
+import io
+import sys
+import gzip
+import json
+import uuid
+import solution.models as models
+import solution.serializers as serializers
+import solution.instrumentation as instrumentation
+
+
+# number of appointments (and bundles) loaded per query
+DEFAULT_CHUNK_SIZE = 500
+
+# max number of ids per "IN (...)" query (SQLite's default limit is 999 parameters)
+_IN_CHUNK_SIZE = 500
+
+# namespace of the (deterministic) ids of the exported bundles
+_BUNDLE_ID_NAMESPACE = uuid.UUID('5b0f4c8e-2a6d-4f51-9a3e-0d8c7e61b2a4')
+
+
+def open_export_file(file_path):
+    """
+    Open the file the bundles are exported to (gzip compressed if the extension is .gz)
+    :param file_path: path of the file, '-' for stdout
+    :return: text file object
+    """
+    if file_path == '-':
+        return io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+
+    if file_path.endswith('.gz'):
+        return gzip.open(file_path, 'wt', encoding='utf-8')
+
+    return open(file_path, 'w', encoding='utf-8')
+
+
+def _user_resource(resource_type, user, names, contact_info):
+    result = dict(
+        resourceType=resource_type,
+        id=user['id'],
+        active=user['is_active'],
+        name=[],
+    )
+    for family_name, name_text, given_names in names:
+        name = {}
+        if name_text is not None:
+            name['text'] = name_text
+        if family_name is not None:
+            name['family'] = family_name
+        name['given'] = given_names
+        result['name'].append(name)
+
+    if contact_info:
+        result['contact'] = [dict(system=system.name, value=value, use=name) for system, name, value in contact_info]
+    if user['gender']:
+        result['gender'] = user['gender'].name
+    if user['birth_date']:
+        result['birthDate'] = user['birth_date'].strftime('%Y-%m-%d')
+
+    return result
+
+
+def _appointment_resource(appt):
+    result = dict(
+        resourceType='Appointment',
+        id=appt['id'],
+        status=appt['status'].name,
+        type=[dict(text=reason_text) for reason_text in appt['reasons']],
+    )
+    if appt['subject_id']:
+        result['subject'] = dict(reference=f'Patient/{appt["subject_id"]}')
+    if appt['actor_id']:
+        result['actor'] = dict(reference=f'Doctor/{appt["actor_id"]}')
+    result['period'] = dict(start=appt['start_time'], end=appt['end_time'])
+
+    return result
+
+
+def _diagnosis_resource(diagnosis):
+    return dict(
+        resourceType='Diagnosis',
+        id=diagnosis['id'],
+        meta=dict(lastUpdated=diagnosis['last_updated_time']),
+        status=diagnosis['status'].name,
+        code=dict(coding=[dict(system=c['system'], code=c['code'], name=c['name']) for c in diagnosis['codes']]),
+        appointment=dict(reference=f'Appointment/{diagnosis["appointment_id"]}'),
+    )
+
+
+@instrumentation.instrumented(instrumentation.SERIALIZE)
+def _make_bundles(db_session, appts):
+    """
+    :param appts: serialized appointments (see solution.serializers)
+    :return: list of bundles
+    """
+    user_serializer = serializers.get_serializer(models.User)
+    user_ids = sorted({appt[key] for appt in appts for key in ('subject_id', 'actor_id') if appt[key]})
+    users = {}
+    for i in range(0, len(user_ids), _IN_CHUNK_SIZE):
+        for user in db_session.execute(user_serializer.select().where(
+                models.User.id.in_(user_ids[i:i + _IN_CHUNK_SIZE]))).mappings():
+            users[user['id']] = user
+    names, contact_info = user_serializer.load_children(db_session, list(users))
+
+    diagnosis_serializer = serializers.get_serializer(models.Diagnosis)
+    appt_ids = [appt['id'] for appt in appts]
+    diagnoses = {}
+    for i in range(0, len(appt_ids), _IN_CHUNK_SIZE):
+        select_stmt = diagnosis_serializer.select().where(
+            models.Diagnosis.appointment_id.in_(appt_ids[i:i + _IN_CHUNK_SIZE])).order_by(models.Diagnosis.id)
+        for diagnosis in serializers.serialize_rows(db_session, models.Diagnosis, db_session.execute(select_stmt)):
+            diagnoses.setdefault(diagnosis['appointment_id'], []).append(diagnosis)
+
+    result = []
+    for appt in appts:
+        entries = []
+        for resource_type, user_id in (('Patient', appt['subject_id']), ('Doctor', appt['actor_id'])):
+            if user_id in users:
+                entries.append(dict(resource=_user_resource(
+                    resource_type, users[user_id], names.get(user_id, ()), contact_info.get(user_id, ()))))
+        entries.append(dict(resource=_appointment_resource(appt)))
+
+        # one bundle per diagnosis of the appointment (a bundle holds a single diagnosis)
+        for diagnosis in diagnoses.get(appt['id']) or [None]:
+            bundle_entries = list(entries)
+            if diagnosis:
+                bundle_entries.append(dict(resource=_diagnosis_resource(diagnosis)))
+
+            result.append(dict(
+                resourceType='Bundle',
+                id=str(uuid.uuid5(_BUNDLE_ID_NAMESPACE, f'{appt["id"]}:{diagnosis["id"] if diagnosis else ""}')),
+                timestamp=diagnosis['last_updated_time'] if diagnosis else appt['end_time'],
+                entry=bundle_entries,
+            ))
+
+    return result
+
+
+def iter_bundles(db_session, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Export every appointment as an appointment summary bundle (patient, doctor, appointment and diagnosis entries,
+    the shape import_summary.py imports). The appointments are read in chunks by id (keyset pagination, every chunk
+    is an index range scan) and the rows they reference are loaded in bulk per chunk, without ORM objects, so the
+    memory use does not depend on the size of the database
+    :param chunk_size: number of appointments per chunk
+    :return: generator of bundles, ordered by appointment id
+    """
+    appt_serializer = serializers.get_serializer(models.Appointment)
+    last_appt_id = None
+    while True:
+        select_stmt = appt_serializer.select().order_by(models.Appointment.id).limit(chunk_size)
+        if last_appt_id is not None:
+            select_stmt = select_stmt.where(models.Appointment.id > last_appt_id)
+
+        appts = serializers.serialize_rows(db_session, models.Appointment, db_session.execute(select_stmt))
+        if not appts:
+            break
+
+        yield from _make_bundles(db_session, appts)
+
+        if len(appts) < chunk_size:
+            break
+        last_appt_id = appts[-1]['id']
+
+
+def write_bundles(f, bundles):
+    """
+    Write bundles as NDJSON (one bundle per line)
+    :return: number of written bundles
+    """
+    result = 0
+    for bundle in bundles:
+        f.write(json.dumps(bundle, ensure_ascii=False, separators=(',', ':')))
+        f.write('\n')
+        result += 1
+
+    return result
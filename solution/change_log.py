@@ -0,0 +1,111 @@
+import time
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+import solution.models as models
+import solution.batching as batching
+import solution.serializers as serializers
+
+
+# number of changes returned per batch
+DEFAULT_BATCH_SIZE = 500
+
+# models of the entities whose changes are logged, by entity type
+ENTITY_MODELS = {
+    model.__name__: model
+    for model in (models.User, models.Appointment, models.Diagnosis, models.PostAppointmentSurvey)
+}
+
+# (entity type, entity id) of the entities changed by a transaction (in order), logged once when it commits
+_CHANGES_KEY = 'change_log_changes'
+
+
+def record_change(db_session, obj):
+    """
+    Record that an entity changed, the change is logged (see ChangeLog) when the transaction commits; an entity
+    changed many times by a transaction is logged once
+    :param obj: the changed User, Appointment, Diagnosis or PostAppointmentSurvey object
+    """
+    db_session.info.setdefault(_CHANGES_KEY, {})[(type(obj).__name__, obj.id)] = None
+
+
+def get_changes(db_session, cursor=0, limit=DEFAULT_BATCH_SIZE):
+    """
+    Get the logged changes after a cursor
+    :param cursor: sequence number of the last change already seen, 0 for all the changes
+    :param limit: max number of changes
+    :return: list of (seq, entity type, entity id, changed ts) rows, ordered by sequence number
+    """
+    table = models.ChangeLog.__table__
+    return db_session.execute(
+        sa.select(table.c.seq, table.c.entity_type, table.c.entity_id, table.c.changed_ts)
+        .where(table.c.seq > cursor).order_by(table.c.seq).limit(limit)
+    ).all()
+
+
+def get_last_cursor(db_session):
+    """
+    :return: sequence number of the most recent change, 0 if no change is logged
+    """
+    return db_session.execute(sa.select(sa.func.max(models.ChangeLog.seq))).scalar() or 0
+
+
+def iter_changed_entities(db_session, cursor=0, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Get the current state of the entities changed after a cursor, in batches of (at most) batch_size changes; the
+    work depends on the number of changes, not on the size of the tables
+    :param cursor: sequence number of the last change already seen, 0 for all the changes
+    :return: generator of (cursor, entities) tuples: the cursor to resume after the batch, and a list of dicts with
+             the seq (of the last change), entity_type, entity_id and entity (serialized, see solution.serializers;
+             None if the entity does not exist anymore) of each entity changed in the batch, ordered by seq
+    """
+    while True:
+        changes = get_changes(db_session, cursor, batch_size)
+        if not changes:
+            break
+
+        # an entity changed more than once is returned once, with its last change
+        last_seqs = {}
+        for seq, entity_type, entity_id, _ in changes:
+            last_seqs.pop((entity_type, entity_id), None)
+            last_seqs[(entity_type, entity_id)] = seq
+
+        entity_ids = {}
+        for entity_type, entity_id in last_seqs:
+            entity_ids.setdefault(entity_type, []).append(entity_id)
+        entities = {
+            entity_type: serializers.serialize_ids(db_session, ENTITY_MODELS[entity_type], ids)
+            for entity_type, ids in entity_ids.items()
+        }
+
+        cursor = changes[-1][0]
+        yield cursor, [
+            dict(
+                seq=seq,
+                entity_type=entity_type,
+                entity_id=entity_id,
+                entity=entities[entity_type].get(entity_id),
+            )
+            for (entity_type, entity_id), seq in last_seqs.items()
+        ]
+
+        if len(changes) < batch_size:
+            break
+
+
+batching.register_transaction_state(_CHANGES_KEY, dict)
+
+
+@event.listens_for(orm.Session, 'before_commit')
+def _log_changes_before_commit(db_session):
+    if db_session.in_nested_transaction():
+        # a released savepoint, its changes are logged along with the enclosing transaction
+        return
+
+    changes = db_session.info.pop(_CHANGES_KEY, None)
+    if changes:
+        changed_ts = int(time.time())
+        db_session.execute(models.ChangeLog.__table__.insert(), [
+            dict(entity_type=entity_type, entity_id=entity_id, changed_ts=changed_ts)
+            for entity_type, entity_id in changes
+        ])
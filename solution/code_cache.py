@@ -0,0 +1,206 @@
+import csv
+import threading
+import weakref
+from collections import OrderedDict
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+import solution.models as models
+import solution.batching as batching
+
+
+DEFAULT_CACHE_SIZE = 100000
+
+# codes inserted by a transaction, promoted to the shared cache once the transaction commits
+_NEW_CODE_IDS_KEY = 'new_diagnosis_code_ids'
+_UNRESOLVED_CODES_KEY = 'unresolved_diagnosis_codes'
+
+# max number of bind parameters per "code IN (...)" query (SQLite's default limit is 999)
+_QUERY_CHUNK_SIZE = 500
+
+
+def _chunks(items, chunk_size):
+    for i in range(0, len(items), chunk_size):
+        yield items[i:i + chunk_size]
+
+
+def _insert_ignore(db_session):
+    # insert codes, skipping the ones inserted concurrently by another session (code is unique); other constraint
+    # violations (e.g. a code without name) still fail
+    table = models.DiagnosisCode.__table__
+    dialect = postgresql if db_session.get_bind().dialect.name == 'postgresql' else sqlite
+
+    return dialect.insert(table).on_conflict_do_nothing(index_elements=[table.c.code])
+
+
+class DiagnosisCodeCache:
+    """
+    Bounded (LRU) map of diagnosis code -> DiagnosisCode.id for one database, shared by all the sessions of the
+    process; only ids of committed DiagnosisCode rows are cached
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE):
+        self._max_size = max_size
+        self._code_ids = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._code_ids)
+
+    def get(self, code):
+        with self._lock:
+            result = self._code_ids.get(code)
+            if result is not None:
+                self._code_ids.move_to_end(code)
+
+            return result
+
+    def update(self, code_ids):
+        with self._lock:
+            for code, code_id in code_ids.items():
+                self._code_ids[code] = code_id
+                self._code_ids.move_to_end(code)
+
+            while len(self._code_ids) > self._max_size:
+                self._code_ids.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._code_ids.clear()
+
+    def warm_from_database(self, db_session):
+        """
+        Load the ids of (up to max_size) existing codes with a single query
+        """
+        table = models.DiagnosisCode.__table__
+        rows = db_session.execute(sa.select(table.c.code, table.c.id).order_by(table.c.id).limit(self._max_size))
+        self.update({code: code_id for code, code_id in rows})
+
+    def warm_from_file(self, db_session, file_path):
+        """
+        Load the ids of the codes listed in a CSV file (with a "code,name,system" header), codes that do not exist
+        yet are inserted in batches
+        """
+        with open(file_path, 'r', newline='') as f:
+            code_rows = {row['code']: row for row in csv.DictReader(f) if row.get('code')}
+
+        code_ids = self.resolve(db_session, [
+            dict(code=code, name=row.get('name') or code, system=row.get('system') or None)
+            for code, row in code_rows.items()
+        ])
+
+        # the new codes are cached on commit, caching the existing ones right away
+        new_code_ids = db_session.info.get(_NEW_CODE_IDS_KEY, {})
+        self.update({code: code_id for code, code_id in code_ids.items() if code not in new_code_ids})
+
+    def resolve(self, db_session, code_rows):
+        """
+        Look up the ids of the given codes, inserting the missing codes in bulk
+        :param db_session: a connection to a database
+        :param code_rows: list of dicts with the code, name and system of each code
+        :return: dict of code -> id
+        """
+        result = {}
+        new_code_ids = db_session.info.setdefault(_NEW_CODE_IDS_KEY, {})
+
+        missing_rows = {}
+        for code_row in code_rows:
+            code = code_row['code']
+            code_id = new_code_ids.get(code) or self.get(code)
+            if code_id is None:
+                missing_rows.setdefault(code, code_row)
+            else:
+                result[code] = code_id
+
+        if not missing_rows:
+            return result
+
+        table = models.DiagnosisCode.__table__
+        existing_code_ids = {}
+        for codes in _chunks(list(missing_rows), _QUERY_CHUNK_SIZE):
+            rows = db_session.execute(sa.select(table.c.code, table.c.id).where(table.c.code.in_(codes)))
+            existing_code_ids.update({code: code_id for code, code_id in rows})
+
+        self.update(existing_code_ids)
+        result.update(existing_code_ids)
+
+        insert_rows = [code_row for code, code_row in missing_rows.items() if code not in existing_code_ids]
+        if insert_rows:
+            db_session.execute(_insert_ignore(db_session), insert_rows)
+
+            inserted_codes = [code_row['code'] for code_row in insert_rows]
+            for codes in _chunks(inserted_codes, _QUERY_CHUNK_SIZE):
+                rows = db_session.execute(sa.select(table.c.code, table.c.id).where(table.c.code.in_(codes)))
+                new_code_ids.update({code: code_id for code, code_id in rows})
+
+            result.update({code: new_code_ids[code] for code in inserted_codes})
+
+        return result
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def get_diagnosis_code_cache(db_session, max_size=DEFAULT_CACHE_SIZE):
+    """
+    Get the process wide diagnosis code cache of the database the session is bound to
+    :param max_size: max number of cached codes, used when the cache is created
+    """
+    db_engine = db_session.get_bind()
+    with _caches_lock:
+        result = _caches.get(db_engine)
+        if result is None:
+            result = _caches[db_engine] = DiagnosisCodeCache(max_size)
+
+        return result
+
+
+def _resolve_queued_codes(db_session):
+    unresolved_codes = db_session.info.pop(_UNRESOLVED_CODES_KEY, [])
+    code_ids = get_diagnosis_code_cache(db_session).resolve(
+        db_session, [code_row for code_row, _ in unresolved_codes])
+    for code_row, row in unresolved_codes:
+        row['diagnosis_code_id'] = code_ids[code_row['code']]
+
+
+def set_diagnosis_code_id(db_session, row, code, name, system):
+    """
+    Set the diagnosis_code_id of a queued (DiagnosisDetail) row, the code id comes from the cache or (for unseen
+    codes) is resolved in bulk right before the queued rows are written
+    """
+    code_id = db_session.info.get(_NEW_CODE_IDS_KEY, {}).get(code) or \
+        get_diagnosis_code_cache(db_session).get(code)
+
+    row['diagnosis_code_id'] = code_id
+    if code_id is None:
+        code_row = dict(code=code, name=name, system=system)
+        db_session.info.setdefault(_UNRESOLVED_CODES_KEY, []).append((code_row, row))
+        batching.add_before_write(db_session, _UNRESOLVED_CODES_KEY, _resolve_queued_codes)
+
+
+def queue_diagnosis_detail(db_session, diagnosis_id, code, name, system):
+    """
+    Queue a DiagnosisDetail row for the given code
+    """
+    detail_row = batching.add_row(
+        db_session,
+        models.DiagnosisDetail,
+        diagnosis_id=diagnosis_id,
+        diagnosis_code_id=None,
+    )
+    set_diagnosis_code_id(db_session, detail_row, code, name, system)
+
+
+batching.register_transaction_state(_NEW_CODE_IDS_KEY, dict)
+batching.register_transaction_state(_UNRESOLVED_CODES_KEY, list)
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _cache_new_codes_after_commit(db_session):
+    # (the codes of a released savepoint are only committed along with the enclosing transaction)
+    if not db_session.in_nested_transaction():
+        new_code_ids = db_session.info.pop(_NEW_CODE_IDS_KEY, None)
+        if new_code_ids:
+            get_diagnosis_code_cache(db_session).update(new_code_ids)
@@ -0,0 +1,45 @@
+import uuid
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+class UUID(sa.types.TypeDecorator):
+    """
+    UUID stored as 16 bytes (or as the dialect's native UUID type), the values are exposed in their canonical
+    string form ('6739ec3e-93bd-11eb-a8b3-0242ac130003')
+    """
+
+    impl = sa.LargeBinary(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == 'postgresql':
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+
+        return dialect.type_descriptor(sa.LargeBinary(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+
+        if dialect.name == 'postgresql':
+            return str(value)
+
+        if isinstance(value, uuid.UUID):
+            return value.bytes
+
+        # fast path for the canonical form, uuid.UUID() handles the other forms (and validates the value)
+        if len(value) == 36 and value[8] == value[13] == value[18] == value[23] == '-':
+            return bytes.fromhex(value.replace('-', ''))
+
+        return uuid.UUID(value).bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        if dialect.name == 'postgresql':
+            return str(value)
+
+        value = bytes(value).hex()
+        return f'{value[:8]}-{value[8:12]}-{value[12:16]}-{value[16:20]}-{value[20:]}'
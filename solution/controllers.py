@@ -1,8 +1,24 @@
 import time
+import uuid
+from contextlib import contextmanager
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
 from solution.enums import (
     UserType,
+    LookupTokenKind,
 )
 import solution.models as models
+import solution.database as database
+import solution.batching as batching
+import solution.code_cache as code_cache
+import solution.instrumentation as instrumentation
+import solution.summary_cache as summary_cache
+import solution.change_log as change_log
+import solution.search as search
+import solution.patient_lookup as patient_lookup
+import solution.serializers as serializers
+import solution.schedule as schedule
+import solution.survey_rollups as survey_rollups
 
 
 class ObjectBuilderBase:
@@ -16,6 +32,59 @@ class ObjectBuilderBase:
         else:
             return None
 
+    def _get_summary_dependency_ids(self):
+        """
+        :return: ids of the users/appointments whose appointment summaries depend on the object
+        """
+        return []
+
+    def _mark_changed(self):
+        # the cached appointment summaries that depend on the object are invalidated on commit, and the change of
+        # the object is logged (see solution.change_log)
+        summary_cache.mark_changed(self._db_session, *self._get_summary_dependency_ids())
+        change_log.record_change(self._db_session, self._object)
+
+    def _expire_relationship(self, name):
+        # child rows are written outside of the ORM, a loaded collection is reloaded when accessed next
+        # (a pending object has nothing loaded yet)
+        if sa.inspect(self._object).persistent:
+            self._db_session.expire(self._object, [name])
+
+    def _get_stored_collection(self, name):
+        # a new object has no stored child rows
+        if sa.inspect(self._object).pending:
+            return []
+
+        return list(getattr(self._object, name))
+
+    def _reconcile_rows(self, model, row_objs, rows, add_row=None):
+        """
+        Reconcile stored child rows with the given ones, position by position: unchanged rows are left alone,
+        changed rows are updated in place and only the surplus rows are inserted or deleted
+        :param model: mapped class of the child rows
+        :param row_objs: stored child rows (in order)
+        :param rows: list of dicts with the column values of the child rows
+        :param add_row: function that queues a new child row, takes a dict of column values (if not given, the
+                        caller adds the surplus rows)
+        :return: True if rows were inserted or deleted
+        """
+        for row_obj, row in zip(row_objs, rows):
+            changed_values = {key: value for key, value in row.items() if getattr(row_obj, key) != value}
+            if changed_values:
+                batching.update_row(self._db_session, model, row_obj.id, **changed_values)
+                for key, value in changed_values.items():
+                    orm.attributes.set_committed_value(row_obj, key, value)
+
+        if add_row:
+            for row in rows[len(row_objs):]:
+                add_row(row)
+
+        surplus_row_objs = row_objs[len(rows):]
+        if surplus_row_objs:
+            batching.delete_rows(self._db_session, model, [row_obj.id for row_obj in surplus_row_objs])
+
+        return len(row_objs) != len(rows)
+
     @property
     def object(self):
         """
@@ -39,60 +108,166 @@ class UserObjectBuilder(ObjectBuilderBase):
             self._object = db_session.query(models.User).filter_by(id=object_id).first()
 
         if not self._object:
+            # assign the id up front, so child rows can be queued without flushing the new object
             self._object = models.User(
-                id=object_id,
+                id=object_id or models.new_object_id(),
             )
             db_session.add(self._object)
-            db_session.flush()
+
+    def _get_summary_dependency_ids(self):
+        return [self._object.id]
 
     def set_user_type(self, user_type):
+        self._mark_changed()
         self._object.user_type = user_type
 
     def set_is_active(self, is_active):
+        self._mark_changed()
         self._object.is_active = is_active
 
     def set_birth_date(self, date):
+        self._mark_changed()
         self._object.birth_date = date
 
     def set_gender(self, gender):
+        self._mark_changed()
         self._object.gender = gender
 
     def clear_names(self):
-        for name in self._db_session.query(models.UserName).filter_by(user_id=self._object.id):
-            self._db_session.query(models.UserGivenName).filter_by(user_name_id=name.id).delete()
+        self._mark_changed()
+        search.mark_changed(self._db_session, search.USER_NAMES, self._object)
+        user_name_ids = sa.select(models.UserName.id).where(models.UserName.user_id == self._object.id)
+        self._db_session.query(models.UserGivenName).filter(
+            models.UserGivenName.user_name_id.in_(user_name_ids.scalar_subquery())).delete(synchronize_session=False)
         self._db_session.query(models.UserName).filter_by(user_id=self._object.id).delete()
-        self._db_session.flush()
+        patient_lookup.delete_tokens(self._db_session, self._object.id, LookupTokenKind.name)
+        self._expire_relationship('names')
+
+    def set_names(self, names):
+        """
+        Reconcile the stored names with the given ones (see _reconcile_rows)
+        :param names: list of dicts with the family_name, name_text and given_names (list) of each name
+        """
+        self._mark_changed()
+        name_objs = self._get_stored_collection('names')
+        # (the full-text index only holds the names, not the given names)
+        if ([(name_obj.family_name, name_obj.name_text) for name_obj in name_objs] !=
+                [(name.get('family_name'), name.get('name_text')) for name in names]):
+            search.mark_changed(self._db_session, search.USER_NAMES, self._object)
+
+        # the lookup tokens of the stored names are written again if any of them changes (the added names write
+        # their own, see add_name)
+        stored_names = [
+            (name_obj.family_name, name_obj.name_text, [g.given_name for g in name_obj.given_names])
+            for name_obj in name_objs
+        ]
+        reconciled_names = [
+            (name.get('family_name'), name.get('name_text'), list(name.get('given_names', [])))
+            for name in names[:len(name_objs)]
+        ]
+        if stored_names != reconciled_names:
+            patient_lookup.delete_tokens(self._db_session, self._object.id, LookupTokenKind.name)
+            for family_name, name_text, given_names in reconciled_names:
+                patient_lookup.add_name_tokens(self._db_session, self._object.id, family_name, name_text, given_names)
+
+        for name_obj, name in zip(name_objs, names):
+            given_name_objs = list(name_obj.given_names)
+            if self._reconcile_rows(
+                    models.UserGivenName,
+                    given_name_objs,
+                    [dict(given_name=given_name) for given_name in name.get('given_names', [])],
+                    lambda row, user_name_id=name_obj.id: batching.add_row(
+                        self._db_session, models.UserGivenName, user_name_id=user_name_id, **row),
+            ):
+                self._db_session.expire(name_obj, ['given_names'])
+
+        surplus_name_objs = name_objs[len(names):]
+        batching.delete_rows(
+            self._db_session,
+            models.UserGivenName,
+            [given_name_obj.id for name_obj in surplus_name_objs for given_name_obj in name_obj.given_names],
+        )
+
+        if self._reconcile_rows(
+                models.UserName,
+                name_objs,
+                [dict(family_name=name.get('family_name'), name_text=name.get('name_text')) for name in names],
+        ):
+            self._expire_relationship('names')
+
+        for name in names[len(name_objs):]:
+            self.add_name(
+                family_name=name.get('family_name'),
+                name_text=name.get('name_text'),
+                given_names=name.get('given_names', []),
+            )
 
     def add_name(self, family_name, name_text, given_names):
-        user_name_obj = models.UserName(
+        self._mark_changed()
+        search.mark_changed(self._db_session, search.USER_NAMES, self._object)
+        # the name id is allocated up front, so the given names can be queued along with the name
+        user_name_id = batching.allocate_ids(self._db_session, models.UserName, 1)[0]
+        batching.add_row(
+            self._db_session,
+            models.UserName,
+            id=user_name_id,
             user_id=self._object.id,
             family_name=family_name,
             name_text=name_text,
         )
-        self._db_session.add(user_name_obj)
-        self._db_session.flush()
 
         for given_name in given_names:
-            given_name_obj = models.UserGivenName(
-                user_name_id=user_name_obj.id,
+            batching.add_row(
+                self._db_session,
+                models.UserGivenName,
+                user_name_id=user_name_id,
                 given_name=given_name,
             )
-            self._db_session.add(given_name_obj)
-        self._db_session.flush()
+
+        patient_lookup.add_name_tokens(self._db_session, self._object.id, family_name, name_text, given_names)
+        self._expire_relationship('names')
 
     def clear_contact_info(self):
+        self._mark_changed()
         self._db_session.query(models.UserContactInfo).filter_by(user_id=self._object.id).delete()
-        self._db_session.flush()
+        patient_lookup.delete_tokens(self._db_session, self._object.id, LookupTokenKind.contact)
+        self._expire_relationship('contact_info')
+
+    def set_contact_info(self, contact_infos):
+        """
+        Reconcile the stored contact info with the given one (see _reconcile_rows)
+        :param contact_infos: list of dicts with the system, name and value of each contact info
+        """
+        self._mark_changed()
+        contact_info_objs = self._get_stored_collection('contact_info')
+
+        # (see set_names)
+        reconciled_values = [c.get('value') for c in contact_infos[:len(contact_info_objs)]]
+        if [c.value for c in contact_info_objs] != reconciled_values:
+            patient_lookup.delete_tokens(self._db_session, self._object.id, LookupTokenKind.contact)
+            for value in reconciled_values:
+                patient_lookup.add_contact_token(self._db_session, self._object.id, value)
+
+        if self._reconcile_rows(
+                models.UserContactInfo,
+                contact_info_objs,
+                [dict(system=c.get('system'), name=c.get('name'), value=c.get('value')) for c in contact_infos],
+                lambda row: self.add_contact_info(**row),
+        ):
+            self._expire_relationship('contact_info')
 
     def add_contact_info(self, system, name, value):
-        contact_info_obj = models.UserContactInfo(
+        self._mark_changed()
+        batching.add_row(
+            self._db_session,
+            models.UserContactInfo,
             user_id=self._object.id,
             system=system,
             name=name,
             value=value,
         )
-        self._db_session.add(contact_info_obj)
-        self._db_session.flush()
+        patient_lookup.add_contact_token(self._db_session, self._object.id, value)
+        self._expire_relationship('contact_info')
 
 
 class AppointmentObjectBuilder(ObjectBuilderBase):
@@ -104,36 +279,71 @@ class AppointmentObjectBuilder(ObjectBuilderBase):
 
         if not self._object:
             self._object = models.Appointment(
-                id=object_id,
+                id=object_id or models.new_object_id(),
                 start_time_ts=int(time.time()),
             )
             db_session.add(self._object)
-            db_session.flush()
+
+    def _get_summary_dependency_ids(self):
+        return [self._object.id, self._object.subject_id]
 
     def set_doctor_id(self, doctor_id):
+        self._mark_changed()
+        if doctor_id != self._object.actor_id:
+            # (the surveys of the appointment move to the rollups of the doctor)
+            survey_rollups.mark_appointment_changed(self._db_session, self._object)
         self._object.actor_id = doctor_id
 
     def set_patient_id(self, patient_id):
+        self._mark_changed()
         self._object.subject_id = patient_id
+        self._mark_changed()
 
     def set_appointment_time(self, start_time_ts, duration_secs):
+        self._mark_changed()
+        if survey_rollups.get_bucket_ts(start_time_ts) != survey_rollups.get_bucket_ts(self._object.start_time_ts):
+            survey_rollups.mark_appointment_changed(self._db_session, self._object)
         self._object.start_time_ts = start_time_ts
         self._object.duration_secs = duration_secs
 
     def set_status(self, status):
+        self._mark_changed()
         self._object.status = status
 
     def clear_reasons(self):
+        self._mark_changed()
+        search.mark_changed(self._db_session, search.APPOINTMENT_REASONS, self._object)
         self._db_session.query(models.AppointmentReason).filter_by(appointment_id=self._object.id).delete()
-        self._db_session.flush()
+        self._expire_relationship('reasons')
+
+    def set_reasons(self, reason_texts):
+        """
+        Reconcile the stored reasons with the given ones (see _reconcile_rows)
+        :param reason_texts: list of reason texts
+        """
+        self._mark_changed()
+        reason_objs = self._get_stored_collection('reasons')
+        if [reason_obj.reason_text for reason_obj in reason_objs] != list(reason_texts):
+            search.mark_changed(self._db_session, search.APPOINTMENT_REASONS, self._object)
+
+        if self._reconcile_rows(
+                models.AppointmentReason,
+                reason_objs,
+                [dict(reason_text=reason_text) for reason_text in reason_texts],
+                lambda row: self.add_reason(**row),
+        ):
+            self._expire_relationship('reasons')
 
     def add_reason(self, reason_text):
-        reason_obj = models.AppointmentReason(
+        self._mark_changed()
+        search.mark_changed(self._db_session, search.APPOINTMENT_REASONS, self._object)
+        batching.add_row(
+            self._db_session,
+            models.AppointmentReason,
             appointment_id=self._object.id,
-            reason_text=reason_text
+            reason_text=reason_text,
         )
-        self._db_session.add(reason_obj)
-        self._db_session.flush()
+        self._expire_relationship('reasons')
 
 
 class DiagnosisObjectBuilder(ObjectBuilderBase):
@@ -145,41 +355,63 @@ class DiagnosisObjectBuilder(ObjectBuilderBase):
 
         if not self._object:
             self._object = models.Diagnosis(
-                id=object_id,
+                id=object_id or models.new_object_id(),
             )
             db_session.add(self._object)
-            db_session.flush()
+
+    def _get_summary_dependency_ids(self):
+        return [self._object.appointment_id]
 
     def set_appointment_id(self, appointment_id):
+        self._mark_changed()
         self._object.appointment_id = appointment_id
+        self._mark_changed()
 
     def set_status(self, diagnosis_status):
+        self._mark_changed()
         self._object.status = diagnosis_status
 
     def set_last_updated_ts(self, ts):
+        self._mark_changed()
         self._object.last_updated_ts = ts
 
     def clear_details(self):
+        self._mark_changed()
         self._db_session.query(models.DiagnosisDetail).filter_by(diagnosis_id=self._object.id).delete()
-        self._db_session.flush()
+        self._expire_relationship('details')
 
-    def add_detail(self, code, name, system):
-        code_obj = self._db_session.query(models.DiagnosisCode).filter_by(code=code).first()
-        if not code_obj:
-            code_obj = models.DiagnosisCode(
-                code=code,
-                name=name,
-                system=system,
-            )
-            self._db_session.add(code_obj)
-            self._db_session.flush()
+    def set_details(self, details):
+        """
+        Reconcile the stored details with the given ones, by code (see _reconcile_rows)
+        :param details: list of dicts with the code, name and system of each detail
+        """
+        self._mark_changed()
+        detail_objs = self._get_stored_collection('details')
+
+        for detail_obj, detail in zip(detail_objs, details):
+            if detail_obj.code.code != detail.get('code'):
+                row = batching.update_row(self._db_session, models.DiagnosisDetail, detail_obj.id)
+                code_cache.set_diagnosis_code_id(self._db_session, row, **detail)
+                self._db_session.expire(detail_obj, ['diagnosis_code_id', 'code'])
+
+        for detail in details[len(detail_objs):]:
+            self.add_detail(**detail)
+
+        surplus_detail_objs = detail_objs[len(details):]
+        if surplus_detail_objs:
+            batching.delete_rows(self._db_session, models.DiagnosisDetail, [d.id for d in surplus_detail_objs])
+            self._expire_relationship('details')
 
-        detail_obj = models.DiagnosisDetail(
+    def add_detail(self, code, name, system):
+        self._mark_changed()
+        code_cache.queue_diagnosis_detail(
+            self._db_session,
             diagnosis_id=self._object.id,
-            diagnosis_code_id=code_obj.id,
+            code=code,
+            name=name,
+            system=system,
         )
-        self._db_session.add(detail_obj)
-        self._db_session.flush()
+        self._expire_relationship('details')
 
 
 class PostAppointmentSurveyObjectBuilder(ObjectBuilderBase):
@@ -191,25 +423,44 @@ class PostAppointmentSurveyObjectBuilder(ObjectBuilderBase):
 
         if not self._object:
             self._object = models.PostAppointmentSurvey(
-                id=object_id,
+                id=object_id or models.new_object_id(),
             )
             db_session.add(self._object)
-            db_session.flush()
+            # a new survey is indexed when the transaction commits, even if it is written before its texts are set
+            search.mark_changed(db_session, search.SURVEY_FEEDBACK, self._object)
+            survey_rollups.mark_survey_changed(db_session, self._object)
+
+    def _get_summary_dependency_ids(self):
+        return [self._object.appointment_id]
 
     def set_appointment_id(self, appointment_id):
+        self._mark_changed()
+        survey_rollups.mark_survey_changed(self._db_session, self._object)
         self._object.appointment_id = appointment_id
+        self._mark_changed()
 
     def set_recommendation_rating(self, rating):
+        self._mark_changed()
+        survey_rollups.mark_survey_changed(self._db_session, self._object)
         self._object.recommendation_rating = rating
 
     def set_diagnosis_feedback(self, feedback_text, is_diagnosis_explained):
+        self._mark_changed()
+        search.mark_changed(self._db_session, search.SURVEY_FEEDBACK, self._object)
+        survey_rollups.mark_survey_changed(self._db_session, self._object)
         self._object.diagnosis_feedback = feedback_text
         self._object.is_diagnosis_explained = is_diagnosis_explained
 
     def set_patient_feeling(self, feeling_text):
+        self._mark_changed()
+        search.mark_changed(self._db_session, search.SURVEY_FEEDBACK, self._object)
         self._object.patient_feeling = feeling_text
 
 
+# number of appointments per page of PatientController.get_appointment_history
+DEFAULT_HISTORY_PAGE_SIZE = 20
+
+
 class PatientController:
     """
     A calls that represents a user (patient or doctor) in the Tendo SW system and
@@ -224,9 +475,46 @@ class PatientController:
 
         self._db_session = db_session
         self._user_id = user_id
-        self._user = db_session.query(models.User).filter_by(id=self._user_id).one()
+        # (no query if the user is loaded in the session already)
+        self._user = db_session.get(models.User, self._user_id)
+        if self._user is None:
+            raise orm.exc.NoResultFound(f'no user with id {self._user_id}')
+
+    @classmethod
+    @contextmanager
+    def sharded(cls, sharded_db, user_id):
+        """
+        Controller of a patient of a sharded database, bound to a session of the patient's shard (committed when the
+        block exits, see solution.database.session_scope)
+        :param sharded_db: solution.sharding.ShardedDatabase object
+        """
+        with sharded_db.session_scope(user_id) as db_session:
+            yield cls(db_session, user_id)
+
+    @property
+    def db_session(self):
+        return self._db_session
+
+    @staticmethod
+    @instrumentation.instrumented(instrumentation.SERIALIZE)
+    def _appointment_summary(db_session, appt_obj, patient_obj, doctor_obj, diagnosis_obj, survey_obj):
+        return dict(
+            appointment=appt_obj.to_dict(db_session),
+            patient=patient_obj.to_dict(db_session),
+            doctor=doctor_obj.to_dict(db_session) if doctor_obj else None,
+            diagnosis=diagnosis_obj.to_dict(db_session) if diagnosis_obj else None,
+            survey=survey_obj.to_dict(db_session) if survey_obj else None,
+        )
 
+    @instrumentation.instrumented(instrumentation.APPOINTMENT_SUMMARY)
     def get_most_recent_appointment_summary(self):
+        """
+        Get the summary of the patient's most recent appointment, from the summary cache if it is enabled (see
+        solution.summary_cache)
+        """
+        return summary_cache.get_summary(self._db_session, self._user.id, self._load_most_recent_appointment_summary)
+
+    def _load_most_recent_appointment_summary(self):
         appt_obj = self._db_session.query(models.Appointment).filter_by(subject_id=self._user.id).order_by(
             models.Appointment.start_time_ts.desc()).limit(1).first()
         if not appt_obj:
@@ -236,10 +524,250 @@ class PatientController:
         diagnosis_obj = self._db_session.query(models.Diagnosis).filter_by(appointment_id=appt_obj.id).first()
         survey_obj = self._db_session.query(models.PostAppointmentSurvey).filter_by(appointment_id=appt_obj.id).first()
 
-        return dict(
-            appointment=appt_obj.to_dict(self._db_session),
-            patient=self._user.to_dict(self._db_session),
-            doctor=doctor_obj.to_dict(self._db_session) if doctor_obj else None,
-            diagnosis=diagnosis_obj.to_dict(self._db_session) if diagnosis_obj else None,
-            survey=survey_obj.to_dict(self._db_session) if survey_obj else None,
-        )
+        return self._appointment_summary(self._db_session, appt_obj, self._user, doctor_obj, diagnosis_obj, survey_obj)
+
+    @staticmethod
+    def _encode_history_cursor(appt):
+        return f'{appt["start_time_ts"]}:{appt["id"]}'
+
+    @staticmethod
+    def _decode_history_cursor(cursor):
+        start_time_ts, _, appt_id = cursor.partition(':')
+        try:
+            return int(start_time_ts), str(uuid.UUID(appt_id))
+        except ValueError:
+            raise ValueError(f'invalid appointment history cursor {cursor!r}') from None
+
+    def get_appointment_history(self, cursor=None, limit=DEFAULT_HISTORY_PAGE_SIZE, statuses=None,
+                                diagnosis_code=None):
+        """
+        Get a page of the patient's appointments, most recent first. The pages are keyset-paginated over
+        (start_time_ts, id), so a page is a range scan of the (patient, start time) index that starts where the
+        previous page ended, whatever its position in the history, and the reasons, diagnoses and surveys of the
+        page are loaded in bulk (a fixed number of queries per page)
+        :param cursor: next_cursor of the previous page, None for the first page
+        :param limit: max number of appointments per page
+        :param statuses: list of AppointmentStatus values the appointments must have, None for any
+        :param diagnosis_code: diagnosis code (e.g. 'I10') a diagnosis of the appointments must have, None for any
+        :return: dict: appointments (list of appointments, see DBObjectBase.to_dict, with their diagnoses and
+                 surveys) and next_cursor (None on the last page)
+        """
+        select_stmt = serializers.get_serializer(models.Appointment).select().where(
+            models.Appointment.subject_id == self._user.id,
+        ).order_by(models.Appointment.start_time_ts.desc(), models.Appointment.id.desc()).limit(limit + 1)
+        if cursor:
+            select_stmt = select_stmt.where(sa.tuple_(models.Appointment.start_time_ts, models.Appointment.id) <
+                                            self._decode_history_cursor(cursor))
+        if statuses:
+            select_stmt = select_stmt.where(models.Appointment.status.in_(statuses))
+        if diagnosis_code:
+            # checked per appointment (by the appointment's diagnoses), rather than from the rows with the code
+            code_id = sa.select(models.DiagnosisCode.id).where(
+                models.DiagnosisCode.code == diagnosis_code).scalar_subquery()
+            select_stmt = select_stmt.where(sa.exists().where(
+                models.Diagnosis.appointment_id == models.Appointment.id,
+                sa.exists().where(
+                    models.DiagnosisDetail.diagnosis_id == models.Diagnosis.id,
+                    models.DiagnosisDetail.diagnosis_code_id == code_id,
+                ),
+            ))
+
+        appts = serializers.serialize_rows(self._db_session, models.Appointment, self._db_session.execute(select_stmt))
+        next_cursor = self._encode_history_cursor(appts[limit - 1]) if len(appts) > limit else None
+        appts = appts[:limit]
+
+        appt_ids = [appt['id'] for appt in appts]
+        diagnoses = {}
+        surveys = {}
+        if appt_ids:
+            for diagnosis in serializers.serialize_rows(self._db_session, models.Diagnosis, self._db_session.execute(
+                    serializers.get_serializer(models.Diagnosis).select().where(
+                        models.Diagnosis.appointment_id.in_(appt_ids)).order_by(models.Diagnosis.last_updated_ts))):
+                diagnoses.setdefault(diagnosis['appointment_id'], []).append(diagnosis)
+
+            for survey in serializers.serialize_rows(
+                    self._db_session, models.PostAppointmentSurvey, self._db_session.execute(
+                        serializers.get_serializer(models.PostAppointmentSurvey).select().where(
+                            models.PostAppointmentSurvey.appointment_id.in_(appt_ids)))):
+                surveys.setdefault(survey['appointment_id'], []).append(survey)
+
+        for appt in appts:
+            appt['diagnoses'] = diagnoses.get(appt['id'], [])
+            appt['surveys'] = surveys.get(appt['id'], [])
+
+        return dict(appointments=appts, next_cursor=next_cursor)
+
+    @staticmethod
+    @instrumentation.instrumented(instrumentation.APPOINTMENT_SUMMARY)
+    def _load_summary_objects(db_session, user_ids):
+        """
+        :return: tuple of dicts: patient id -> most recent appointment, user id -> patient/doctor, appointment id ->
+                 diagnosis and appointment id -> survey
+        """
+        # rank the appointments of each patient, most recent first
+        ranked_appts = sa.select(
+            models.Appointment.id,
+            sa.func.row_number().over(
+                partition_by=models.Appointment.subject_id,
+                order_by=models.Appointment.start_time_ts.desc(),
+            ).label('rank'),
+        ).where(models.Appointment.subject_id.in_(user_ids)).subquery()
+
+        appt_objs = {
+            appt_obj.subject_id: appt_obj
+            for appt_obj in db_session.query(models.Appointment).join(
+                ranked_appts, ranked_appts.c.id == models.Appointment.id).filter(ranked_appts.c.rank == 1)
+        }
+
+        user_ids_to_load = set(user_ids)
+        user_ids_to_load.update(appt_obj.actor_id for appt_obj in appt_objs.values() if appt_obj.actor_id)
+        user_objs = {
+            user_obj.id: user_obj
+            for user_obj in db_session.query(models.User).filter(models.User.id.in_(user_ids_to_load))
+        }
+
+        appt_ids = [appt_obj.id for appt_obj in appt_objs.values()]
+        diagnosis_objs = {}
+        for diagnosis_obj in db_session.query(models.Diagnosis).filter(
+                models.Diagnosis.appointment_id.in_(appt_ids)):
+            diagnosis_objs.setdefault(diagnosis_obj.appointment_id, diagnosis_obj)
+
+        survey_objs = {}
+        for survey_obj in db_session.query(models.PostAppointmentSurvey).filter(
+                models.PostAppointmentSurvey.appointment_id.in_(appt_ids)):
+            survey_objs.setdefault(survey_obj.appointment_id, survey_obj)
+
+        return appt_objs, user_objs, diagnosis_objs, survey_objs
+
+    @classmethod
+    def iter_most_recent_appointment_summaries(cls, db_session, user_ids, batch_size=500):
+        """
+        Get the most recent appointment summary of many patients; each batch of patients is loaded with a
+        handful of (set-based) queries, regardless of the batch size
+        :param db_session: a connection to a database
+        :param user_ids: ids of the patients
+        :param batch_size: number of patients loaded at a time (bound by the max number of query parameters)
+        :return: generator of (user id, appointment summary) tuples, in the order of user_ids; the summary is None
+                 for unknown patients and patients without appointments
+        """
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), batch_size):
+            batch_user_ids = user_ids[i:i + batch_size]
+            appt_objs, user_objs, diagnosis_objs, survey_objs = cls._load_summary_objects(db_session, batch_user_ids)
+
+            for user_id in batch_user_ids:
+                patient_obj = user_objs.get(user_id)
+                appt_obj = appt_objs.get(user_id)
+                if not patient_obj or not appt_obj:
+                    yield user_id, None
+                    continue
+
+                yield user_id, cls._appointment_summary(
+                    db_session,
+                    appt_obj,
+                    patient_obj,
+                    user_objs.get(appt_obj.actor_id),
+                    diagnosis_objs.get(appt_obj.id),
+                    survey_objs.get(appt_obj.id),
+                )
+
+    @classmethod
+    def find_patients(cls, db_session, name=None, birth_date=None, contact=None, limit=patient_lookup.DEFAULT_LIMIT):
+        """
+        Look patients up by partial name, birth date and/or contact value (see solution.patient_lookup)
+        :param name: words the names of the patient start with, e.g. 'tend tend' (case and accent insensitive)
+        :param birth_date: datetime.date or 'YYYY-MM-DD' string
+        :param contact: phone number or email (phone numbers match by their digits)
+        :param limit: max number of patients
+        :return: list of patients (see DBObjectBase.to_dict)
+        """
+        user_ids = patient_lookup.find_user_ids(db_session, name, birth_date, contact, limit=limit)
+        users = serializers.serialize_ids(db_session, models.User, user_ids)
+
+        return [users[user_id] for user_id in user_ids if user_id in users]
+
+    @classmethod
+    def iter_sharded_most_recent_appointment_summaries(cls, sharded_db, user_ids, batch_size=500):
+        """
+        Same as iter_most_recent_appointment_summaries, for the patients of a sharded database: every batch of
+        patients is split by shard and each part is loaded from its shard
+        :param sharded_db: solution.sharding.ShardedDatabase object
+        :return: generator of (user id, appointment summary) tuples, in the order of user_ids
+        """
+        user_ids = list(user_ids)
+        for i in range(0, len(user_ids), batch_size):
+            batch_user_ids = user_ids[i:i + batch_size]
+            summaries = {}
+            for shard_index, shard_user_ids in sharded_db.group_by_shard(batch_user_ids).items():
+                with database.session_scope(sharded_db.shard_session_makers[shard_index]) as db_session:
+                    summaries.update(cls.iter_most_recent_appointment_summaries(db_session, shard_user_ids))
+
+            for user_id in batch_user_ids:
+                yield user_id, summaries[user_id]
+
+
+class DoctorScheduleController:
+    """
+    Schedule of a doctor: appointments in a time range, conflicts of an appointment being booked and free slots
+    (see solution.schedule, every query is an index range scan bound by the length of the time range)
+    """
+
+    def __init__(self, db_session, doctor_id):
+        """
+        :param doctor_id: unique id/key of the doctor
+        :param db_session: a connection to a database
+        """
+        self._db_session = db_session
+        self._doctor_id = doctor_id
+        # (no query if the doctor is loaded in the session already)
+        if db_session.get(models.User, doctor_id) is None:
+            raise orm.exc.NoResultFound(f'no user with id {doctor_id}')
+
+    def get_appointments(self, start_ts, end_ts):
+        """
+        Get the doctor's appointments that overlap a time range
+        :param start_ts: start of the time range (timestamp)
+        :param end_ts: end of the time range (excluded)
+        :return: list of appointments (see DBObjectBase.to_dict), ordered by start time
+        """
+        select_stmt = serializers.get_serializer(models.Appointment).select().where(
+            schedule.overlaps([self._doctor_id], start_ts, end_ts, schedule.get_max_duration_secs(self._db_session)),
+        ).order_by(models.Appointment.start_time_ts)
+
+        return serializers.serialize_rows(self._db_session, models.Appointment, self._db_session.execute(select_stmt))
+
+    def find_conflicts(self, start_ts, duration_secs, appointment_id=None):
+        """
+        Find the doctor's appointments that overlap an appointment being booked
+        :param appointment_id: id of the appointment being booked, if it is rescheduled (it doesn't conflict with
+                               itself)
+        :return: list of the ids of the conflicting appointments, ordered by start time
+        """
+        busy_intervals = schedule.get_busy_intervals(
+            self._db_session, [self._doctor_id], start_ts, start_ts + duration_secs, appointment_id)
+
+        return [appt_id for _, _, appt_id in busy_intervals.get(self._doctor_id, ())]
+
+    def is_available(self, start_ts, duration_secs, appointment_id=None):
+        return not self.find_conflicts(start_ts, duration_secs, appointment_id)
+
+    def find_free_slots(self, start_ts, end_ts, duration_secs):
+        """
+        Find the gaps of at least duration_secs between the doctor's appointments, within a time range
+        :return: list of (start ts, end ts) tuples
+        """
+        return self.find_doctors_free_slots(self._db_session, [self._doctor_id], start_ts, end_ts, duration_secs)[
+            self._doctor_id]
+
+    @classmethod
+    def find_doctors_free_slots(cls, db_session, doctor_ids, start_ts, end_ts, duration_secs):
+        """
+        Find the free slots of many doctors, with one query per chunk of doctors
+        :return: dict of doctor id -> list of (start ts, end ts) tuples (see find_free_slots), for every given doctor
+        """
+        busy_intervals = schedule.get_busy_intervals(db_session, doctor_ids, start_ts, end_ts)
+
+        return {
+            doctor_id: schedule.get_free_slots(busy_intervals.get(doctor_id, ()), start_ts, end_ts, duration_secs)
+            for doctor_id in doctor_ids
+        }
@@ -1,10 +1,101 @@
+import sqlalchemy as sa
 import sqlalchemy.orm as orm
+import sqlalchemy.pool as pool
+from sqlalchemy import event
 from contextlib import contextmanager
 
 
 Base = orm.declarative_base()
 
 
+# engine performance profiles, the SQLite settings are applied (as PRAGMAs) to every new connection:
+# - journal_mode: 'WAL' lets readers and the (single) writer work concurrently
+# - synchronous: fsync level, 'NORMAL' is durable in WAL mode except for the last transactions on power loss
+# - cache_size: page cache per connection (negative values are KiB), mmap_size: bytes of the file memory mapped
+# - temp_store: where temporary tables/indexes (sorting, DISTINCT, ...) live
+# - busy_timeout: ms to wait for a lock before failing with "database is locked"
+# - foreign_keys: enforce foreign key constraints (SQLite does not by default)
+# - begin: transaction mode, 'IMMEDIATE' takes the write lock up front (a writer never fails to upgrade its lock)
+# - pool_size/max_overflow: connections kept open (file databases are not pooled by default)
+ENGINE_PROFILES = {
+    'default': dict(),
+    'bulk_load': dict(
+        journal_mode='WAL',
+        synchronous='OFF',
+        cache_size=-512 * 1024,
+        mmap_size=1024 ** 3,
+        temp_store='MEMORY',
+        busy_timeout=60000,
+        foreign_keys=False,
+        begin='IMMEDIATE',
+        pool_size=1,
+        max_overflow=0,
+    ),
+    'serving': dict(
+        journal_mode='WAL',
+        synchronous='NORMAL',
+        cache_size=-64 * 1024,
+        mmap_size=256 * 1024 ** 2,
+        temp_store='MEMORY',
+        busy_timeout=5000,
+        foreign_keys=True,
+        pool_size=5,
+        max_overflow=10,
+    ),
+}
+
+_SQLITE_PRAGMAS = ('journal_mode', 'synchronous', 'cache_size', 'mmap_size', 'temp_store', 'busy_timeout')
+
+
+def create_engine(database_url, profile='default', **kwargs):
+    """
+    Create a connection to the database server, tuned by a performance profile
+    :param database_url: SqlAlchemy database URL
+    :param profile: name of a profile in ENGINE_PROFILES
+    :param kwargs: settings that override the ones of the profile, and sa.create_engine() arguments (e.g. echo)
+    :return: database engine
+    """
+    settings = dict(ENGINE_PROFILES[profile])
+    settings.update(kwargs)
+
+    pragmas = {name: settings.pop(name) for name in _SQLITE_PRAGMAS if name in settings}
+    foreign_keys = settings.pop('foreign_keys', None)
+    begin = settings.pop('begin', None)
+
+    url = sa.engine.make_url(database_url)
+    is_sqlite = url.get_backend_name() == 'sqlite'
+    is_memory_db = is_sqlite and url.database in (None, '', ':memory:')
+
+    if is_sqlite and not is_memory_db and 'pool_size' in settings:
+        settings.setdefault('poolclass', pool.QueuePool)
+    elif is_memory_db:
+        # an in-memory database lives in its (single) connection
+        settings.pop('pool_size', None)
+        settings.pop('max_overflow', None)
+
+    result = sa.create_engine(database_url, **settings)
+
+    if is_sqlite:
+        @event.listens_for(result, 'connect')
+        def _on_connect(dbapi_connection, connection_record):
+            # take over the transaction handling from pysqlite (which defers BEGIN to the first DML statement and
+            # breaks SAVEPOINTs), see the begin event below
+            dbapi_connection.isolation_level = None
+
+            cursor = dbapi_connection.cursor()
+            for name, value in pragmas.items():
+                cursor.execute(f'PRAGMA {name} = {value}')
+            if foreign_keys is not None:
+                cursor.execute(f'PRAGMA foreign_keys = {"ON" if foreign_keys else "OFF"}')
+            cursor.close()
+
+        @event.listens_for(result, 'begin')
+        def _on_begin(connection):
+            connection.exec_driver_sql(f'BEGIN {begin}' if begin else 'BEGIN')
+
+    return result
+
+
 def get_session_maker(db_engine):
     """
     Initialize the Database by creating the DB Schema and returning a DB Session maker/factory
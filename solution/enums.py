@@ -17,6 +17,11 @@ class ContactSystem(enum.Enum):
     address = 3
 
 
+class LookupTokenKind(enum.Enum):
+    name = 1
+    contact = 2
+
+
 class AppointmentStatus(enum.Enum):
     scheduled = 1
     in_progress = 2
@@ -0,0 +1,287 @@
+import json
+import time
+import functools
+import threading
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+
+
+# phases of the import and summary operations (instrumented in import_summary.py and solution/controllers.py);
+# the batched writes of an import are executed on commit, i.e. attributed to the import batch
+PARSE = 'parse'
+USER_UPSERT = 'user_upsert'
+APPOINTMENT = 'appointment'
+DIAGNOSIS = 'diagnosis'
+SERIALIZE = 'serialize'
+SURVEY_WRITE = 'survey_write'
+IMPORT_BATCH = 'import_batch'
+APPOINTMENT_SUMMARY = 'appointment_summary'
+
+# statements executed outside of any phase
+UNATTRIBUTED = 'unattributed'
+
+
+class _PhaseStats:
+    __slots__ = ('calls', 'secs', 'statements', 'statement_secs', 'rows_written', 'rows_loaded')
+
+    def __init__(self):
+        self.calls = 0
+        self.secs = 0.0
+        self.statements = 0
+        self.statement_secs = 0.0
+        self.rows_written = 0
+        self.rows_loaded = 0
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_PHASE = _NullPhase()
+
+
+class _Phase:
+    __slots__ = ('_instrumentation', '_name', '_start_time')
+
+    def __init__(self, instrumentation, name):
+        self._instrumentation = instrumentation
+        self._name = name
+        self._start_time = None
+
+    def __enter__(self):
+        self._instrumentation._get_phase_names().append(self._name)
+        self._start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        elapsed_secs = time.perf_counter() - self._start_time
+        self._instrumentation._get_phase_names().pop()
+
+        with self._instrumentation._lock:
+            stats = self._instrumentation._get_stats(self._name)
+            stats.calls += 1
+            stats.secs += elapsed_secs
+
+        return False
+
+
+class Instrumentation:
+    """
+    Per-phase counters of the SQL statements (count, time and rows) and of the time spent; a statement is
+    attributed to the innermost phase that is active (in the thread that executes it), the time of a phase includes
+    the time of its nested phases
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._db_engines = []
+
+    def _get_phase_names(self):
+        result = getattr(self._local, 'phase_names', None)
+        if result is None:
+            result = self._local.phase_names = []
+
+        return result
+
+    def _get_current_phase_name(self):
+        phase_names = self._get_phase_names()
+        return phase_names[-1] if phase_names else UNATTRIBUTED
+
+    def _get_stats(self, name):
+        result = self._stats.get(name)
+        if result is None:
+            result = self._stats[name] = _PhaseStats()
+
+        return result
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('instrumentation_start_times', []).append(time.perf_counter())
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters, context, executemany):
+        elapsed_secs = time.perf_counter() - conn.info['instrumentation_start_times'].pop()
+        if statement.startswith('BEGIN'):
+            return
+
+        # rowcount is -1 for SELECT statements
+        rows_written = max(cursor.rowcount, 0)
+        with self._lock:
+            stats = self._get_stats(self._get_current_phase_name())
+            stats.statements += 1
+            stats.statement_secs += elapsed_secs
+            stats.rows_written += rows_written
+
+    def _loaded_as_persistent(self, db_session, instance):
+        with self._lock:
+            self._get_stats(self._get_current_phase_name()).rows_loaded += 1
+
+    def attach(self, db_engine):
+        """
+        Count the statements executed by (the connections of) the engine
+        """
+        event.listen(db_engine, 'before_cursor_execute', self._before_cursor_execute)
+        event.listen(db_engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._db_engines.append(db_engine)
+
+    def detach(self):
+        for db_engine in self._db_engines:
+            event.remove(db_engine, 'before_cursor_execute', self._before_cursor_execute)
+            event.remove(db_engine, 'after_cursor_execute', self._after_cursor_execute)
+        self._db_engines = []
+
+    def phase(self, name):
+        return _Phase(self, name)
+
+    def add_phase_time(self, name, secs, calls=1):
+        """
+        Record calls of a phase that ran outside of this process (e.g. in the worker processes of a parallel import)
+        """
+        with self._lock:
+            stats = self._get_stats(name)
+            stats.calls += calls
+            stats.secs += secs
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def get_stats(self):
+        """
+        :return: dict of phase name -> dict of calls, secs, statements, statement_secs, rows_written and
+                 rows_loaded (ORM objects)
+        """
+        with self._lock:
+            return {name: stats.to_dict() for name, stats in sorted(self._stats.items())}
+
+
+# the active instrumentation, None when instrumentation is disabled
+_instrumentation = None
+
+
+def enable(*db_engines):
+    """
+    Enable the instrumentation (replacing the active one), and count the statements of the given engines
+    :return: Instrumentation object
+    """
+    global _instrumentation
+
+    disable()
+
+    result = Instrumentation()
+    for db_engine in db_engines:
+        result.attach(db_engine)
+    event.listen(orm.Session, 'loaded_as_persistent', result._loaded_as_persistent)
+
+    _instrumentation = result
+    return result
+
+
+def disable():
+    global _instrumentation
+
+    if _instrumentation:
+        _instrumentation.detach()
+        event.remove(orm.Session, 'loaded_as_persistent', _instrumentation._loaded_as_persistent)
+        _instrumentation = None
+
+
+def is_enabled():
+    return _instrumentation is not None
+
+
+def phase(name):
+    """
+    Context manager that attributes the statements executed in its block to the phase
+    (does nothing when the instrumentation is disabled)
+    """
+    if _instrumentation is None:
+        return _NULL_PHASE
+
+    return _instrumentation.phase(name)
+
+
+def add_phase_time(name, secs, calls=1):
+    """
+    Record calls of a phase that ran outside of this process (does nothing when the instrumentation is disabled)
+    """
+    if _instrumentation is not None:
+        _instrumentation.add_phase_time(name, secs, calls=calls)
+
+
+def instrumented(name):
+    """
+    Decorator that runs the function as a phase (see phase())
+    """
+    def _decorator(func):
+        @functools.wraps(func)
+        def _wrapper(*args, **kwargs):
+            if _instrumentation is None:
+                return func(*args, **kwargs)
+
+            with _instrumentation.phase(name):
+                return func(*args, **kwargs)
+
+        return _wrapper
+
+    return _decorator
+
+
+def get_stats():
+    return _instrumentation.get_stats() if _instrumentation else {}
+
+
+def reset():
+    if _instrumentation:
+        _instrumentation.reset()
+
+
+def to_json(stats=None):
+    return json.dumps(get_stats() if stats is None else stats, indent=4, sort_keys=True)
+
+
+# Prometheus metric name suffix, help text and type of the stats
+_PROMETHEUS_METRICS = [
+    ('calls', 'calls_total', 'Number of times the phase ran.', 'counter'),
+    ('secs', 'seconds_total', 'Time spent in the phase (including its nested phases).', 'counter'),
+    ('statements', 'statements_total', 'Number of SQL statements executed by the phase.', 'counter'),
+    ('statement_secs', 'statement_seconds_total', 'Time spent executing the SQL statements of the phase.',
+     'counter'),
+    ('rows_written', 'rows_written_total', 'Number of rows inserted, updated or deleted by the phase.', 'counter'),
+    ('rows_loaded', 'rows_loaded_total', 'Number of ORM objects loaded by the phase.', 'counter'),
+]
+
+
+def to_prometheus(stats=None, prefix='tendo_phase'):
+    """
+    :return: the stats in the Prometheus text exposition format
+    """
+    stats = get_stats() if stats is None else stats
+
+    lines = []
+    for key, suffix, help_text, metric_type in _PROMETHEUS_METRICS:
+        metric_name = f'{prefix}_{suffix}'
+        lines.append(f'# HELP {metric_name} {help_text}')
+        lines.append(f'# TYPE {metric_name} {metric_type}')
+        for name, phase_stats in stats.items():
+            lines.append(f'{metric_name}{{phase="{name}"}} {phase_stats[key]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_stats(file_path, stats=None):
+    """
+    Write the stats to a file, in the Prometheus text format if the file extension is .prom, as JSON otherwise
+    """
+    with open(file_path, 'w') as f:
+        if file_path.lower().endswith('.prom'):
+            f.write(to_prometheus(stats))
+        else:
+            f.write(to_json(stats) + '\n')
@@ -0,0 +1,292 @@
+import time
+import uuid
+import sqlalchemy as sa
+from solution.database import Base
+from solution.column_types import UUID
+import solution.models as models
+import solution.search as search
+import solution.patient_lookup as patient_lookup
+import solution.survey_rollups as survey_rollups
+from solution.enums import (
+    LookupTokenKind,
+)
+
+
+# number of rows converted per statement
+_BATCH_SIZE = 10000
+
+
+def _quote(connection, name):
+    return connection.dialect.identifier_preparer.quote(name)
+
+
+def _convert_uuid_keys(connection):
+    """
+    Convert the UUIDs stored as text (by the former String(36) id columns) to 16-byte values, in place
+    :return: number of converted rows
+    """
+    if connection.dialect.name != 'sqlite':
+        return 0
+
+    result = 0
+    for table in Base.metadata.sorted_tables:
+        column_names = [column.name for column in table.columns if isinstance(column.type, UUID)]
+        if not column_names:
+            continue
+
+        table_name = _quote(connection, table.name)
+        quoted_column_names = [_quote(connection, column_name) for column_name in column_names]
+        is_text_clause = ' OR '.join(f"typeof({c}) = 'text'" for c in quoted_column_names)
+        select_stmt = sa.text(
+            f'SELECT rowid, {", ".join(quoted_column_names)} FROM {table_name} '
+            f'WHERE {is_text_clause} LIMIT {_BATCH_SIZE}'
+        )
+
+        set_clause = ', '.join(f'{c} = :c{i}' for i, c in enumerate(quoted_column_names))
+        update_stmt = sa.text(f'UPDATE {table_name} SET {set_clause} WHERE rowid = :row_id')
+
+        while True:
+            rows = connection.execute(select_stmt).fetchall()
+            if not rows:
+                break
+
+            update_rows = []
+            for row in rows:
+                update_row = dict(row_id=row[0])
+                for i, value in enumerate(row[1:]):
+                    update_row[f'c{i}'] = uuid.UUID(value).bytes if isinstance(value, str) else value
+                update_rows.append(update_row)
+
+            connection.execute(update_stmt, update_rows)
+            result += len(rows)
+
+    return result
+
+
+def _add_appointment_end_time(connection):
+    """
+    Add the end time column of the appointments (start time + duration) to an existing Appointment table
+    :return: number of updated appointments
+    """
+    table = models.Appointment.__table__
+    if 'end_time_ts' in {column['name'] for column in sa.inspect(connection).get_columns(table.name)}:
+        return 0
+
+    connection.exec_driver_sql(
+        f'ALTER TABLE {_quote(connection, table.name)} ADD COLUMN end_time_ts INTEGER NOT NULL DEFAULT 0')
+    return connection.execute(table.update().values(end_time_ts=table.c.start_time_ts + table.c.duration_secs)).rowcount
+
+
+def _add_appointment_duration_class(connection):
+    """
+    Add the duration class column of the appointments (see models.get_duration_class) to an existing Appointment
+    table
+    :return: number of updated appointments
+    """
+    table = models.Appointment.__table__
+    if 'duration_class' in {column['name'] for column in sa.inspect(connection).get_columns(table.name)}:
+        return 0
+
+    connection.exec_driver_sql(
+        f'ALTER TABLE {_quote(connection, table.name)} ADD COLUMN duration_class INTEGER NOT NULL DEFAULT 0')
+    # (one update per distinct duration, there are few)
+    result = 0
+    durations = connection.execute(sa.select(table.c.duration_secs).distinct()).scalars().all()
+    for duration_secs in durations:
+        duration_class = models.get_duration_class(duration_secs)
+        if duration_class:
+            result += connection.execute(table.update().where(table.c.duration_secs == duration_secs).values(
+                duration_class=duration_class)).rowcount
+
+    return result
+
+
+def _add_survey_search_rowid(connection):
+    """
+    Add the search_rowid column of the surveys (see models.PostAppointmentSurvey) to an existing
+    PostAppointmentSurvey table, and recreate the full-text index of the surveys keyed by it (empty, indexed by the
+    search_indexes migration)
+    :return: number of updated surveys
+    """
+    table = models.PostAppointmentSurvey.__table__
+    if 'search_rowid' in {column['name'] for column in sa.inspect(connection).get_columns(table.name)}:
+        return 0
+
+    connection.exec_driver_sql(
+        f'ALTER TABLE {_quote(connection, table.name)} ADD COLUMN search_rowid INTEGER NOT NULL DEFAULT 0')
+    update_stmt = table.update().where(table.c.id == sa.bindparam('_id')).values(search_rowid=sa.bindparam('_rowid'))
+    result = 0
+    last_survey_id = None
+    while True:
+        select_stmt = sa.select(table.c.id).order_by(table.c.id).limit(_BATCH_SIZE)
+        if last_survey_id is not None:
+            select_stmt = select_stmt.where(table.c.id > last_survey_id)
+        survey_ids = connection.execute(select_stmt).scalars().all()
+        if not survey_ids:
+            break
+
+        connection.execute(update_stmt, [
+            dict(_id=survey_id, _rowid=result + i) for i, survey_id in enumerate(survey_ids, 1)])
+        result += len(survey_ids)
+        last_survey_id = survey_ids[-1]
+
+    connection.exec_driver_sql(f'DROP TABLE IF EXISTS {search.SURVEY_FEEDBACK.name}')
+    return result
+
+
+def _create_missing_indexes(connection):
+    """
+    Create the indexes of the DB Schema missing from the existing tables (create_all only creates the indexes of
+    new tables)
+    :return: number of created indexes
+    """
+    inspector = sa.inspect(connection)
+    result = 0
+    for table in Base.metadata.sorted_tables:
+        index_names = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in sorted(table.indexes, key=lambda i: i.name):
+            if index.name not in index_names:
+                index.create(connection)
+                result += 1
+
+    return result
+
+
+def _seed_change_log(connection):
+    """
+    Log every existing entity as changed (once, while the change log is empty), so a change feed consumer that
+    starts from cursor 0 gets the entities written before the change log existed
+    :return: number of logged entities
+    """
+    change_log_table = models.ChangeLog.__table__
+    if connection.execute(sa.select(change_log_table.c.seq).limit(1)).first():
+        return 0
+
+    changed_ts = int(time.time())
+    result = 0
+    for model in (models.User, models.Appointment, models.Diagnosis, models.PostAppointmentSurvey):
+        table = model.__table__
+        result += connection.execute(change_log_table.insert().from_select(
+            ['entity_type', 'entity_id', 'changed_ts'],
+            sa.select(sa.literal(model.__name__), table.c.id, sa.literal(changed_ts)).order_by(table.c.id),
+        )).rowcount
+
+    return result
+
+
+def _build_search_indexes(connection):
+    """
+    Index the rows written before the full-text indexes existed (see solution.search)
+    :return: number of indexed rows
+    """
+    return sum(search.rebuild_indexes(connection, only_empty=True).values())
+
+
+def _build_patient_lookup_tokens(connection):
+    """
+    Write the lookup tokens of the names and contact info of the existing users (once, while there are no tokens),
+    see solution.patient_lookup
+    :return: number of written tokens
+    """
+    token_table = models.PatientLookupToken.__table__
+    if connection.execute(sa.select(token_table.c.id).limit(1)).first():
+        return 0
+
+    name_table = models.UserName.__table__
+    given_name_table = models.UserGivenName.__table__
+    contact_info_table = models.UserContactInfo.__table__
+
+    result = 0
+    last_name_id = 0
+    while True:
+        name_rows = connection.execute(
+            sa.select(name_table.c.id, name_table.c.user_id, name_table.c.family_name, name_table.c.name_text)
+            .where(name_table.c.id > last_name_id).order_by(name_table.c.id).limit(_BATCH_SIZE)
+        ).all()
+        if not name_rows:
+            break
+
+        given_names = {}
+        for user_name_id, given_name in connection.execute(
+                sa.select(given_name_table.c.user_name_id, given_name_table.c.given_name)
+                .where(given_name_table.c.user_name_id.between(name_rows[0][0], name_rows[-1][0]))
+                .order_by(given_name_table.c.id)):
+            given_names.setdefault(user_name_id, []).append(given_name)
+
+        token_rows = [
+            dict(user_id=user_id, kind=LookupTokenKind.name, token=token)
+            for name_id, user_id, family_name, name_text in name_rows
+            for token in patient_lookup.get_name_tokens(family_name, name_text, *given_names.get(name_id, ()))
+        ]
+        if token_rows:
+            connection.execute(token_table.insert(), token_rows)
+        result += len(token_rows)
+        last_name_id = name_rows[-1][0]
+
+    last_contact_info_id = 0
+    while True:
+        contact_info_rows = connection.execute(
+            sa.select(contact_info_table.c.id, contact_info_table.c.user_id, contact_info_table.c.value)
+            .where(contact_info_table.c.id > last_contact_info_id).order_by(contact_info_table.c.id)
+            .limit(_BATCH_SIZE)
+        ).all()
+        if not contact_info_rows:
+            break
+
+        connection.execute(token_table.insert(), [
+            dict(user_id=user_id, kind=LookupTokenKind.contact, token=patient_lookup.get_contact_token(value))
+            for _, user_id, value in contact_info_rows
+        ])
+        result += len(contact_info_rows)
+        last_contact_info_id = contact_info_rows[-1][0]
+
+    return result
+
+
+def _build_survey_rollups(connection):
+    """
+    Roll up the surveys written before the rollups existed (once, while there are no rollups), see
+    solution.survey_rollups
+    :return: number of written rollups
+    """
+    return survey_rollups.rebuild_rollups(connection, only_empty=True)
+
+
+# ordered (name, migration) pairs; a migration detects whether the database needs it, so running it is idempotent
+MIGRATIONS = [
+    ('binary_uuid_keys', _convert_uuid_keys),
+    ('appointment_end_time', _add_appointment_end_time),
+    ('appointment_duration_class', _add_appointment_duration_class),
+    ('survey_search_rowid', _add_survey_search_rowid),
+    ('foreign_key_indexes', _create_missing_indexes),
+    ('change_log_seed', _seed_change_log),
+    ('search_indexes', _build_search_indexes),
+    ('patient_lookup_tokens', _build_patient_lookup_tokens),
+    ('survey_rollups', _build_survey_rollups),
+]
+
+
+def upgrade(db_engine, vacuum=False):
+    """
+    Bring an existing database up to date with the current DB Schema, creating the missing tables and running
+    the migrations
+    :param db_engine: connection to the database server
+    :param vacuum: reclaim the space freed by the migrations (SQLite only)
+    :return: list of (migration name, number of migrated rows) tuples
+    """
+    result = []
+    Base.metadata.create_all(db_engine)
+
+    with db_engine.connect() as connection:
+        if connection.dialect.name == 'sqlite':
+            # keys are rewritten in place, references are consistent again once the transaction commits
+            connection.exec_driver_sql('PRAGMA foreign_keys = OFF')
+
+        for name, migration in MIGRATIONS:
+            with connection.begin():
+                result.append((name, migration(connection)))
+
+        if vacuum and connection.dialect.name == 'sqlite':
+            connection.exec_driver_sql('VACUUM')
+
+    return result
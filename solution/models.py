@@ -1,63 +1,76 @@
 import time
 import uuid
-from datetime import datetime
 import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy import event
 from solution.enums import (
     UserType,
     Gender,
     ContactSystem,
+    LookupTokenKind,
     AppointmentStatus,
     DiagnosisStatus,
 )
 from solution.database import Base
+from solution.column_types import UUID
+
+
+# duration of an appointment whose time is not set
+DEFAULT_APPOINTMENT_DURATION_SECS = 1800
+
+# duration classes of the appointments: class k holds the durations up to 15 minutes * 4^k (see solution.schedule)
+DURATION_CLASS_BASE_SECS = 900
+DURATION_CLASS_FACTOR = 4
+
+
+def new_object_id():
+    return str(uuid.uuid1())
+
+
+def get_duration_class(duration_secs):
+    result = 0
+    max_duration_secs = DURATION_CLASS_BASE_SECS
+    while duration_secs > max_duration_secs:
+        max_duration_secs *= DURATION_CLASS_FACTOR
+        result += 1
+
+    return result
 
 
 def timestamp_to_utc_datetime_str(ts):
-    return datetime.utcfromtimestamp(ts).strftime('%Y-%m-%dT%H:%M:%SZ')
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(ts))
 
 
 class DBObjectBase:
+    def _flush_if_pending(self, db_session):
+        # a new object gets its column defaults (and can load its relationships) once it is written
+        if sa.inspect(self).pending:
+            db_session.flush()
+
     def to_dict(self, db_session):
-        return {c.key: getattr(self, c.key) for c in sa.inspect(self).mapper.column_attrs}
+        # (imported here, the serializers are compiled from the models)
+        from solution.serializers import serialize
+
+        self._flush_if_pending(db_session)
+        return serialize(self)
 
 
 class User(Base, DBObjectBase):
     __tablename__ = 'User'
 
-    # object id is an UUID, should consider using a datatype (UUID is a 16-byte data structure) for performance
-    id = sa.Column(sa.String(36), primary_key=True, default=lambda: str(uuid.uuid1()))
+    # object id is an UUID, stored as a 16-byte value (see UUID column type)
+    id = sa.Column(UUID, primary_key=True, default=new_object_id)
 
     user_type = sa.Column(sa.Enum(UserType), nullable=False, index=True, default=UserType.patient)
     is_active = sa.Column(sa.Boolean, nullable=False, default=True)
-    birth_date = sa.Column(sa.Date, nullable=True)
+    birth_date = sa.Column(sa.Date, nullable=True, index=True)
     gender = sa.Column(sa.Enum(Gender), nullable=True, index=True)
 
-    def to_dict(self, db_session):
-        user_names = []
-        for name_obj in db_session.query(UserName).filter_by(user_id=self.id):
-            for given_name_obj in db_session.query(UserGivenName).filter_by(user_name_id=name_obj.id):
-                user_names.append(dict(
-                    last_name=name_obj.family_name,
-                    first_name=given_name_obj.given_name,
-                    name_text=name_obj.name_text,
-                ))
-
-        user_contacts = []
-        for contact_info_obj in db_session.query(UserContactInfo).filter_by(user_id=self.id):
-            user_contacts.append(dict(
-                system=contact_info_obj.system,
-                name=contact_info_obj.name,
-                value=contact_info_obj.value,
-            ))
-
-        result = super().to_dict(db_session)
-        result.update(dict(
-            birth_date=self.birth_date.strftime('%Y-%m-%d') if self.birth_date else '',
-            names=user_names,
-            contact_info=user_contacts,
-        ))
-
-        return result
+    # child rows are written by the object builders (see solution.batching), the relationships are read-only and
+    # (selectin) loaded along with the user, so serializing a user takes a constant number of queries
+    names = orm.relationship('UserName', order_by='UserName.id', lazy='selectin', viewonly=True)
+    contact_info = orm.relationship('UserContactInfo', order_by='UserContactInfo.id', lazy='selectin',
+                                    viewonly=True)
 
 
 class UserName(Base, DBObjectBase):
@@ -65,17 +78,19 @@ class UserName(Base, DBObjectBase):
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
-    user_id = sa.Column(sa.String(36), sa.ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
+    user_id = sa.Column(UUID, sa.ForeignKey(User.id, ondelete='CASCADE'), nullable=False, index=True)
     family_name = sa.Column(sa.String, nullable=True)
     name_text = sa.Column(sa.String, nullable=True)
 
+    given_names = orm.relationship('UserGivenName', order_by='UserGivenName.id', lazy='selectin', viewonly=True)
+
 
 class UserGivenName(Base, DBObjectBase):
     __tablename__ = 'UserGivenName'
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
-    user_name_id = sa.Column(sa.Integer, sa.ForeignKey(UserName.id, ondelete='CASCADE'), nullable=False)
+    user_name_id = sa.Column(sa.Integer, sa.ForeignKey(UserName.id, ondelete='CASCADE'), nullable=False, index=True)
     given_name = sa.Column(sa.String, nullable=False)
 
 
@@ -84,36 +99,62 @@ class UserContactInfo(Base, DBObjectBase):
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
-    user_id = sa.Column(sa.String(36), sa.ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
+    user_id = sa.Column(UUID, sa.ForeignKey(User.id, ondelete='CASCADE'), nullable=False, index=True)
     system = sa.Column(sa.Enum(ContactSystem), nullable=False, index=True)
     name = sa.Column(sa.String, nullable=False)
     value = sa.Column(sa.String, nullable=False)
 
 
+class PatientLookupToken(Base, DBObjectBase):
+    __tablename__ = 'PatientLookupToken'
+    __table_args__ = (
+        # users by token prefix (range scan), and tokens of a user, see solution.patient_lookup
+        sa.Index('ix_PatientLookupToken_kind_token_user_id', 'kind', 'token', 'user_id'),
+        sa.Index('ix_PatientLookupToken_user_id_kind_token', 'user_id', 'kind', 'token'),
+    )
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+
+    # normalized name token or contact value of a user, written by the object builders
+    user_id = sa.Column(UUID, sa.ForeignKey(User.id, ondelete='CASCADE'), nullable=False)
+    kind = sa.Column(sa.Enum(LookupTokenKind), nullable=False)
+    token = sa.Column(sa.String, nullable=False)
+
+
 class Appointment(Base, DBObjectBase):
     __tablename__ = 'Appointment'
+    __table_args__ = (
+        # most recent appointments of a patient
+        sa.Index('ix_Appointment_subject_id_start_time_ts', 'subject_id', 'start_time_ts'),
+        # appointments of a doctor in a time range, per duration class (see solution.schedule)
+        sa.Index('ix_Appointment_actor_id_duration_class_start_time_ts', 'actor_id', 'duration_class', 'start_time_ts'),
+    )
 
-    id = sa.Column(sa.String(36), primary_key=True, default=lambda: str(uuid.uuid1()))
+    id = sa.Column(UUID, primary_key=True, default=new_object_id)
 
     start_time_ts = sa.Column(sa.Integer, nullable=False)
-    duration_secs = sa.Column(sa.Integer, nullable=False, default=1800)
+    # (the max duration bounds the duration classes to query, see solution.schedule)
+    duration_secs = sa.Column(sa.Integer, nullable=False, index=True, default=DEFAULT_APPOINTMENT_DURATION_SECS)
+    # start_time_ts + duration_secs and get_duration_class(duration_secs), derived when the appointment is written
+    # (see _derive_appointment_columns)
+    end_time_ts = sa.Column(sa.Integer, nullable=False)
+    duration_class = sa.Column(sa.Integer, nullable=False)
     status = sa.Column(sa.Enum(AppointmentStatus), nullable=False, default=AppointmentStatus.scheduled)
-    actor_id = sa.Column(sa.String(36), sa.ForeignKey(User.id, ondelete='SET NULL'), nullable=True)
-    subject_id = sa.Column(sa.String(36), sa.ForeignKey(User.id, ondelete='SET NULL'), nullable=True)
+    actor_id = sa.Column(UUID, sa.ForeignKey(User.id, ondelete='SET NULL'), nullable=True)
+    subject_id = sa.Column(UUID, sa.ForeignKey(User.id, ondelete='SET NULL'), nullable=True)
 
-    def to_dict(self, db_session):
-        reasons = []
-        for reason_obj in db_session.query(AppointmentReason).filter_by(appointment_id=self.id):
-            reasons.append(reason_obj.reason_text)
+    reasons = orm.relationship('AppointmentReason', order_by='AppointmentReason.id', lazy='selectin',
+                               viewonly=True)
 
-        result = super().to_dict(db_session)
-        result.update(dict(
-            start_time=timestamp_to_utc_datetime_str(self.start_time_ts),
-            end_time=timestamp_to_utc_datetime_str(self.start_time_ts + self.duration_secs),
-            reasons=reasons,
-        ))
 
-        return result
+@event.listens_for(Appointment, 'before_insert')
+@event.listens_for(Appointment, 'before_update')
+def _derive_appointment_columns(mapper, connection, appt_obj):
+    # (the duration column default is only applied by the insert statement)
+    if appt_obj.duration_secs is None:
+        appt_obj.duration_secs = DEFAULT_APPOINTMENT_DURATION_SECS
+    appt_obj.end_time_ts = appt_obj.start_time_ts + appt_obj.duration_secs
+    appt_obj.duration_class = get_duration_class(appt_obj.duration_secs)
 
 
 class AppointmentReason(Base, DBObjectBase):
@@ -121,35 +162,20 @@ class AppointmentReason(Base, DBObjectBase):
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
-    appointment_id = sa.Column(sa.String(36), sa.ForeignKey(Appointment.id, ondelete='CASCADE'), nullable=False)
+    appointment_id = sa.Column(UUID, sa.ForeignKey(Appointment.id, ondelete='CASCADE'), nullable=False, index=True)
     reason_text = sa.Column(sa.Text, nullable=False)
 
 
 class Diagnosis(Base, DBObjectBase):
     __tablename__ = 'Diagnosis'
 
-    id = sa.Column(sa.String(36), primary_key=True, default=lambda: str(uuid.uuid1()))
+    id = sa.Column(UUID, primary_key=True, default=new_object_id)
 
-    appointment_id = sa.Column(sa.String(36), sa.ForeignKey(Appointment.id, ondelete='SET NULL'), nullable=True)
+    appointment_id = sa.Column(UUID, sa.ForeignKey(Appointment.id, ondelete='SET NULL'), nullable=True, index=True)
     last_updated_ts = sa.Column(sa.Integer, nullable=False, default=lambda: int(time.time()))
     status = sa.Column(sa.Enum(DiagnosisStatus), nullable=False, default=DiagnosisStatus.thesis)
 
-    def to_dict(self, db_session):
-        db_session.flush()
-
-        diagnosis_codes = []
-        for detail_obj in db_session.query(DiagnosisDetail).filter_by(diagnosis_id=self.id):
-            code_obj = db_session.query(DiagnosisCode).filter_by(id=detail_obj.diagnosis_code_id).first()
-            if code_obj:
-                diagnosis_codes.append(code_obj.to_dict(db_session))
-
-        result = super().to_dict(db_session)
-        result.update(dict(
-            last_updated_time=timestamp_to_utc_datetime_str(self.last_updated_ts),
-            codes=diagnosis_codes,
-        ))
-
-        return result
+    details = orm.relationship('DiagnosisDetail', order_by='DiagnosisDetail.id', lazy='selectin', viewonly=True)
 
 
 class DiagnosisCode(Base, DBObjectBase):
@@ -164,20 +190,92 @@ class DiagnosisCode(Base, DBObjectBase):
 
 class DiagnosisDetail(Base, DBObjectBase):
     __tablename__ = 'DiagnosisDetail'
+    __table_args__ = (
+        # codes of a diagnosis, and whether a diagnosis has a code (see PatientController.get_appointment_history)
+        sa.Index('ix_DiagnosisDetail_diagnosis_id_diagnosis_code_id', 'diagnosis_id', 'diagnosis_code_id'),
+    )
 
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
 
-    diagnosis_id = sa.Column(sa.String(36), sa.ForeignKey(Diagnosis.id, ondelete='CASCADE'), nullable=False)
-    diagnosis_code_id = sa.Column(sa.Integer, sa.ForeignKey(DiagnosisCode.id, ondelete='CASCADE'), nullable=False)
+    diagnosis_id = sa.Column(UUID, sa.ForeignKey(Diagnosis.id, ondelete='CASCADE'), nullable=False)
+    diagnosis_code_id = sa.Column(sa.Integer, sa.ForeignKey(DiagnosisCode.id, ondelete='CASCADE'), nullable=False,
+                                  index=True)
+
+    code = orm.relationship(DiagnosisCode, lazy='joined', innerjoin=True, viewonly=True)
 
 
 class PostAppointmentSurvey(Base, DBObjectBase):
     __tablename__ = 'PostAppointmentSurvey'
 
-    id = sa.Column(sa.String(36), primary_key=True, default=lambda: str(uuid.uuid1()))
+    id = sa.Column(UUID, primary_key=True, default=new_object_id)
 
-    appointment_id = sa.Column(sa.String(36), sa.ForeignKey(Appointment.id, ondelete='SET NULL'), nullable=True)
+    appointment_id = sa.Column(UUID, sa.ForeignKey(Appointment.id, ondelete='SET NULL'), nullable=True, index=True)
     recommendation_rating = sa.Column(sa.Integer, nullable=False, default=5)
     is_diagnosis_explained = sa.Column(sa.Boolean, nullable=False, default=False)
     diagnosis_feedback = sa.Column(sa.Text, nullable=True)
     patient_feeling = sa.Column(sa.Text, nullable=True)
+    # stable integer key of the survey, the full-text index entries are keyed by it (see solution.search) rather than
+    # by the implicit rowid (of a table without an integer primary key), which VACUUM may renumber; assigned when the
+    # survey is inserted (see _assign_survey_search_rowid)
+    search_rowid = sa.Column(sa.Integer, nullable=False, unique=True, index=True)
+
+
+@event.listens_for(PostAppointmentSurvey, 'before_insert')
+def _assign_survey_search_rowid(mapper, connection, survey_obj):
+    if survey_obj.search_rowid is None:
+        # (evaluated by the insert statement, while it holds the write lock)
+        search_rowid = PostAppointmentSurvey.__table__.c.search_rowid
+        survey_obj.search_rowid = sa.select(sa.func.coalesce(sa.func.max(search_rowid), 0) + 1).scalar_subquery()
+
+
+class DoctorSurveyRollup(Base, DBObjectBase):
+    __tablename__ = 'DoctorSurveyRollup'
+
+    # aggregates of the surveys of the appointments of a doctor that start in a time bucket (a week, or all time),
+    # maintained by the object builders (see solution.survey_rollups)
+    doctor_id = sa.Column(UUID, sa.ForeignKey(User.id, ondelete='CASCADE'), primary_key=True)
+    bucket_ts = sa.Column(sa.Integer, primary_key=True)
+
+    survey_count = sa.Column(sa.Integer, nullable=False, default=0)
+    rating_sum = sa.Column(sa.Integer, nullable=False, default=0)
+    promoter_count = sa.Column(sa.Integer, nullable=False, default=0)
+    detractor_count = sa.Column(sa.Integer, nullable=False, default=0)
+    explained_count = sa.Column(sa.Integer, nullable=False, default=0)
+
+
+class ImportLedger(Base, DBObjectBase):
+    __tablename__ = 'ImportLedger'
+
+    # id of the imported Bundle (assigned by the sender, not necessarily an UUID)
+    bundle_id = sa.Column(sa.String, primary_key=True)
+
+    content_hash = sa.Column(sa.String(64), nullable=False)
+    imported_ts = sa.Column(sa.Integer, nullable=False, default=lambda: int(time.time()))
+
+
+class QuarantinedBundle(Base, DBObjectBase):
+    __tablename__ = 'QuarantinedBundle'
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+
+    # id of the Bundle (if it has one), and the file/position it was read from
+    bundle_id = sa.Column(sa.String, nullable=True)
+    source = sa.Column(sa.String, nullable=True)
+
+    error = sa.Column(sa.Text, nullable=False)
+    bundle_json = sa.Column(sa.Text, nullable=False)
+    quarantined_ts = sa.Column(sa.Integer, nullable=False, default=lambda: int(time.time()))
+
+
+class ChangeLog(Base, DBObjectBase):
+    __tablename__ = 'ChangeLog'
+    # (sequence numbers of deleted rows are never reused)
+    __table_args__ = dict(sqlite_autoincrement=True)
+
+    # sequence number of the change, increases with every change (cursor of the change feed)
+    seq = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+
+    # changed entity: name of its model (User, Appointment, Diagnosis or PostAppointmentSurvey) and id
+    entity_type = sa.Column(sa.String, nullable=False)
+    entity_id = sa.Column(UUID, nullable=False)
+    changed_ts = sa.Column(sa.Integer, nullable=False, default=lambda: int(time.time()))
@@ -0,0 +1,127 @@
+import re
+import datetime
+import unicodedata
+import sqlalchemy as sa
+from solution.enums import (
+    UserType,
+    LookupTokenKind,
+)
+import solution.models as models
+import solution.batching as batching
+
+
+# max number of users returned by a lookup
+DEFAULT_LIMIT = 20
+
+# (greater than any token that starts with a given prefix)
+_PREFIX_UPPER_BOUND = '\U0010ffff'
+
+
+def _fold(text):
+    # case and accent folding: 'Émile' -> 'emile'
+    return ''.join(c for c in unicodedata.normalize('NFKD', text) if not unicodedata.combining(c)).casefold()
+
+
+def get_name_tokens(*texts):
+    """
+    :param texts: name texts (family name, name text, given names), None values are skipped
+    :return: list of the distinct normalized words of the texts
+    """
+    return list(dict.fromkeys(token for text in texts if text for token in re.findall(r'\w+', _fold(text))))
+
+
+def get_contact_token(value):
+    """
+    Normalized contact value: phone numbers are reduced to their digits (so '555-555-2021' matches '(555) 555 2021'),
+    other values are case folded
+    """
+    value = _fold(value.strip())
+    if '@' not in value:
+        digits = re.sub(r'\D', '', value)
+        if len(digits) >= 3:
+            return digits
+
+    return value
+
+
+def add_name_tokens(db_session, user_id, family_name, name_text, given_names):
+    """
+    Queue the lookup tokens of a name of a user (see solution.batching)
+    """
+    for token in get_name_tokens(family_name, name_text, *given_names):
+        batching.add_row(db_session, models.PatientLookupToken, user_id=user_id, kind=LookupTokenKind.name, token=token)
+
+
+def add_contact_token(db_session, user_id, value):
+    """
+    Queue the lookup token of a contact value of a user (see solution.batching)
+    """
+    batching.add_row(
+        db_session, models.PatientLookupToken, user_id=user_id, kind=LookupTokenKind.contact,
+        token=get_contact_token(value),
+    )
+
+
+def delete_tokens(db_session, user_id, kind):
+    """
+    Delete the lookup tokens of a kind (name or contact) of a user
+    """
+    db_session.query(models.PatientLookupToken).filter_by(user_id=user_id, kind=kind).delete(
+        synchronize_session=False)
+
+
+def find_user_ids(db_session, name=None, birth_date=None, contact=None, user_type=UserType.patient,
+                  limit=DEFAULT_LIMIT):
+    """
+    Find users by partial name, birth date and/or contact value (all the given criteria must match). The query
+    starts from the most selective criterion (contact value, birth date or longest name word), an index range scan,
+    so its cost depends on the number of matching users rather than on the number of users
+    :param name: words the names of the user must start with (case and accent insensitive, e.g. 'ck hs')
+    :param birth_date: datetime.date or 'YYYY-MM-DD' string
+    :param contact: phone number, email or other contact value (exact match, see get_contact_token)
+    :param user_type: type of the users, None for any
+    :param limit: max number of users
+    :return: list of user ids
+    """
+    token_table = models.PatientLookupToken.__table__
+    user_table = models.User.__table__
+
+    def _name_criterion(table, token):
+        return sa.and_(table.c.kind == LookupTokenKind.name, table.c.token >= token,
+                       table.c.token < token + _PREFIX_UPPER_BOUND)
+
+    def _contact_criterion(table, token):
+        return sa.and_(table.c.kind == LookupTokenKind.contact, table.c.token == token)
+
+    # (criterion, token) pairs, the most selective first
+    criteria = []
+    if contact:
+        criteria.append((_contact_criterion, get_contact_token(contact)))
+    for token in sorted(get_name_tokens(name), key=len, reverse=True) if name else ():
+        criteria.append((_name_criterion, token))
+
+    if isinstance(birth_date, str):
+        birth_date = datetime.date.fromisoformat(birth_date)
+
+    if contact or (criteria and not birth_date):
+        criterion, token = criteria.pop(0)
+        select_stmt = sa.select(token_table.c.user_id).distinct().join_from(
+            token_table, user_table, user_table.c.id == token_table.c.user_id).where(criterion(token_table, token))
+    elif birth_date:
+        select_stmt = sa.select(user_table.c.id)
+    else:
+        return []
+
+    if birth_date:
+        select_stmt = select_stmt.where(user_table.c.birth_date == birth_date)
+
+    # the other criteria are checked per candidate user (by the index of the user's tokens)
+    for criterion, token in criteria:
+        other_token_table = token_table.alias()
+        select_stmt = select_stmt.where(sa.exists().where(
+            other_token_table.c.user_id == user_table.c.id, criterion(other_token_table, token)))
+
+    if user_type:
+        select_stmt = select_stmt.where(user_table.c.user_type == user_type)
+
+    return list(db_session.execute(select_stmt.limit(limit)).scalars())
@@ -0,0 +1,86 @@
+import sqlalchemy as sa
+import solution.models as models
+
+
+# max number of doctors per "actor_id IN (...)" query
+_IN_CHUNK_SIZE = 500
+
+
+def get_max_duration_secs(db_session):
+    """
+    :return: duration of the longest appointment (a lookup of the duration index)
+    """
+    return db_session.execute(sa.select(sa.func.max(models.Appointment.duration_secs))).scalar() or 0
+
+
+def overlaps(doctor_ids, start_ts, end_ts, max_duration_secs):
+    """
+    Condition of the appointments of doctors that overlap the time range [start_ts, end_ts). An appointment of
+    duration class k (see models.get_duration_class) that overlaps the range starts less than the max duration of
+    its class before it, so the condition is a range scan of the (actor_id, duration_class, start_time_ts) index per
+    duration class, bound by the length of the range plus the max duration of the class. A class only holds
+    appointments longer than a quarter of its max duration, so the scans read a few appointments beyond the range,
+    however many appointments the doctors have and however long the longest appointment is
+    :param max_duration_secs: see get_max_duration_secs, the classes of longer durations are not queried
+    """
+    appt = models.Appointment
+    class_selects = []
+    class_max_duration_secs = models.DURATION_CLASS_BASE_SECS
+    for duration_class in range(models.get_duration_class(max_duration_secs) + 1):
+        class_selects.append(sa.select(appt.id).where(
+            appt.actor_id.in_(doctor_ids),
+            appt.duration_class == duration_class,
+            appt.start_time_ts > start_ts - class_max_duration_secs,
+            appt.start_time_ts < end_ts,
+            appt.end_time_ts > start_ts,
+        ))
+        class_max_duration_secs *= models.DURATION_CLASS_FACTOR
+
+    return appt.id.in_(sa.union_all(*class_selects) if len(class_selects) > 1 else class_selects[0])
+
+
+def get_busy_intervals(db_session, doctor_ids, start_ts, end_ts, exclude_appointment_id=None):
+    """
+    Get the appointments of doctors that overlap a time range
+    :param exclude_appointment_id: id of an appointment to leave out (e.g. the one being rescheduled)
+    :return: dict of doctor id -> list of (start ts, end ts, appointment id) tuples ordered by start time (doctors
+             without appointments in the range are left out)
+    """
+    doctor_ids = list(doctor_ids)
+    max_duration_secs = get_max_duration_secs(db_session)
+    result = {}
+    for i in range(0, len(doctor_ids), _IN_CHUNK_SIZE):
+        select_stmt = sa.select(
+            models.Appointment.actor_id, models.Appointment.start_time_ts, models.Appointment.end_time_ts,
+            models.Appointment.id,
+        ).where(
+            overlaps(doctor_ids[i:i + _IN_CHUNK_SIZE], start_ts, end_ts, max_duration_secs),
+        ).order_by(models.Appointment.actor_id, models.Appointment.start_time_ts)
+        if exclude_appointment_id:
+            select_stmt = select_stmt.where(models.Appointment.id != exclude_appointment_id)
+
+        for doctor_id, appt_start_ts, appt_end_ts, appt_id in db_session.execute(select_stmt):
+            result.setdefault(doctor_id, []).append((appt_start_ts, appt_end_ts, appt_id))
+
+    return result
+
+
+def get_free_slots(busy_intervals, start_ts, end_ts, duration_secs):
+    """
+    :param busy_intervals: (start ts, end ts, ...) tuples ordered by start time
+    :return: list of the (start ts, end ts) gaps of at least duration_secs between the busy intervals, within the
+             time range [start_ts, end_ts)
+    """
+    result = []
+    free_start_ts = start_ts
+    for busy_start_ts, busy_end_ts, *_ in busy_intervals:
+        if min(busy_start_ts, end_ts) - free_start_ts >= duration_secs:
+            result.append((free_start_ts, min(busy_start_ts, end_ts)))
+        free_start_ts = max(free_start_ts, busy_end_ts)
+        if free_start_ts >= end_ts:
+            return result
+
+    if end_ts - free_start_ts >= duration_secs:
+        result.append((free_start_ts, end_ts))
+
+    return result
@@ -0,0 +1,248 @@
+import re
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+from solution.database import Base
+from solution.column_types import UUID
+import solution.models as models
+import solution.batching as batching
+
+
+# number of results per page of the search functions
+DEFAULT_PAGE_SIZE = 20
+
+# max number of ids per "IN (...)" statement that re-indexes changed rows
+_IN_CHUNK_SIZE = 500
+
+# ids of the parents (see SearchIndex.parent_column) whose rows a transaction changed, by index name; re-indexed
+# when the transaction commits
+_CHANGED_KEY = 'search_changed_ids'
+
+
+class SearchIndex:
+    """
+    SQLite FTS5 full-text index of text columns of a table ("external content" table: the index stores the tokens
+    only, the texts are read from the indexed table by rowid). The object builders keep it in sync: the entries of
+    the rows of a parent are removed before the rows first change in a transaction (see mark_changed), and the rows
+    of the changed parents are indexed again when the transaction commits
+    """
+
+    def __init__(self, name, model, columns, parent_column, rowid_column='id'):
+        """
+        :param name: name of the FTS5 table
+        :param model: mapped class of the indexed table
+        :param columns: names of the indexed columns
+        :param parent_column: name of the column that identifies the rows a builder changes together (e.g. the
+                              appointment id of the reasons)
+        :param rowid_column: integer column the index entries are keyed by, it must not change (unlike the
+                             implicit rowid of a table without an integer primary key, see VACUUM)
+        """
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.parent_column = parent_column
+        self.rowid_column = rowid_column
+
+        table_name = model.__tablename__
+        column_list = ', '.join(columns)
+        parent_ids_param = sa.bindparam('parent_ids', type_=UUID, expanding=True)
+
+        self.create_sql = (
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5({column_list}, content='{table_name}', "
+            f"content_rowid='{rowid_column}', tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+        )
+        # (the 'delete' command of an external content index takes the indexed values of the row)
+        self.delete_stmt = sa.text(
+            f"INSERT INTO {name}({name}, rowid, {column_list}) SELECT 'delete', {rowid_column}, {column_list} "
+            f"FROM {table_name} WHERE {parent_column} IN :parent_ids"
+        ).bindparams(parent_ids_param)
+        self.insert_stmt = sa.text(
+            f"INSERT INTO {name}(rowid, {column_list}) SELECT {rowid_column}, {column_list} "
+            f"FROM {table_name} WHERE {parent_column} IN :parent_ids"
+        ).bindparams(parent_ids_param)
+        self.rebuild_sql = f"INSERT INTO {name}({name}) VALUES('rebuild')"
+        self.is_empty_sql = f'SELECT NOT EXISTS (SELECT 1 FROM {name}_docsize)'
+        self.count_sql = f'SELECT count(*) FROM {table_name}'
+
+
+APPOINTMENT_REASONS = SearchIndex(
+    'AppointmentReasonSearch', models.AppointmentReason, ['reason_text'], 'appointment_id')
+USER_NAMES = SearchIndex('UserNameSearch', models.UserName, ['name_text', 'family_name'], 'user_id')
+SURVEY_FEEDBACK = SearchIndex(
+    'PostAppointmentSurveySearch', models.PostAppointmentSurvey, ['diagnosis_feedback', 'patient_feeling'], 'id',
+    rowid_column='search_rowid')
+
+INDEXES = (APPOINTMENT_REASONS, USER_NAMES, SURVEY_FEEDBACK)
+_INDEXES_BY_NAME = {index.name: index for index in INDEXES}
+
+
+def _is_supported(bind):
+    # (FTS5 is a SQLite module, other databases are not indexed)
+    return bind.dialect.name == 'sqlite'
+
+
+def mark_changed(db_session, index, obj):
+    """
+    Mark that the indexed rows of a parent are about to change (called by the object builders before they change
+    them); the first time in a transaction, the index entries of the stored rows are removed
+    :param index: SearchIndex of the rows
+    :param obj: the parent object (User, Appointment or PostAppointmentSurvey)
+    """
+    if not _is_supported(db_session.get_bind()):
+        return
+
+    changed_ids = db_session.info.setdefault(_CHANGED_KEY, {}).setdefault(index.name, set())
+    if obj.id in changed_ids:
+        return
+
+    changed_ids.add(obj.id)
+    # a new object has no stored rows
+    if not sa.inspect(obj).pending:
+        db_session.execute(index.delete_stmt, dict(parent_ids=[obj.id]))
+
+
+def create_indexes(connection):
+    """
+    Create the missing full-text indexes (empty, see rebuild_indexes)
+    """
+    if _is_supported(connection):
+        for index in INDEXES:
+            connection.exec_driver_sql(index.create_sql)
+
+
+def rebuild_indexes(connection, only_empty=False):
+    """
+    Rebuild the full-text indexes from the indexed tables, e.g. for the rows written before the indexes existed
+    :param only_empty: only rebuild the indexes that are empty
+    :return: dict of index name -> number of indexed rows, of the rebuilt indexes
+    """
+    result = {}
+    if not _is_supported(connection):
+        return result
+
+    create_indexes(connection)
+    for index in INDEXES:
+        if only_empty and not connection.exec_driver_sql(index.is_empty_sql).scalar():
+            continue
+
+        connection.exec_driver_sql(index.rebuild_sql)
+        result[index.name] = connection.exec_driver_sql(index.count_sql).scalar()
+
+    return result
+
+
+def _match_query(text):
+    """
+    :return: FTS5 query matching the rows that have every word of the text (as a word prefix), None if the text
+             has no words
+    """
+    words = re.findall(r'\w+', text)
+    if not words:
+        return None
+
+    return ' '.join(f'"{word}"*' for word in words)
+
+
+def _search(db_session, sql, column_types, text, page, page_size, **params):
+    match_query = _match_query(text)
+    if match_query is None:
+        return []
+
+    rows = db_session.execute(
+        sa.text(sql).columns(**column_types),
+        dict(params, query=match_query, limit=page_size, offset=(page - 1) * page_size),
+    )
+    return [dict(row) for row in rows.mappings()]
+
+
+def search_appointments(db_session, text, since_ts=None, until_ts=None, page=1, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Search the appointments by the text of their reasons, e.g. the visits whose reason mentions "endocrinologist"
+    in the last 90 days
+    :param text: words the reason must contain (as word prefixes, case and accent insensitive)
+    :param since_ts: only the appointments that start at or after this timestamp
+    :param until_ts: only the appointments that start before this timestamp
+    :param page: page of the results (from 1)
+    :param page_size: number of results per page
+    :return: list of dicts with the appointment_id, patient_id, doctor_id, start_time_ts, status, reason_text (of
+             the best matching reason) and rank (bm25, lower is better) of the matching appointments, best first
+    """
+    where_clauses = ['AppointmentReasonSearch MATCH :query']
+    if since_ts is not None:
+        where_clauses.append('a.start_time_ts >= :since_ts')
+    if until_ts is not None:
+        where_clauses.append('a.start_time_ts < :until_ts')
+
+    # (the other columns of a row with a min() aggregate are the ones of the row with the min value)
+    return _search(db_session, f'''
+        SELECT a.id AS appointment_id, a.subject_id AS patient_id, a.actor_id AS doctor_id, a.start_time_ts,
+               a.status, r.reason_text, min(AppointmentReasonSearch.rank) AS rank
+        FROM AppointmentReasonSearch
+        JOIN AppointmentReason AS r ON r.id = AppointmentReasonSearch.rowid
+        JOIN Appointment AS a ON a.id = r.appointment_id
+        WHERE {' AND '.join(where_clauses)}
+        GROUP BY a.id ORDER BY rank, a.id LIMIT :limit OFFSET :offset
+    ''', dict(
+        appointment_id=UUID, patient_id=UUID, doctor_id=UUID, status=models.Appointment.status.type,
+    ), text, page, page_size, since_ts=since_ts, until_ts=until_ts)
+
+
+def search_patients(db_session, text, page=1, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Search the users by their names
+    :return: list of dicts with the user_id, user_type, name_text and family_name (of the best matching name) and
+             rank of the matching users, best first
+    """
+    return _search(db_session, '''
+        SELECT u.id AS user_id, u.user_type, n.name_text, n.family_name, min(UserNameSearch.rank) AS rank
+        FROM UserNameSearch
+        JOIN UserName AS n ON n.id = UserNameSearch.rowid
+        JOIN User AS u ON u.id = n.user_id
+        WHERE UserNameSearch MATCH :query
+        GROUP BY u.id ORDER BY rank, u.id LIMIT :limit OFFSET :offset
+    ''', dict(user_id=UUID, user_type=models.User.user_type.type), text, page, page_size)
+
+
+def search_surveys(db_session, text, page=1, page_size=DEFAULT_PAGE_SIZE):
+    """
+    Search the post appointment surveys by their diagnosis feedback and patient feeling
+    :return: list of dicts with the survey_id, appointment_id, recommendation_rating, diagnosis_feedback,
+             patient_feeling and rank of the matching surveys, best first
+    """
+    return _search(db_session, '''
+        SELECT s.id AS survey_id, s.appointment_id, s.recommendation_rating, s.diagnosis_feedback,
+               s.patient_feeling, PostAppointmentSurveySearch.rank AS rank
+        FROM PostAppointmentSurveySearch
+        JOIN PostAppointmentSurvey AS s ON s.search_rowid = PostAppointmentSurveySearch.rowid
+        WHERE PostAppointmentSurveySearch MATCH :query
+        ORDER BY rank, s.id LIMIT :limit OFFSET :offset
+    ''', dict(survey_id=UUID, appointment_id=UUID), text, page, page_size)
+
+
+@event.listens_for(Base.metadata, 'after_create')
+def _create_indexes_after_create_all(target, connection, **kw):
+    create_indexes(connection)
+
+
+# (the index entries removed in a rolled back savepoint are restored by the rollback too)
+batching.register_transaction_state(
+    _CHANGED_KEY, lambda changed: {index_name: set(parent_ids) for index_name, parent_ids in changed.items()})
+
+
+@event.listens_for(orm.Session, 'before_commit')
+def _index_changed_rows_before_commit(db_session):
+    if db_session.in_nested_transaction():
+        # a released savepoint, its rows are indexed along with the enclosing transaction
+        return
+
+    changed = db_session.info.pop(_CHANGED_KEY, None)
+    if not changed:
+        return
+
+    # the changed rows (and objects) are written first
+    db_session.flush()
+    for index_name, parent_ids in changed.items():
+        parent_ids = sorted(parent_ids)
+        for i in range(0, len(parent_ids), _IN_CHUNK_SIZE):
+            db_session.execute(
+                _INDEXES_BY_NAME[index_name].insert_stmt, dict(parent_ids=parent_ids[i:i + _IN_CHUNK_SIZE]))
@@ -0,0 +1,251 @@
+import operator
+import threading
+import sqlalchemy as sa
+import solution.models as models
+from solution.models import timestamp_to_utc_datetime_str
+
+
+# max number of ids per "id IN (...)" query of the child rows (SQLite's default limit is 999 parameters)
+_IN_CHUNK_SIZE = 500
+
+
+def _iter_chunks(values):
+    values = list(values)
+    for i in range(0, len(values), _IN_CHUNK_SIZE):
+        yield values[i:i + _IN_CHUNK_SIZE]
+
+
+class ModelSerializer:
+    """
+    Serializer of a mapped class, compiled once: the column attributes are read with a single attrgetter and zipped
+    with their keys, so serializing an object (or a result row of select()) doesn't introspect the mapper.
+    Subclasses add the computed fields and the child collections
+    """
+
+    model = None
+    # keys of the columns left out of the serialized dicts
+    excluded_keys = ()
+
+    def __init__(self, model=None):
+        if model is not None:
+            self.model = model
+
+        self.keys = tuple(
+            column_attr.key for column_attr in sa.inspect(self.model).column_attrs
+            if column_attr.key not in self.excluded_keys
+        )
+        self._get_values = operator.attrgetter(*self.keys)
+
+    def select(self):
+        """
+        :return: select statement of the columns of the model, in the order serialize_rows() expects them
+        """
+        return sa.select(*(getattr(self.model, key) for key in self.keys))
+
+    def serialize(self, obj):
+        result = dict(zip(self.keys, self._get_values(obj)))
+        self._add_object_fields(result, obj)
+
+        return result
+
+    def serialize_rows(self, db_session, rows):
+        """
+        Serialize result rows of select() without creating ORM objects; the child collections of the rows are
+        loaded in bulk (one query per collection and chunk of rows)
+        :return: list of dicts, in the order of the rows
+        """
+        results = [dict(zip(self.keys, row)) for row in rows]
+        if results:
+            self._add_row_fields(db_session, results)
+
+        return results
+
+    def _add_object_fields(self, result, obj):
+        pass
+
+    def _add_row_fields(self, db_session, results):
+        pass
+
+
+class UserSerializer(ModelSerializer):
+    model = models.User
+
+    @staticmethod
+    def _complete(result, names, contact_info):
+        """
+        :param names: list of (family name, name text, given names) tuples
+        :param contact_info: list of (system, name, value) tuples
+        """
+        birth_date = result['birth_date']
+        result['birth_date'] = birth_date.strftime('%Y-%m-%d') if birth_date else ''
+        result['names'] = [
+            dict(last_name=family_name, first_name=given_name, name_text=name_text)
+            for family_name, name_text, given_names in names
+            for given_name in given_names
+        ]
+        result['contact_info'] = [dict(system=system, name=name, value=value) for system, name, value in contact_info]
+
+    def _add_object_fields(self, result, obj):
+        self._complete(
+            result,
+            [(n.family_name, n.name_text, [g.given_name for g in n.given_names]) for n in obj.names],
+            [(c.system, c.name, c.value) for c in obj.contact_info],
+        )
+
+    @staticmethod
+    def load_children(db_session, user_ids):
+        """
+        Load the names and contact info of users in bulk
+        :return: tuple of dicts: user id -> list of (family name, name text, given names) tuples, and user id -> list
+                 of (system, name, value) tuples
+        """
+        names = {}
+        given_names = {}
+        contact_info = {}
+        for chunk_user_ids in _iter_chunks(user_ids):
+            name_rows = db_session.execute(sa.select(
+                models.UserName.id, models.UserName.user_id, models.UserName.family_name, models.UserName.name_text,
+            ).where(models.UserName.user_id.in_(chunk_user_ids)).order_by(models.UserName.id)).all()
+            for name_id, user_id, family_name, name_text in name_rows:
+                names.setdefault(user_id, []).append((family_name, name_text, given_names.setdefault(name_id, [])))
+
+            for name_ids in _iter_chunks(row[0] for row in name_rows):
+                for user_name_id, given_name in db_session.execute(sa.select(
+                    models.UserGivenName.user_name_id, models.UserGivenName.given_name,
+                ).where(models.UserGivenName.user_name_id.in_(name_ids)).order_by(models.UserGivenName.id)):
+                    given_names[user_name_id].append(given_name)
+
+            for user_id, system, name, value in db_session.execute(sa.select(
+                models.UserContactInfo.user_id, models.UserContactInfo.system, models.UserContactInfo.name,
+                models.UserContactInfo.value,
+            ).where(models.UserContactInfo.user_id.in_(chunk_user_ids)).order_by(models.UserContactInfo.id)):
+                contact_info.setdefault(user_id, []).append((system, name, value))
+
+        return names, contact_info
+
+    def _add_row_fields(self, db_session, results):
+        names, contact_info = self.load_children(db_session, [result['id'] for result in results])
+        for result in results:
+            self._complete(result, names.get(result['id'], ()), contact_info.get(result['id'], ()))
+
+
+class AppointmentSerializer(ModelSerializer):
+    model = models.Appointment
+    # (derived for the time range queries, see solution.schedule)
+    excluded_keys = ('end_time_ts', 'duration_class')
+
+    @staticmethod
+    def _complete(result, reasons):
+        start_time_ts = result['start_time_ts']
+        result['start_time'] = timestamp_to_utc_datetime_str(start_time_ts)
+        result['end_time'] = timestamp_to_utc_datetime_str(start_time_ts + result['duration_secs'])
+        result['reasons'] = reasons
+
+    def _add_object_fields(self, result, obj):
+        self._complete(result, [reason_obj.reason_text for reason_obj in obj.reasons])
+
+    def _add_row_fields(self, db_session, results):
+        reasons = {}
+        for appt_ids in _iter_chunks(result['id'] for result in results):
+            for appt_id, reason_text in db_session.execute(sa.select(
+                models.AppointmentReason.appointment_id, models.AppointmentReason.reason_text,
+            ).where(models.AppointmentReason.appointment_id.in_(appt_ids)).order_by(models.AppointmentReason.id)):
+                reasons.setdefault(appt_id, []).append(reason_text)
+
+        for result in results:
+            self._complete(result, reasons.get(result['id'], []))
+
+
+class DiagnosisSerializer(ModelSerializer):
+    model = models.Diagnosis
+
+    def __init__(self):
+        super().__init__()
+        self._code_serializer = ModelSerializer(models.DiagnosisCode)
+
+    @staticmethod
+    def _complete(result, codes):
+        result['last_updated_time'] = timestamp_to_utc_datetime_str(result['last_updated_ts'])
+        result['codes'] = codes
+
+    def _add_object_fields(self, result, obj):
+        serialize_code = self._code_serializer.serialize
+        self._complete(result, [serialize_code(detail_obj.code) for detail_obj in obj.details if detail_obj.code])
+
+    def _add_row_fields(self, db_session, results):
+        codes = {}
+        code_keys = self._code_serializer.keys
+        for diagnosis_ids in _iter_chunks(result['id'] for result in results):
+            for row in db_session.execute(self._code_serializer.select().add_columns(
+                models.DiagnosisDetail.diagnosis_id,
+            ).join_from(models.DiagnosisCode, models.DiagnosisDetail).where(
+                models.DiagnosisDetail.diagnosis_id.in_(diagnosis_ids),
+            ).order_by(models.DiagnosisDetail.id)):
+                codes.setdefault(row[-1], []).append(dict(zip(code_keys, row)))
+
+        for result in results:
+            self._complete(result, codes.get(result['id'], []))
+
+
+class PostAppointmentSurveySerializer(ModelSerializer):
+    model = models.PostAppointmentSurvey
+    # (the key of the full-text index entries, see solution.search)
+    excluded_keys = ('search_rowid',)
+
+
+# model -> serializer class, the other models are serialized by their columns
+_SERIALIZER_CLASSES = {
+    models.User: UserSerializer,
+    models.Appointment: AppointmentSerializer,
+    models.Diagnosis: DiagnosisSerializer,
+    models.PostAppointmentSurvey: PostAppointmentSurveySerializer,
+}
+
+_serializers = {}
+_serializers_lock = threading.Lock()
+
+
+def get_serializer(model):
+    """
+    Get the (compiled once per process) serializer of a mapped class
+    :return: ModelSerializer object
+    """
+    result = _serializers.get(model)
+    if result is None:
+        with _serializers_lock:
+            result = _serializers.get(model)
+            if result is None:
+                serializer_class = _SERIALIZER_CLASSES.get(model)
+                result = _serializers[model] = serializer_class() if serializer_class else ModelSerializer(model)
+
+    return result
+
+
+def serialize(obj):
+    """
+    Serialize an ORM object (see DBObjectBase.to_dict, which also writes the object if it is pending)
+    """
+    return get_serializer(type(obj)).serialize(obj)
+
+
+def serialize_ids(db_session, model, ids):
+    """
+    Serialize the rows of a model with the given ids (one query per chunk of ids, see serialize_rows)
+    :return: dict of id -> serialized row (missing ids are left out)
+    """
+    serializer = get_serializer(model)
+    id_column = sa.inspect(model).primary_key[0]
+    result = {}
+    for chunk_ids in _iter_chunks(ids):
+        rows = db_session.execute(serializer.select().where(id_column.in_(chunk_ids)))
+        for row_dict in serializer.serialize_rows(db_session, rows):
+            result[row_dict[id_column.key]] = row_dict
+
+    return result
+
+
+def serialize_rows(db_session, model, rows):
+    """
+    Serialize result rows of get_serializer(model).select() (see ModelSerializer.serialize_rows)
+    """
+    return get_serializer(model).serialize_rows(db_session, rows)
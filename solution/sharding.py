@@ -0,0 +1,88 @@
+import uuid
+import zlib
+from contextlib import contextmanager
+import solution.database as database
+
+
+def get_shard_index(patient_id, shard_count):
+    """
+    Stable (across processes and runs) shard of a patient
+    :param patient_id: UUID of the patient (string)
+    :param shard_count: number of shards
+    :return: index of the shard, in [0, shard_count)
+    """
+    # hash of the 16-byte UUID rather than its integer value: the low bits of a time based (version 1) UUID are the
+    # node id, the same for all the ids generated by a host
+    return zlib.crc32(uuid.UUID(str(patient_id)).bytes) % shard_count
+
+
+class ShardedDatabase:
+    """
+    Storage split across SQLite databases: each patient, with their appointments, diagnoses and surveys, lives in
+    one of the shard databases (by hash of the patient id, see get_shard_index), so writers of different shards never
+    wait on each other's lock. The doctors and diagnosis codes live in the reference database; every shard also
+    holds replicas of the ones its rows reference (written along with those rows, the diagnosis codes with their
+    reference database ids), so a shard is self-contained: its foreign keys hold and a patient's summary is read from
+    a single shard
+    """
+
+    def __init__(self, shard_urls, reference_url, profile='default', **settings):
+        """
+        :param shard_urls: SqlAlchemy database URLs of the shards (the order is part of the routing, it must not change)
+        :param reference_url: SqlAlchemy database URL of the reference database
+        :param profile: engine profile of the databases (see solution.database.ENGINE_PROFILES)
+        :param settings: settings that override the ones of the profile
+        """
+        self.shard_urls = list(shard_urls)
+        self.reference_url = reference_url
+        self.profile = profile
+        self.settings = settings
+
+        self.shard_engines = [database.create_engine(url, profile, **settings) for url in self.shard_urls]
+        self.shard_session_makers = [database.get_session_maker(db_engine) for db_engine in self.shard_engines]
+        self.reference_engine = database.create_engine(reference_url, profile, **settings)
+        self.reference_session_maker = database.get_session_maker(self.reference_engine)
+
+    @classmethod
+    def from_url_template(cls, shard_url_template, shard_count, reference_url, profile='default', **settings):
+        """
+        :param shard_url_template: database URL of the shards, formatted with the shard index (e.g.
+                                   'sqlite:///data.shard{shard}.db')
+        """
+        shard_urls = [shard_url_template.format(shard=i) for i in range(shard_count)]
+        return cls(shard_urls, reference_url, profile, **settings)
+
+    @property
+    def shard_count(self):
+        return len(self.shard_urls)
+
+    def get_shard_index(self, patient_id):
+        return get_shard_index(patient_id, self.shard_count)
+
+    def get_session_maker(self, patient_id):
+        """
+        :return: DB Session factory of the shard of the patient
+        """
+        return self.shard_session_makers[self.get_shard_index(patient_id)]
+
+    @contextmanager
+    def session_scope(self, patient_id):
+        """
+        Session of the shard of the patient (see solution.database.session_scope)
+        """
+        with database.session_scope(self.get_session_maker(patient_id)) as db_session:
+            yield db_session
+
+    def group_by_shard(self, patient_ids):
+        """
+        :return: dict of shard index -> list of the given patient ids in the shard (in order)
+        """
+        result = {}
+        for patient_id in patient_ids:
+            result.setdefault(self.get_shard_index(patient_id), []).append(patient_id)
+
+        return result
+
+    def dispose(self):
+        for db_engine in self.shard_engines + [self.reference_engine]:
+            db_engine.dispose()
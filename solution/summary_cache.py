@@ -0,0 +1,238 @@
+import os
+import time
+import pickle
+import threading
+import weakref
+from collections import OrderedDict
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+
+
+DEFAULT_CACHE_SIZE = 10000
+
+# ids (users and appointments) changed by the object builders of a transaction, their summaries are invalidated once
+# the transaction commits
+_CHANGED_IDS_KEY = 'summary_changed_ids'
+
+
+class SummaryCache:
+    """
+    Bounded (LRU) map of patient id -> most recent appointment summary for one database, shared by all the sessions
+    of the process. A summary is invalidated when the object builders change its patient, doctor, appointment,
+    diagnosis or survey (in this process); ttl_secs bounds the staleness from changes made by other processes.
+    The summaries are kept pickled, a hit returns a new copy
+    """
+
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, ttl_secs=None):
+        self._max_size = max_size
+        self._ttl_secs = ttl_secs
+        # patient id -> (pickled summary, cached time, ids the summary depends on)
+        self._entries = OrderedDict()
+        # user/appointment id -> patient ids of the summaries that depend on it
+        self._patient_ids_by_id = {}
+        self._lock = threading.Lock()
+        # incremented by every invalidation, a summary loaded while an invalidation happened is not cached
+        self._generation = 0
+
+        self.hit_count = 0
+        self.miss_count = 0
+        self.invalidation_count = 0
+        self.eviction_count = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def _remove(self, patient_id):
+        _, _, dependency_ids = self._entries.pop(patient_id)
+        for dependency_id in dependency_ids:
+            patient_ids = self._patient_ids_by_id.get(dependency_id)
+            if patient_ids is not None:
+                patient_ids.discard(patient_id)
+                if not patient_ids:
+                    del self._patient_ids_by_id[dependency_id]
+
+    def get(self, patient_id):
+        """
+        :return: tuple of (is hit, summary)
+        """
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is not None and self._ttl_secs is not None and time.time() - entry[1] > self._ttl_secs:
+                self._remove(patient_id)
+                entry = None
+
+            if entry is None:
+                self.miss_count += 1
+                return False, None
+
+            self._entries.move_to_end(patient_id)
+            self.hit_count += 1
+
+        return True, pickle.loads(entry[0])
+
+    def put(self, patient_id, summary, generation=None):
+        """
+        Cache a summary
+        :param generation: the cache generation when the summary was loaded, the summary is not cached if an
+                           invalidation happened since
+        """
+        dependency_ids = {patient_id}
+        if summary:
+            dependency_ids.update(
+                (summary.get(name) or {}).get('id') for name in ('doctor', 'appointment'))
+            dependency_ids.discard(None)
+
+        pickled_summary = pickle.dumps(summary, protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+
+            self._add(patient_id, (pickled_summary, time.time(), dependency_ids))
+
+    def _add(self, patient_id, entry):
+        if patient_id in self._entries:
+            self._remove(patient_id)
+
+        self._entries[patient_id] = entry
+        for dependency_id in entry[2]:
+            self._patient_ids_by_id.setdefault(dependency_id, set()).add(patient_id)
+
+        while len(self._entries) > self._max_size:
+            self._remove(next(iter(self._entries)))
+            self.eviction_count += 1
+
+    def invalidate(self, ids):
+        """
+        Drop the summaries of the patients, and the ones that depend on the given (doctor/appointment) ids
+        """
+        with self._lock:
+            self._generation += 1
+            for changed_id in ids:
+                for patient_id in list(self._patient_ids_by_id.get(changed_id, ())):
+                    self._remove(patient_id)
+                    self.invalidation_count += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._patient_ids_by_id.clear()
+
+    def get_stats(self):
+        with self._lock:
+            lookup_count = self.hit_count + self.miss_count
+            return dict(
+                size=len(self._entries),
+                hits=self.hit_count,
+                misses=self.miss_count,
+                hit_rate=self.hit_count / lookup_count if lookup_count else 0.0,
+                invalidations=self.invalidation_count,
+                evictions=self.eviction_count,
+            )
+
+    def save(self, file_path):
+        """
+        Persist the cached summaries to a file (atomically), e.g. on shutdown
+        """
+        with self._lock:
+            entries = list(self._entries.items())
+
+        tmp_file_path = f'{file_path}.tmp'
+        with open(tmp_file_path, 'wb') as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file_path, file_path)
+
+    def load(self, file_path):
+        """
+        Load the summaries persisted by save(), the expired ones (see ttl_secs) are dropped
+        """
+        if not os.path.exists(file_path):
+            return
+
+        with open(file_path, 'rb') as f:
+            entries = pickle.load(f)
+
+        now = time.time()
+        with self._lock:
+            for patient_id, entry in entries:
+                if self._ttl_secs is None or now - entry[1] <= self._ttl_secs:
+                    self._add(patient_id, entry)
+
+
+_caches = weakref.WeakKeyDictionary()
+_caches_lock = threading.Lock()
+
+
+def configure(db_engine, max_size=DEFAULT_CACHE_SIZE, ttl_secs=None, file_path=None):
+    """
+    Enable the summary cache of a database (replacing the existing one)
+    :param max_size: max number of cached summaries
+    :param ttl_secs: max age of a cached summary, None to only rely on invalidation
+    :param file_path: optional file the cache is loaded from (see SummaryCache.save)
+    :return: SummaryCache object
+    """
+    result = SummaryCache(max_size, ttl_secs)
+    if file_path:
+        result.load(file_path)
+
+    with _caches_lock:
+        _caches[db_engine] = result
+
+    return result
+
+
+def get_summary_cache(db_session):
+    """
+    Get the summary cache of the database the session is bound to
+    :return: SummaryCache, None if the cache is not enabled
+    """
+    return _caches.get(db_session.get_bind())
+
+
+def mark_changed(db_session, *ids):
+    """
+    Record that the object builders of the session changed rows of the given users/appointments
+    """
+    db_session.info.setdefault(_CHANGED_IDS_KEY, set()).update(changed_id for changed_id in ids if changed_id)
+
+
+def get_summary(db_session, patient_id, load_summary):
+    """
+    Get the summary of a patient from the cache (if enabled) or load it
+    :param load_summary: function that loads the summary from the database
+    """
+    cache = get_summary_cache(db_session)
+    if cache is None or db_session.info.get(_CHANGED_IDS_KEY):
+        # a session with uncommitted changes reads (and does not cache) its own view of the data
+        return load_summary()
+
+    is_hit, result = cache.get(patient_id)
+    if is_hit:
+        return result
+
+    generation = cache.generation
+    result = load_summary()
+    cache.put(patient_id, result, generation=generation)
+
+    return result
+
+
+@event.listens_for(orm.Session, 'after_commit')
+def _invalidate_after_commit(db_session):
+    if db_session.in_nested_transaction():
+        return
+
+    changed_ids = db_session.info.pop(_CHANGED_IDS_KEY, None)
+    cache = get_summary_cache(db_session) if changed_ids else None
+    if cache is not None:
+        cache.invalidate(changed_ids)
+
+
+@event.listens_for(orm.Session, 'after_transaction_end')
+def _drop_changed_ids_after_transaction(db_session, transaction):
+    if transaction.parent is None:
+        db_session.info.pop(_CHANGED_IDS_KEY, None)
@@ -0,0 +1,235 @@
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql, sqlite
+import solution.models as models
+import solution.batching as batching
+
+
+# length of a time bucket of the rollups, a week from Monday 00:00 UTC (the epoch is a Thursday)
+BUCKET_SECS = 7 * 86400
+_BUCKET_OFFSET_SECS = 4 * 86400
+
+# time bucket of the rollup of all the surveys of a doctor (not a week start)
+ALL_TIME_BUCKET_TS = -1
+
+# ratings (from 1 to 10) of the promoters and of the detractors, for the net promoter score
+PROMOTER_MIN_RATING = 9
+DETRACTOR_MAX_RATING = 6
+
+# aggregated columns of DoctorSurveyRollup
+_COUNT_KEYS = ('survey_count', 'rating_sum', 'promoter_count', 'detractor_count', 'explained_count')
+
+# max number of ids per "IN (...)" query
+_IN_CHUNK_SIZE = 500
+
+# ids of the surveys whose contributions a transaction removed from the rollups, added back when it commits
+_CHANGED_KEY = 'survey_rollups_changed_ids'
+
+
+def get_bucket_ts(ts):
+    """
+    :return: start of the time bucket (week) of a timestamp
+    """
+    return ts - (ts - _BUCKET_OFFSET_SECS) % BUCKET_SECS
+
+
+def _select_contributions():
+    # aggregates of surveys by doctor and time bucket of their appointment (surveys without doctor are left out)
+    survey = models.PostAppointmentSurvey
+    appt = models.Appointment
+    bucket_ts = appt.start_time_ts - (appt.start_time_ts - _BUCKET_OFFSET_SECS) % BUCKET_SECS
+
+    return sa.select(
+        appt.actor_id,
+        bucket_ts,
+        sa.func.count(),
+        sa.func.sum(survey.recommendation_rating),
+        sa.func.sum(sa.case((survey.recommendation_rating >= PROMOTER_MIN_RATING, 1), else_=0)),
+        sa.func.sum(sa.case((survey.recommendation_rating <= DETRACTOR_MAX_RATING, 1), else_=0)),
+        sa.func.sum(sa.case((survey.is_diagnosis_explained, 1), else_=0)),
+    ).join_from(survey, appt, appt.id == survey.appointment_id).where(
+        appt.actor_id.isnot(None),
+    ).group_by(appt.actor_id, bucket_ts)
+
+
+def _add_contributions(deltas, rows, sign):
+    """
+    Add the rows of _select_contributions() to their weekly and all time rollups
+    :param deltas: dict of (doctor id, bucket ts) -> list of counts (see _COUNT_KEYS)
+    :param sign: 1 to add the contributions, -1 to remove them
+    """
+    for doctor_id, bucket_ts, *counts in rows:
+        for key in ((doctor_id, bucket_ts), (doctor_id, ALL_TIME_BUCKET_TS)):
+            totals = deltas.setdefault(key, [0] * len(_COUNT_KEYS))
+            for i, count in enumerate(counts):
+                totals[i] += sign * (count or 0)
+
+
+def _upsert(db_session):
+    # insert rollups, adding the counts to the existing ones
+    table = models.DoctorSurveyRollup.__table__
+    dialect = postgresql if db_session.get_bind().dialect.name == 'postgresql' else sqlite
+    insert_stmt = dialect.insert(table)
+
+    return insert_stmt.on_conflict_do_update(
+        index_elements=[table.c.doctor_id, table.c.bucket_ts],
+        set_={key: table.c[key] + insert_stmt.excluded[key] for key in _COUNT_KEYS},
+    )
+
+
+def _write_deltas(db_session, deltas):
+    if deltas:
+        db_session.execute(_upsert(db_session), [
+            dict(doctor_id=doctor_id, bucket_ts=bucket_ts, **dict(zip(_COUNT_KEYS, counts)))
+            for (doctor_id, bucket_ts), counts in deltas.items()
+        ])
+
+
+def _mark_changed(db_session, survey_ids):
+    changed_ids = db_session.info.setdefault(_CHANGED_KEY, set())
+    survey_ids = [survey_id for survey_id in survey_ids if survey_id not in changed_ids]
+    if not survey_ids:
+        return
+
+    changed_ids.update(survey_ids)
+    deltas = {}
+    # (the stored state of the surveys, before the changes of the caller are written)
+    with db_session.no_autoflush:
+        for i in range(0, len(survey_ids), _IN_CHUNK_SIZE):
+            _add_contributions(deltas, db_session.execute(_select_contributions().where(
+                models.PostAppointmentSurvey.id.in_(survey_ids[i:i + _IN_CHUNK_SIZE]))), -1)
+    _write_deltas(db_session, deltas)
+
+
+def mark_survey_changed(db_session, survey_obj):
+    """
+    Mark that a survey is about to change (called by the object builder before it changes the rating, the diagnosis
+    explanation or the appointment of the survey); the first time in a transaction, the contribution of the stored
+    survey is removed from the rollups, the one of the changed survey is added when the transaction commits
+    """
+    if sa.inspect(survey_obj).pending:
+        # a new survey has no stored contribution
+        db_session.info.setdefault(_CHANGED_KEY, set()).add(survey_obj.id)
+    else:
+        _mark_changed(db_session, [survey_obj.id])
+
+
+def mark_appointment_changed(db_session, appt_obj):
+    """
+    Mark that the doctor or the start time of an appointment is about to change, which moves its surveys to other
+    rollups (see mark_survey_changed)
+    """
+    if sa.inspect(appt_obj).pending:
+        return
+
+    survey = models.PostAppointmentSurvey
+    with db_session.no_autoflush:
+        survey_ids = db_session.execute(sa.select(survey.id).where(survey.appointment_id == appt_obj.id)).scalars()
+        _mark_changed(db_session, list(survey_ids))
+
+
+def rebuild_rollups(connection, only_empty=False):
+    """
+    Rebuild the rollups from the surveys, e.g. for the surveys written before the rollups existed
+    :param only_empty: only rebuild the rollups if there are none
+    :return: number of written rollups
+    """
+    table = models.DoctorSurveyRollup.__table__
+    if only_empty and connection.execute(sa.select(table.c.doctor_id).limit(1)).first():
+        return 0
+
+    connection.execute(table.delete())
+    deltas = {}
+    _add_contributions(deltas, connection.execute(_select_contributions()), 1)
+    rows = [
+        dict(doctor_id=doctor_id, bucket_ts=bucket_ts, **dict(zip(_COUNT_KEYS, counts)))
+        for (doctor_id, bucket_ts), counts in deltas.items()
+    ]
+    for i in range(0, len(rows), _IN_CHUNK_SIZE):
+        connection.execute(table.insert(), rows[i:i + _IN_CHUNK_SIZE])
+
+    return len(rows)
+
+
+def _get_scores(counts):
+    """
+    :param counts: dict of the counts of a rollup (see _COUNT_KEYS)
+    :return: dict of the counts, average rating, net promoter score (from -100 to 100) and rate of the surveys whose
+             diagnosis was explained (None without surveys)
+    """
+    result = dict(counts)
+    survey_count = counts['survey_count']
+    result.update(
+        average_rating=counts['rating_sum'] / survey_count if survey_count else None,
+        net_promoter_score=(
+            100 * (counts['promoter_count'] - counts['detractor_count']) / survey_count if survey_count else None),
+        explained_rate=counts['explained_count'] / survey_count if survey_count else None,
+    )
+    return result
+
+
+def get_doctor_scores(db_session, doctor_ids, bucket_ts=ALL_TIME_BUCKET_TS):
+    """
+    Get the survey scores of doctors, a lookup of one rollup per doctor (whatever the number of surveys)
+    :param bucket_ts: time bucket (see get_bucket_ts), all time by default
+    :return: dict of doctor id -> scores (see _get_scores), for every given doctor
+    """
+    table = models.DoctorSurveyRollup.__table__
+    doctor_ids = list(doctor_ids)
+    result = {doctor_id: _get_scores(dict.fromkeys(_COUNT_KEYS, 0)) for doctor_id in doctor_ids}
+    for i in range(0, len(doctor_ids), _IN_CHUNK_SIZE):
+        for row in db_session.execute(sa.select(table).where(
+            table.c.doctor_id.in_(doctor_ids[i:i + _IN_CHUNK_SIZE]),
+            table.c.bucket_ts == bucket_ts,
+        )).mappings():
+            result[row['doctor_id']] = _get_scores({key: row[key] for key in _COUNT_KEYS})
+
+    return result
+
+
+def get_doctor_weekly_scores(db_session, doctor_id, since_ts=None, until_ts=None):
+    """
+    Get the survey scores of a doctor per week, a range scan of the doctor's rollups
+    :param since_ts: only the weeks that end after this timestamp
+    :param until_ts: only the weeks that start before this timestamp
+    :return: list of scores (see _get_scores) with the bucket_ts of their week, ordered by week (weeks without
+             surveys are left out)
+    """
+    table = models.DoctorSurveyRollup.__table__
+    select_stmt = sa.select(table).where(table.c.doctor_id == doctor_id, table.c.bucket_ts != ALL_TIME_BUCKET_TS)
+    if since_ts is not None:
+        select_stmt = select_stmt.where(table.c.bucket_ts >= get_bucket_ts(since_ts))
+    if until_ts is not None:
+        select_stmt = select_stmt.where(table.c.bucket_ts < until_ts)
+
+    result = []
+    for row in db_session.execute(select_stmt.order_by(table.c.bucket_ts)).mappings():
+        if row['survey_count']:
+            result.append(dict(_get_scores({key: row[key] for key in _COUNT_KEYS}), bucket_ts=row['bucket_ts']))
+
+    return result
+
+
+# (the contributions removed in a rolled back savepoint are restored by the rollback too)
+batching.register_transaction_state(_CHANGED_KEY, set)
+
+
+@event.listens_for(orm.Session, 'before_commit')
+def _add_changed_surveys_before_commit(db_session):
+    if db_session.in_nested_transaction():
+        # a released savepoint, its surveys are added along with the enclosing transaction
+        return
+
+    changed_ids = db_session.info.pop(_CHANGED_KEY, None)
+    if not changed_ids:
+        return
+
+    # the changed surveys (and appointments) are written first
+    db_session.flush()
+    changed_ids = sorted(changed_ids)
+    deltas = {}
+    for i in range(0, len(changed_ids), _IN_CHUNK_SIZE):
+        _add_contributions(deltas, db_session.execute(_select_contributions().where(
+            models.PostAppointmentSurvey.id.in_(changed_ids[i:i + _IN_CHUNK_SIZE]))), 1)
+    _write_deltas(db_session, deltas)
@@ -0,0 +1,52 @@
+import sys
+import json
+import time
+import argparse
+import solution.database as database
+import solution.survey_rollups as survey_rollups
+import config
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Survey Scores - utility to report the survey scores (average '
+                                                 'rating, net promoter score, diagnosis explanation rate) of doctors, '
+                                                 'and to rebuild the survey rollups of an existing database.')
+    parser.add_argument('command', choices=['scores', 'rebuild'],
+                        help='scores to report the scores of doctors, or rebuild to rebuild the rollups.')
+    parser.add_argument('doctor_ids', nargs='*', help='ids of the doctors.')
+    parser.add_argument('--weeks', type=int,
+                        help='scores per week, of the last WEEKS weeks (default: the scores of all time).')
+    parser.add_argument('--database-url', default=config.DATABASE_URL,
+                        help=f'database of the surveys (default: {config.DATABASE_URL}).')
+
+    args = vars(parser.parse_args())
+
+    db_engine = database.create_engine(args.get('database_url'), config.SERVING_ENGINE_PROFILE,
+                                       **config.ENGINE_SETTINGS)
+    session_maker = database.get_session_maker(db_engine)
+
+    if args.get('command') == 'rebuild':
+        with db_engine.begin() as connection:
+            print(f'{survey_rollups.rebuild_rollups(connection)} rollup(s) written')
+        return
+
+    with database.session_scope(session_maker) as db_session:
+        if args.get('weeks'):
+            since_ts = int(time.time()) - args.get('weeks') * survey_rollups.BUCKET_SECS
+            results = [
+                dict(scores, doctor_id=doctor_id)
+                for doctor_id in args.get('doctor_ids')
+                for scores in survey_rollups.get_doctor_weekly_scores(db_session, doctor_id, since_ts=since_ts)
+            ]
+        else:
+            results = [
+                dict(scores, doctor_id=doctor_id)
+                for doctor_id, scores in survey_rollups.get_doctor_scores(db_session, args.get('doctor_ids')).items()
+            ]
+
+    for result in results:
+        sys.stdout.write(json.dumps(result) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,93 @@
+import pytest
+import solution.database as db
+from solution.enums import (
+    UserType,
+    AppointmentStatus,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+    AppointmentObjectBuilder,
+    DiagnosisObjectBuilder,
+    PostAppointmentSurveyObjectBuilder,
+    PatientController,
+)
+
+
+DAY = 86400
+
+
+def _iter_pages(controller, **kwargs):
+    cursor = None
+    while True:
+        page = controller.get_appointment_history(cursor=cursor, **kwargs)
+        yield page['appointments']
+        cursor = page['next_cursor']
+        if cursor is None:
+            break
+
+
+def test_appointment_history(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        patient_obj_builder = UserObjectBuilder(db_session)
+        patient_obj_builder.set_user_type(UserType.patient)
+        patient_id = patient_obj_builder.object_id
+
+        appt_ids = []
+        for i in range(7):
+            appt_obj_builder = AppointmentObjectBuilder(db_session)
+            appt_obj_builder.set_patient_id(patient_id)
+            # (two appointments per start time, the pages are ordered by id among them)
+            appt_obj_builder.set_appointment_time((i // 2) * DAY, 1800)
+            appt_obj_builder.set_status(AppointmentStatus.finished if i % 3 else AppointmentStatus.missed)
+            appt_obj_builder.set_reasons([f'Reason {i}'])
+            appt_ids.append(appt_obj_builder.object_id)
+
+            if i % 2:
+                diagnosis_obj_builder = DiagnosisObjectBuilder(db_session)
+                diagnosis_obj_builder.set_appointment_id(appt_obj_builder.object_id)
+                diagnosis_obj_builder.add_detail('I10' if i == 3 else 'E10-E14.9', 'Diagnosis', None)
+
+                survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+                survey_obj_builder.set_appointment_id(appt_obj_builder.object_id)
+                survey_obj_builder.set_recommendation_rating(i)
+
+        # another patient's appointment
+        appt_obj_builder = AppointmentObjectBuilder(db_session)
+        appt_obj_builder.set_patient_id(UserObjectBuilder(db_session).object_id)
+        appt_obj_builder.set_appointment_time(DAY, 1800)
+
+    expected_ids = [appt_id for _, appt_id in sorted(((i // 2) * DAY, appt_id) for i, appt_id in enumerate(appt_ids))]
+    expected_ids.reverse()
+
+    with db.session_scope(db_session_maker) as db_session:
+        controller = PatientController(db_session, patient_id)
+
+        pages = list(_iter_pages(controller, limit=3))
+        assert([len(page) for page in pages] == [3, 3, 1])
+        appts = [appt for page in pages for appt in page]
+        assert([appt['id'] for appt in appts] == expected_ids)
+
+        appts_by_id = {appt['id']: appt for appt in appts}
+        appt = appts_by_id[appt_ids[3]]
+        assert(appt['reasons'] == ['Reason 3'])
+        assert([code['code'] for code in appt['diagnoses'][0]['codes']] == ['I10'])
+        assert([survey['recommendation_rating'] for survey in appt['surveys']] == [3])
+        assert(appts_by_id[appt_ids[2]]['diagnoses'] == [])
+        assert(appts_by_id[appt_ids[2]]['surveys'] == [])
+
+        # a page that ends with the last appointment has no next page
+        page = controller.get_appointment_history(limit=7)
+        assert(len(page['appointments']) == 7 and page['next_cursor'] is None)
+
+        missed_appts = [appt for page in _iter_pages(controller, limit=1, statuses=[AppointmentStatus.missed])
+                        for appt in page]
+        assert([appt['id'] for appt in missed_appts] == [
+            appt_id for appt_id in expected_ids if appt_ids.index(appt_id) % 3 == 0])
+
+        page = controller.get_appointment_history(diagnosis_code='E10-E14.9')
+        assert([appt['id'] for appt in page['appointments']] == [
+            appt_id for appt_id in expected_ids if appt_id in (appt_ids[1], appt_ids[5])])
+        assert(controller.get_appointment_history(diagnosis_code='unknown')['appointments'] == [])
+
+        with pytest.raises(ValueError):
+            controller.get_appointment_history(cursor='invalid')
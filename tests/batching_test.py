@@ -0,0 +1,80 @@
+import threading
+import pytest
+import sqlalchemy as sa
+import solution.database as db
+import solution.models as models
+import solution.batching as batching
+from solution.enums import (
+    UserType,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+)
+
+
+_STATE_KEY = 'batching_test_state'
+batching.register_transaction_state(_STATE_KEY, set)
+
+
+def test_transaction_state_savepoints(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        db_session.info.setdefault(_STATE_KEY, set()).add(1)
+        with batching.savepoint(db_session):
+            db_session.info[_STATE_KEY].add(2)
+            # a rolled back savepoint (in a released one) restores the state it began with
+            with pytest.raises(ValueError):
+                with batching.savepoint(db_session):
+                    db_session.info[_STATE_KEY].add(3)
+                    raise ValueError()
+            assert(db_session.info[_STATE_KEY] == {1, 2})
+
+        assert(db_session.info[_STATE_KEY] == {1, 2})
+        with pytest.raises(ValueError):
+            with batching.savepoint(db_session):
+                db_session.info[_STATE_KEY].add(4)
+                raise ValueError()
+        assert(db_session.info[_STATE_KEY] == {1, 2})
+
+    # the state is dropped when the transaction ends
+    assert(_STATE_KEY not in db_session.info)
+
+    # a state set in a rolled back savepoint only is dropped along with it
+    with db.session_scope(db_session_maker) as db_session:
+        with pytest.raises(ValueError):
+            with batching.savepoint(db_session):
+                db_session.info.setdefault(_STATE_KEY, set()).add(1)
+                raise ValueError()
+        assert(_STATE_KEY not in db_session.info)
+
+
+def _add_patient(session_maker, given_name, patient_ids, before_commit=lambda: None):
+    with db.session_scope(session_maker) as db_session:
+        user_obj_builder = UserObjectBuilder(db_session)
+        user_obj_builder.set_user_type(UserType.patient)
+        # (the given name is queued with the id allocated for the name)
+        user_obj_builder.add_name(None, None, [given_name])
+        patient_ids[given_name] = user_obj_builder.object_id
+        before_commit()
+
+
+def test_allocate_ids_concurrent_sessions(tmp_path):
+    session_maker = db.get_session_maker(db.create_engine(f'sqlite:///{tmp_path / "ids.db"}', busy_timeout=10000))
+    patient_ids = {}
+
+    # a second session allocates a name id while the first one has allocated its own but not committed yet
+    def _add_second_patient():
+        thread = threading.Thread(target=_add_patient, args=(session_maker, 'Second', patient_ids))
+        thread.start()
+        thread.join(0.5)
+        return thread
+
+    threads = []
+    _add_patient(session_maker, 'First', patient_ids, lambda: threads.append(_add_second_patient()))
+    threads[0].join()
+
+    with db.session_scope(session_maker) as db_session:
+        given_names = db_session.execute(
+            sa.select(models.UserName.user_id, models.UserGivenName.given_name)
+            .join_from(models.UserName, models.UserGivenName, models.UserGivenName.user_name_id == models.UserName.id)
+        ).all()
+        assert(sorted(given_names) == sorted((patient_id, name) for name, patient_id in patient_ids.items()))
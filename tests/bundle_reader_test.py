@@ -0,0 +1,122 @@
+import io
+import gzip
+import json
+import pickle
+import pytest
+import solution.bundle_reader as bundle_reader
+from benchmarks.synthetic_data import BundleGenerator
+
+
+def _read_bundles(text, chunk_size=7):
+    return list(bundle_reader.iter_bundles(io.StringIO(text), chunk_size=chunk_size))
+
+
+def test_bundle_reader():
+    bundles = list(BundleGenerator(5))
+
+    # NDJSON, concatenated values and arrays of bundles (read in chunks smaller than a token)
+    assert(_read_bundles('\n'.join(json.dumps(bundle) for bundle in bundles) + '\n') == bundles)
+    assert(_read_bundles(''.join(json.dumps(bundle, indent=2) for bundle in bundles)) == bundles)
+    assert(_read_bundles(json.dumps(bundles[:2]) + json.dumps(bundles[2])) == bundles[:3])
+    assert(_read_bundles(json.dumps(dict(count=12345, entry=[], id='x'))) == [dict(count=12345, entry=[], id='x')])
+    assert(_read_bundles(' \n[]\n') == [])
+
+    # the bundles nested in a collection bundle are yielded one by one
+    collection = dict(resourceType='Bundle', type='collection',
+                      entry=[dict(resource=bundle) for bundle in bundles])
+    reader = bundle_reader.iter_bundles(io.StringIO(json.dumps(collection)), chunk_size=64)
+    assert(next(reader) == bundles[0])
+    assert(list(reader) == bundles[1:])
+
+
+def test_bundle_reader_max_entries():
+    bundles = list(BundleGenerator(3))
+    oversized_bundle = dict(bundles[1], entry=bundles[1]['entry'] * 5)
+    collection = dict(resourceType='Bundle', type='collection',
+                      entry=[dict(resource=bundle) for bundle in bundles] * 3)
+    text = '\n'.join(json.dumps(value) for value in (bundles[0], oversized_bundle, collection))
+
+    # only max_entries entries of a bundle are kept, the nested bundles don't count
+    read_bundles = list(bundle_reader.iter_bundles(io.StringIO(text), chunk_size=64, max_entries=8))
+    assert(read_bundles == [bundles[0], dict(oversized_bundle, entry=oversized_bundle['entry'][:8])] + bundles * 3)
+    assert(isinstance(read_bundles[1], bundle_reader.OversizedBundle))
+    assert(read_bundles[1].entry_count == len(oversized_bundle['entry']))
+    assert(not any(isinstance(bundle, bundle_reader.OversizedBundle) for bundle in read_bundles[2:]))
+    # (sent to the worker processes of a parallel import)
+    assert(pickle.loads(pickle.dumps(read_bundles[1])).entry_count == read_bundles[1].entry_count)
+
+
+def test_bundle_reader_malformed_line():
+    bundles = list(BundleGenerator(4))
+    lines = [json.dumps(bundle) for bundle in bundles]
+    lines.insert(1, '{"id": tru}')
+    # (a line cut before the end of its bundle, and a value longer than max_value_chars)
+    lines.insert(3, lines[2][:lines[2].index('"timestamp"')])
+    lines.insert(5, json.dumps(dict(resourceType='Bundle', id='x' * 2000)))
+    text = '\n'.join(lines) + '\n'
+
+    # a malformed line of NDJSON is skipped, the bundles of the next lines are read
+    read_bundles = list(bundle_reader.iter_bundles(io.StringIO(text), chunk_size=64, max_value_chars=1000,
+                                                   is_ndjson=True))
+    assert([bundle for bundle in read_bundles if not isinstance(bundle, bundle_reader.MalformedBundle)] == bundles)
+    assert([i for i, bundle in enumerate(read_bundles) if isinstance(bundle, bundle_reader.MalformedBundle)] == [
+        1, 3, 5])
+    for i in (1, 3, 5):
+        line_offset = sum(len(line) + 1 for line in lines[:i])
+        assert(line_offset <= read_bundles[i].offset <= line_offset + len(lines[i]))
+    assert(read_bundles[1].error_message == 'Expecting value')
+    assert(read_bundles[3].error_message == 'unexpected end of line')
+
+    # otherwise the reading fails at the malformed value, without reading the rest of the input
+    f = io.StringIO('\n'.join(lines[:2] + lines[2:3] * 1000))
+    reader = bundle_reader.iter_bundles(f, chunk_size=64)
+    assert(next(reader) == bundles[0])
+    with pytest.raises(json.JSONDecodeError):
+        next(reader)
+    assert(f.tell() < len(lines[0]) + 1000)
+
+
+def test_bundle_reader_position(tmp_path):
+    bundles = list(BundleGenerator(4))
+    collection = dict(resourceType='Bundle', type='collection',
+                      entry=[dict(resource=bundle) for bundle in bundles[1:3]])
+    # (a non-ASCII character and Windows line endings, the positions are byte offsets)
+    bundles[0]['id'] = 'caf\u00e9'
+    file_path = tmp_path / 'bundles.ndjson'
+    file_path.write_bytes('\r\n'.join(json.dumps(value, ensure_ascii=False) for value in (
+        bundles[0], collection, [bundles[3]])).encode('utf-8'))
+
+    def _read_from(position):
+        offset, skip_count = position
+        with bundle_reader.open_bundle_file(str(file_path), offset=offset) as f:
+            return list(bundle_reader.BundleReader(f, chunk_size=16, offset=offset))[skip_count:]
+
+    expected_bundles = [bundles[0], bundles[1], bundles[2], bundles[3]]
+    with bundle_reader.open_bundle_file(str(file_path)) as f:
+        reader = bundle_reader.BundleReader(f, chunk_size=16)
+        for i, bundle in enumerate(reader):
+            assert(bundle == expected_bundles[i])
+            # the bundles that follow are read again from the position
+            assert(_read_from(reader.position) == expected_bundles[i + 1:])
+
+    # a top-level bundle is followed by the end of its line, the bundles of a collection or array are skipped
+    with bundle_reader.open_bundle_file(str(file_path)) as f:
+        reader = bundle_reader.BundleReader(f)
+        positions = [reader.position for _ in reader]
+    assert([skip_count for _, skip_count in positions] == [0, 1, 2, 1])
+    assert(positions[0][0] == len(json.dumps(bundles[0], ensure_ascii=False).encode('utf-8')))
+
+
+def test_open_bundle_file(tmp_path):
+    bundles = list(BundleGenerator(3))
+    with gzip.open(tmp_path / 'bundles.ndjson.gz', 'wt') as f:
+        for bundle in bundles:
+            f.write(json.dumps(bundle) + '\n')
+
+    with bundle_reader.open_bundle_file(str(tmp_path / 'bundles.ndjson.gz')) as f:
+        assert(list(bundle_reader.iter_bundles(f)) == bundles)
+
+    # the content is read from an offset of the uncompressed content
+    offset = len(json.dumps(bundles[0]).encode('utf-8')) + 1
+    with bundle_reader.open_bundle_file(str(tmp_path / 'bundles.ndjson.gz'), offset=offset) as f:
+        assert(list(bundle_reader.iter_bundles(f)) == bundles[1:])
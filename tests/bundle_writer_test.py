@@ -0,0 +1,63 @@
+import io
+import solution.database as db
+import solution.bundle_reader as bundle_reader
+import solution.bundle_writer as bundle_writer
+from solution.enums import (
+    UserType,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+    AppointmentObjectBuilder,
+    PatientController,
+)
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
+
+
+def _export(session_maker, chunk_size):
+    f = io.StringIO()
+    with db.session_scope(session_maker) as db_session:
+        bundle_count = bundle_writer.write_bundles(f, bundle_writer.iter_bundles(db_session, chunk_size=chunk_size))
+
+    return bundle_count, f.getvalue()
+
+
+def test_export_round_trip(db_session_maker):
+    generator = BundleGenerator(30)
+    bundles = list(generator)
+    import_summary.import_bundles(db_session_maker, [(f'synthetic:{i}', b) for i, b in enumerate(bundles)])
+    patient_ids = list(generator.iter_patient_ids())
+
+    # appointments without diagnosis, without doctor, and without patient
+    with db.session_scope(db_session_maker) as db_session:
+        patient_obj_builder = UserObjectBuilder(db_session)
+        patient_obj_builder.set_user_type(UserType.patient)
+        patient_ids.append(patient_obj_builder.object_id)
+        for patient_id in (patient_ids[0], patient_obj_builder.object_id, None):
+            appt_obj_builder = AppointmentObjectBuilder(db_session)
+            appt_obj_builder.set_patient_id(patient_id)
+            appt_obj_builder.set_appointment_time(1617363000 + 86400 * 365 * 10, 1800)
+            appt_obj_builder.set_reasons(['Follow up'])
+
+    # (the chunk size doesn't divide the number of appointments)
+    bundle_count, exported_ndjson = _export(db_session_maker, chunk_size=7)
+    assert(bundle_count == len(bundles) + 3)
+
+    # a database imported from the export has the same data (and exports the same bundles)
+    session_maker = db.get_session_maker(db.create_engine('sqlite:///:memory:'))
+    exported_bundles = enumerate(bundle_reader.iter_bundles(io.StringIO(exported_ndjson)))
+    assert(import_summary.import_bundles(session_maker, exported_bundles) == (bundle_count, 0, 0))
+    assert(_export(session_maker, chunk_size=500) == (bundle_count, exported_ndjson))
+
+    with db.session_scope(db_session_maker) as db_session:
+        expected_summaries = list(PatientController.iter_most_recent_appointment_summaries(db_session, patient_ids))
+    with db.session_scope(session_maker) as db_session:
+        summaries = list(PatientController.iter_most_recent_appointment_summaries(db_session, patient_ids))
+
+    # (diagnosis code ids are assigned by the database)
+    for summaries_ in (expected_summaries, summaries):
+        for _, summary in summaries_:
+            for code in summary['diagnosis']['codes'] if summary['diagnosis'] else ():
+                del code['id']
+    assert(summaries == expected_summaries)
+    assert(summaries[-1][1]['doctor'] is None and summaries[-1][1]['diagnosis'] is None)
@@ -0,0 +1,74 @@
+import pytest
+import solution.database as db
+import solution.batching as batching
+import solution.change_log as change_log
+from solution.enums import (
+    AppointmentStatus,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+    AppointmentObjectBuilder,
+    PostAppointmentSurveyObjectBuilder,
+)
+
+
+def _get_changes(db_session_maker, cursor=0, batch_size=change_log.DEFAULT_BATCH_SIZE):
+    with db.session_scope(db_session_maker) as db_session:
+        return list(change_log.iter_changed_entities(db_session, cursor, batch_size=batch_size))
+
+
+def test_change_log(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        patient_obj_builder = UserObjectBuilder(db_session)
+        patient_obj_builder.set_is_active(True)
+        patient_obj_builder.add_name(family_name='Hsu', name_text='CK Hsu', given_names=['CK'])
+        doctor_obj_builder = UserObjectBuilder(db_session)
+        doctor_obj_builder.set_is_active(True)
+
+        appt_obj_builder = AppointmentObjectBuilder(db_session)
+        appt_obj_builder.set_patient_id(patient_obj_builder.object_id)
+        appt_obj_builder.set_doctor_id(doctor_obj_builder.object_id)
+
+        patient_id = patient_obj_builder.object_id
+        appt_id = appt_obj_builder.object_id
+
+    # an entity changed many times by a transaction is logged once
+    batches = _get_changes(db_session_maker)
+    assert(len(batches) == 1)
+    cursor, entities = batches[0]
+    assert([(e['seq'], e['entity_type']) for e in entities] == [(1, 'User'), (2, 'User'), (3, 'Appointment')])
+    assert(entities[0]['entity']['names'][0]['first_name'] == 'CK')
+    assert(cursor == 3)
+
+    # only the changes after the cursor are returned
+    assert(_get_changes(db_session_maker, cursor) == [])
+
+    with db.session_scope(db_session_maker) as db_session:
+        AppointmentObjectBuilder(db_session, object_id=appt_id).set_status(AppointmentStatus.finished)
+        survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+        survey_obj_builder.set_appointment_id(appt_id)
+        survey_id = survey_obj_builder.object_id
+
+        # the changes of a rolled back savepoint are not logged
+        with pytest.raises(ValueError):
+            with batching.savepoint(db_session):
+                UserObjectBuilder(db_session, object_id=patient_id).set_is_active(False)
+                raise ValueError()
+
+    batches = _get_changes(db_session_maker, cursor)
+    assert([[(e['entity_type'], e['entity_id']) for e in entities] for _, entities in batches] == [
+        [('Appointment', appt_id), ('PostAppointmentSurvey', survey_id)],
+    ])
+    assert(batches[0][1][0]['entity']['status'] == AppointmentStatus.finished)
+
+    # changes are returned in bounded batches, an entity changed again is returned with its last change
+    with db.session_scope(db_session_maker) as db_session:
+        UserObjectBuilder(db_session, object_id=patient_id).set_is_active(False)
+
+    batches = _get_changes(db_session_maker, batch_size=2)
+    assert([cursor for cursor, _ in batches] == [2, 4, 6])
+    assert([[e['seq'] for e in entities] for _, entities in batches] == [[1, 2], [4], [5, 6]])
+    assert(batches[-1][1][-1]['entity']['is_active'] is False)
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(change_log.get_last_cursor(db_session) == 6)
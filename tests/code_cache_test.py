@@ -0,0 +1,131 @@
+import threading
+import pytest
+import sqlalchemy as sa
+from sqlalchemy import create_engine
+import solution.database as db
+import solution.models as models
+import solution.code_cache as code_cache
+import solution.batching as batching
+from solution.controllers import (
+    DiagnosisObjectBuilder,
+)
+
+
+def test_diagnosis_code_cache(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        diagnosis_code_cache = code_cache.get_diagnosis_code_cache(db_session)
+
+        for _ in range(3):
+            obj_builder = DiagnosisObjectBuilder(db_session)
+            obj_builder.add_detail(code='E10-E14.9', name='Diabetes without complications', system='icd-10')
+            obj_builder.add_detail(code='I10', name='Essential hypertension', system='icd-10')
+
+        # new codes are inserted once, and only cached after commit
+        assert(db_session.query(models.DiagnosisCode).count() == 2)
+        assert(db_session.query(models.DiagnosisDetail).count() == 6)
+        assert(diagnosis_code_cache.get('I10') is None)
+
+    assert(diagnosis_code_cache.get('I10') is not None)
+
+    # codes of a rolled back transaction are not cached
+    with db_session_maker() as db_session:
+        DiagnosisObjectBuilder(db_session).add_detail(code='J45', name='Asthma', system='icd-10')
+        db_session.flush()
+        db_session.query(models.DiagnosisDetail).count()
+        db_session.rollback()
+
+    assert(diagnosis_code_cache.get('J45') is None)
+
+    with db.session_scope(db_session_maker) as db_session:
+        obj_builder = DiagnosisObjectBuilder(db_session)
+        obj_builder.add_detail(code='J45', name='Asthma', system='icd-10')
+        diagnosis_dict = obj_builder.object.to_dict(db_session)
+
+    assert([c['code'] for c in diagnosis_dict['codes']] == ['J45'])
+
+
+def test_diagnosis_code_cache_warm_from_file(tmp_path):
+    session_maker = db.get_session_maker(create_engine(f'sqlite:///{tmp_path / "codes.db"}'))
+
+    # another importer inserted the code since the cache was warmed
+    with db.session_scope(session_maker) as db_session:
+        db_session.add(models.DiagnosisCode(code='I10', name='Essential hypertension'))
+
+    code_list_path = tmp_path / 'codes.csv'
+    code_list_path.write_text('code,name,system\nI10,Essential hypertension,icd-10\nJ45,Asthma,icd-10\n')
+
+    with db.session_scope(session_maker) as db_session:
+        diagnosis_code_cache = code_cache.get_diagnosis_code_cache(db_session, max_size=1)
+        diagnosis_code_cache.warm_from_file(db_session, code_list_path)
+
+    with db.session_scope(session_maker) as db_session:
+        code_ids = dict(db_session.query(models.DiagnosisCode.code, models.DiagnosisCode.id))
+
+    assert(len(code_ids) == 2)
+
+    # bounded cache, the least recently used code got evicted
+    assert(len(diagnosis_code_cache) == 1)
+    assert(diagnosis_code_cache.get('J45') == code_ids['J45'])
+
+
+def test_diagnosis_code_cache_savepoints(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        diagnosis_code_cache = code_cache.get_diagnosis_code_cache(db_session)
+
+        try:
+            with batching.savepoint(db_session):
+                DiagnosisObjectBuilder(db_session).add_detail(code='J45', name='Asthma', system='icd-10')
+                batching.write_pending(db_session)
+                raise ValueError()
+        except ValueError:
+            pass
+
+        with batching.savepoint(db_session):
+            DiagnosisObjectBuilder(db_session).add_detail(code='I10', name='Essential hypertension', system='icd-10')
+
+        # codes are only cached once the enclosing transaction commits
+        assert(diagnosis_code_cache.get('I10') is None)
+
+    assert(diagnosis_code_cache.get('I10') is not None)
+    assert(diagnosis_code_cache.get('J45') is None)
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert([code_obj.code for code_obj in db_session.query(models.DiagnosisCode)] == ['I10'])
+
+
+def test_diagnosis_code_cache_invalid_code(db_session_maker):
+    # a code that violates a constraint other than the unique code fails, rather than being skipped
+    with pytest.raises(sa.exc.IntegrityError):
+        with db.session_scope(db_session_maker) as db_session:
+            DiagnosisObjectBuilder(db_session).add_detail(code='J45', name=None, system='icd-10')
+            batching.write_pending(db_session)
+
+
+def test_diagnosis_code_cache_concurrent_sessions(tmp_path):
+    session_maker = db.get_session_maker(
+        db.create_engine(f'sqlite:///{tmp_path / "codes.db"}', begin='IMMEDIATE', busy_timeout=10000))
+    barrier = threading.Barrier(2)
+    errors = []
+
+    def _add_detail():
+        try:
+            barrier.wait()
+            with db.session_scope(session_maker) as db_session:
+                DiagnosisObjectBuilder(db_session).add_detail(code='J45', name='Asthma', system='icd-10')
+        except Exception as e:
+            errors.append(e)
+
+    # two sessions resolve the same new code at once
+    threads = [threading.Thread(target=_add_detail) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert(errors == [])
+    with db.session_scope(session_maker) as db_session:
+        code_ids = [code_obj.id for code_obj in db_session.query(models.DiagnosisCode)]
+        assert(len(code_ids) == 1)
+        assert([detail_obj.diagnosis_code_id for detail_obj in db_session.query(models.DiagnosisDetail)] ==
+               code_ids * 2)
+        assert(code_cache.get_diagnosis_code_cache(db_session).get('J45') == code_ids[0])
@@ -1,8 +1,25 @@
 import pytest
-from sqlalchemy import create_engine
+from sqlalchemy import event
 import solution.database as db
 
 
 @pytest.fixture
 def db_session_maker():
-    yield db.get_session_maker(create_engine('sqlite:///:memory:', echo=True))
+    yield db.get_session_maker(db.create_engine('sqlite:///:memory:', echo=True))
+
+
+@pytest.fixture
+def executed_statements(db_session_maker):
+    """
+    List of (SQL statement, is executemany) tuples executed by the sessions of db_session_maker (other than BEGIN)
+    """
+    result = []
+
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if not statement.startswith('BEGIN'):
+            result.append((statement, executemany))
+
+    db_engine = db_session_maker.kw['bind']
+    event.listen(db_engine, 'before_cursor_execute', _before_cursor_execute)
+    yield result
+    event.remove(db_engine, 'before_cursor_execute', _before_cursor_execute)
@@ -1,14 +1,26 @@
 import json
+import uuid
+import collections
 import datetime
 import solution.database as db
+import solution.models as models
+import solution.survey_rollups as survey_rollups
 from solution.enums import (
     UserType,
     Gender,
     ContactSystem,
+    AppointmentStatus,
+    DiagnosisStatus,
 )
 from solution.controllers import (
     UserObjectBuilder,
+    AppointmentObjectBuilder,
+    DiagnosisObjectBuilder,
+    PatientController,
+    DoctorScheduleController,
 )
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
 
 
 def test_user_object_builder(db_session_maker):
@@ -57,3 +69,245 @@ def test_user_object_builder(db_session_maker):
 
     assert(json.dumps(test_obj_dict, default=str) == json.dumps(recalled_obj_dict, default=str))
 
+
+def _count_writes(executed_statements, table_names):
+    """
+    Count the INSERT, UPDATE and DELETE statements executed on the given tables
+
+    :param executed_statements: (SQL statement, is executemany) tuples, see the executed_statements fixture
+    :param table_names: names of the tables to count the statements of
+    :return: {(statement verb, table name, is executemany): statement count}
+    """
+    counts = collections.Counter()
+    for statement, executemany in executed_statements:
+        tokens = statement.split()
+        if tokens[0] in ('INSERT', 'DELETE'):
+            table_name = tokens[2]
+        elif tokens[0] == 'UPDATE':
+            table_name = tokens[1]
+        else:
+            continue
+        if table_name.strip('"') in table_names:
+            counts[(tokens[0], table_name.strip('"'), executemany)] += 1
+    return counts
+
+
+def test_user_object_builder_batches_child_rows(db_session_maker, executed_statements):
+    with db.session_scope(db_session_maker) as db_session:
+        obj_builder = UserObjectBuilder(db_session)
+        obj_builder.add_name(family_name='Hsu', name_text='CK Hsu', given_names=['CK', 'Chiakai'])
+        obj_builder.add_name(family_name='Hsu', name_text='Chiakai Hsu', given_names=['Chiakai'])
+        obj_builder.add_contact_info(system=ContactSystem.email, name='personal', value='ckhsusf@gmail.com')
+        obj_builder.add_contact_info(system=ContactSystem.phone, name='mobile', value='555-555-2021')
+        user_id = obj_builder.object_id
+
+    # one statement per table, child rows are written in bulk
+    write_counts = _count_writes(executed_statements, ('User', 'UserName', 'UserGivenName', 'UserContactInfo'))
+    assert({key: count for key, count in write_counts.items() if key[0] == 'INSERT'} == {
+        ('INSERT', 'User', False): 1,
+        ('INSERT', 'UserName', True): 1,
+        ('INSERT', 'UserGivenName', True): 1,
+        ('INSERT', 'UserContactInfo', True): 1,
+    })
+
+    with db.session_scope(db_session_maker) as db_session:
+        user_dict = UserObjectBuilder(db_session, object_id=user_id).object.to_dict(db_session)
+
+    assert(len(user_dict['names']) == 3)
+    assert(len(user_dict['contact_info']) == 2)
+
+
+def _create_appointment(db_session, patient_id, doctor_id, start_time_ts, child_count):
+    for user_id, user_type in ((patient_id, UserType.patient), (doctor_id, UserType.doctor)):
+        obj_builder = UserObjectBuilder(db_session, object_id=user_id)
+        obj_builder.set_user_type(user_type)
+        obj_builder.clear_names()
+        obj_builder.clear_contact_info()
+        for i in range(child_count):
+            obj_builder.add_name(family_name=f'Family {i}', name_text=f'Name {i}', given_names=[f'Given {i}'])
+            obj_builder.add_contact_info(system=ContactSystem.phone, name='mobile', value=f'555-555-{i:04d}')
+
+    appt_obj_builder = AppointmentObjectBuilder(db_session)
+    appt_obj_builder.set_patient_id(patient_id)
+    appt_obj_builder.set_doctor_id(doctor_id)
+    appt_obj_builder.set_appointment_time(start_time_ts=start_time_ts, duration_secs=1800)
+    appt_obj_builder.set_status(AppointmentStatus.finished)
+    for i in range(child_count):
+        appt_obj_builder.add_reason(f'Reason {i}')
+
+    diagnosis_obj_builder = DiagnosisObjectBuilder(db_session)
+    diagnosis_obj_builder.set_appointment_id(appt_obj_builder.object_id)
+    diagnosis_obj_builder.set_status(DiagnosisStatus.final)
+    for i in range(child_count):
+        diagnosis_obj_builder.add_detail(code=f'C{i}', name=f'Code {i}', system='icd-10')
+
+    return appt_obj_builder.object_id
+
+
+def test_appointment_summary_query_count(db_session_maker, executed_statements):
+    patient_id = str(uuid.uuid4())
+    doctor_id = str(uuid.uuid4())
+
+    query_counts = []
+    for i, child_count in enumerate((1, 5)):
+        with db.session_scope(db_session_maker) as db_session:
+            appt_id = _create_appointment(db_session, patient_id, doctor_id, 1617363000 + i, child_count)
+
+        del executed_statements[:]
+        with db.session_scope(db_session_maker) as db_session:
+            appt_summary = PatientController(db_session, patient_id).get_most_recent_appointment_summary()
+        query_counts.append(len(executed_statements))
+
+        assert(appt_summary['appointment']['id'] == appt_id)
+        assert(len(appt_summary['appointment']['reasons']) == child_count)
+        assert(len(appt_summary['patient']['names']) == child_count)
+        assert(len(appt_summary['doctor']['contact_info']) == child_count)
+        assert(len(appt_summary['diagnosis']['codes']) == child_count)
+
+    # serializing the summary does not issue a query per child row
+    assert(query_counts[0] == query_counts[1])
+
+
+def test_most_recent_appointment_summaries(db_session_maker, executed_statements):
+    doctor_id = str(uuid.uuid4())
+    patient_ids = [str(uuid.uuid4()) for _ in range(4)]
+
+    with db.session_scope(db_session_maker) as db_session:
+        for i, patient_id in enumerate(patient_ids[:3]):
+            _create_appointment(db_session, patient_id, doctor_id, 1617363000 + i, 2)
+            _create_appointment(db_session, patient_id, doctor_id, 1617360000 + i, 1)
+
+        UserObjectBuilder(db_session, object_id=patient_ids[3])
+
+    unknown_patient_id = str(uuid.uuid4())
+    del executed_statements[:]
+    with db.session_scope(db_session_maker) as db_session:
+        appt_summaries = list(PatientController.iter_most_recent_appointment_summaries(
+            db_session, patient_ids + [unknown_patient_id], batch_size=2))
+    batch_query_count = len(executed_statements)
+
+    assert([user_id for user_id, _ in appt_summaries] == patient_ids + [unknown_patient_id])
+    assert(appt_summaries[3][1] is None)
+    assert(appt_summaries[4][1] is None)
+
+    with db.session_scope(db_session_maker) as db_session:
+        for patient_id, appt_summary in appt_summaries[:3]:
+            ev_appt_summary = PatientController(db_session, patient_id).get_most_recent_appointment_summary()
+            assert(json.dumps(appt_summary, default=str) == json.dumps(ev_appt_summary, default=str))
+
+    # a handful of queries per batch of patients
+    assert(batch_query_count <= 3 * 10)
+
+
+def test_object_builders_reconcile_child_rows(db_session_maker, executed_statements):
+    names = [
+        dict(family_name='Hsu', name_text='CK Hsu', given_names=['CK', 'Chiakai']),
+        dict(family_name='Hsu', name_text='Chiakai Hsu', given_names=['Chiakai']),
+    ]
+    contact_infos = [
+        dict(system=ContactSystem.email, name='personal', value='ckhsusf@gmail.com'),
+        dict(system=ContactSystem.phone, name='mobile', value='555-555-2021'),
+    ]
+    details = [
+        dict(code='E10-E14.9', name='Diabetes without complications', system='icd-10'),
+    ]
+
+    with db.session_scope(db_session_maker) as db_session:
+        user_obj_builder = UserObjectBuilder(db_session)
+        user_obj_builder.set_names(names)
+        user_obj_builder.set_contact_info(contact_infos)
+        user_id = user_obj_builder.object_id
+
+        diagnosis_obj_builder = DiagnosisObjectBuilder(db_session)
+        diagnosis_obj_builder.set_details(details)
+        diagnosis_id = diagnosis_obj_builder.object_id
+
+    # unchanged rows are left alone
+    del executed_statements[:]
+    with db.session_scope(db_session_maker) as db_session:
+        UserObjectBuilder(db_session, object_id=user_id).set_names(names)
+        UserObjectBuilder(db_session, object_id=user_id).set_contact_info(contact_infos)
+        DiagnosisObjectBuilder(db_session, object_id=diagnosis_id).set_details(details)
+
+    child_table_names = ('UserName', 'UserGivenName', 'UserContactInfo', 'DiagnosisDetail')
+    assert(not _count_writes(executed_statements, child_table_names))
+
+    # only the changes are written
+    names = [dict(family_name='Hsu', name_text='CK Hsu', given_names=['CK', 'Chia-kai'])]
+    contact_infos[1]['value'] = '555-555-2022'
+    details.append(dict(code='I10', name='Essential hypertension', system='icd-10'))
+
+    del executed_statements[:]
+    with db.session_scope(db_session_maker) as db_session:
+        user_obj_builder = UserObjectBuilder(db_session, object_id=user_id)
+        user_obj_builder.set_names(names)
+        user_obj_builder.set_contact_info(contact_infos)
+        user_dict = user_obj_builder.object.to_dict(db_session)
+
+        diagnosis_obj_builder = DiagnosisObjectBuilder(db_session, object_id=diagnosis_id)
+        diagnosis_obj_builder.set_details(details)
+        diagnosis_dict = diagnosis_obj_builder.object.to_dict(db_session)
+
+    write_counts = _count_writes(executed_statements, child_table_names)
+    assert({(verb, table_name) for verb, table_name, _ in write_counts} == {
+        ('DELETE', 'UserName'),
+        ('DELETE', 'UserGivenName'),
+        ('UPDATE', 'UserGivenName'),
+        ('UPDATE', 'UserContactInfo'),
+        ('INSERT', 'DiagnosisDetail'),
+    })
+    assert(set(write_counts.values()) == {1})
+
+    assert(user_dict['names'] == [
+        dict(last_name='Hsu', first_name='CK', name_text='CK Hsu'),
+        dict(last_name='Hsu', first_name='Chia-kai', name_text='CK Hsu'),
+    ])
+    assert([c['value'] for c in user_dict['contact_info']] == ['ckhsusf@gmail.com', '555-555-2022'])
+    assert([c['code'] for c in diagnosis_dict['codes']] == ['E10-E14.9', 'I10'])
+
+
+def test_controller_queries_use_indexes(db_session_maker, executed_statements):
+    generator = BundleGenerator(20)
+    import_summary.import_bundles(db_session_maker, [(f'synthetic:{i}', b) for i, b in enumerate(generator)])
+    patient_ids = list(generator.iter_patient_ids())
+
+    del executed_statements[:]
+    with db.session_scope(db_session_maker) as db_session:
+        summary = PatientController(db_session, patient_ids[0]).get_most_recent_appointment_summary()
+        list(PatientController.iter_most_recent_appointment_summaries(db_session, patient_ids))
+        patient = summary['patient']
+        PatientController.find_patients(
+            db_session, name=patient['names'][0]['name_text'], birth_date=patient['birth_date'],
+            contact=patient['contact_info'][0]['value'] if patient['contact_info'] else None)
+        PatientController.find_patients(db_session, birth_date=patient['birth_date'])
+        doctor_schedule = DoctorScheduleController(db_session, summary['doctor']['id'])
+        appt_start_ts = summary['appointment']['start_time_ts']
+        PatientController(db_session, patient_ids[0]).get_appointment_history(
+            cursor=f"{appt_start_ts + 1}:{summary['appointment']['id']}", statuses=[AppointmentStatus.finished],
+            diagnosis_code=summary['diagnosis']['codes'][0]['code'])
+        doctor_schedule.get_appointments(appt_start_ts - 86400, appt_start_ts + 86400)
+        doctor_schedule.find_conflicts(appt_start_ts, 1800, appointment_id=summary['appointment']['id'])
+        DoctorScheduleController.find_doctors_free_slots(
+            db_session, [summary['doctor']['id'], patient_ids[0]], appt_start_ts, appt_start_ts + 86400, 1800)
+        survey_rollups.get_doctor_scores(db_session, [summary['doctor']['id']])
+        survey_rollups.get_doctor_weekly_scores(db_session, summary['doctor']['id'], since_ts=appt_start_ts - 86400)
+
+        UserObjectBuilder(db_session, object_id=summary['doctor']['id']).set_names(
+            [dict(family_name='Careful', name_text='Adam Careful', given_names=['Adam'])])
+        UserObjectBuilder(db_session, object_id=summary['doctor']['id']).clear_names()
+        UserObjectBuilder(db_session, object_id=patient_ids[0]).clear_contact_info()
+        AppointmentObjectBuilder(db_session, object_id=summary['appointment']['id']).set_reasons(['Checkup'])
+        DiagnosisObjectBuilder(db_session, object_id=summary['diagnosis']['id']).clear_details()
+
+    # no query falls back to a full scan of a table (scans of subqueries are fine)
+    table_names = set(models.Base.metadata.tables)
+    with db_session_maker.kw['bind'].connect() as connection:
+        for statement, executemany in executed_statements:
+            if not statement.startswith(('SELECT', 'UPDATE', 'DELETE')) or executemany:
+                continue
+            # (the plan does not depend on the parameter values)
+            parameters = (None,) * statement.count('?')
+            for row in connection.exec_driver_sql(f'EXPLAIN QUERY PLAN {statement}', [parameters]):
+                detail = row[-1].split()
+                if detail[0] == 'SCAN':
+                    assert(detail[1] not in table_names), f'{row[-1]}: {statement}'
@@ -0,0 +1,32 @@
+import pytest
+import solution.database as db
+import solution.models as models
+from solution.controllers import (
+    UserObjectBuilder,
+)
+
+
+@pytest.mark.parametrize('profile', sorted(db.ENGINE_PROFILES))
+def test_engine_profiles(profile, tmp_path):
+    db_engine = db.create_engine(f'sqlite:///{tmp_path / "profile.db"}', profile)
+    session_maker = db.get_session_maker(db_engine)
+
+    settings = db.ENGINE_PROFILES[profile]
+    with db_engine.connect() as connection:
+        if 'journal_mode' in settings:
+            journal_mode = connection.exec_driver_sql('PRAGMA journal_mode').scalar()
+            assert(journal_mode.lower() == settings['journal_mode'].lower())
+        if 'foreign_keys' in settings:
+            assert(connection.exec_driver_sql('PRAGMA foreign_keys').scalar() == int(settings['foreign_keys']))
+
+    # savepoints are rolled back on their own
+    with db.session_scope(session_maker) as db_session:
+        user_id = UserObjectBuilder(db_session).object_id
+        with pytest.raises(ValueError):
+            with db_session.begin_nested():
+                UserObjectBuilder(db_session)
+                db_session.flush()
+                raise ValueError()
+
+    with db.session_scope(session_maker) as db_session:
+        assert([user_obj.id for user_obj in db_session.query(models.User)] == [user_id])
@@ -0,0 +1,242 @@
+import io
+import os
+import json
+import copy
+import uuid
+import pytest
+import solution.database as db
+import solution.models as models
+import import_summary
+
+
+_INPUT_DATA_PATH = os.path.join(os.path.dirname(__file__), '..', 'input_data.json')
+
+
+def _load_input_bundle():
+    with open(_INPUT_DATA_PATH, 'r') as f:
+        return json.load(f)
+
+
+def _make_bundle(template, patient_id=None):
+    # copy the sample bundle with new patient/appointment/diagnosis ids
+    result = copy.deepcopy(template)
+    result['id'] = str(uuid.uuid4())
+    patient_id = patient_id or str(uuid.uuid4())
+    appt_id = str(uuid.uuid4())
+    for entry in result['entry']:
+        resource = entry['resource']
+        resource_type = resource['resourceType']
+        if resource_type == 'Patient':
+            resource['id'] = patient_id
+        elif resource_type == 'Appointment':
+            resource['id'] = appt_id
+            resource['subject']['reference'] = f'Patient/{patient_id}'
+        elif resource_type == 'Diagnosis':
+            resource['id'] = str(uuid.uuid4())
+            resource['appointment']['reference'] = f'Appointment/{appt_id}'
+
+    return result
+
+
+def test_import_bundles_from_directory(db_session_maker, tmp_path):
+    template = _load_input_bundle()
+
+    ndjson_bundles = [_make_bundle(template) for _ in range(5)]
+    bad_bundle = _make_bundle(template)
+    bad_bundle['entry'][2]['resource']['status'] = 'unknown-status'
+    ndjson_bundles.insert(2, bad_bundle)
+    # (quarantined without reading all of its entries into memory)
+    oversized_bundle = _make_bundle(template)
+    oversized_bundle['entry'] *= 300
+    ndjson_bundles.append(oversized_bundle)
+
+    with open(tmp_path / 'bundles.ndjson', 'w') as f:
+        for i, bundle in enumerate(ndjson_bundles):
+            f.write(json.dumps(bundle) + '\n')
+            # (quarantined, the bundles of the next lines are read)
+            if i == 3:
+                f.write('{"id": tru}\n')
+
+    with open(tmp_path / 'bundle.json', 'w') as f:
+        json.dump(template, f)
+
+    bundles = import_summary._iter_bundles([str(tmp_path)])
+    report_file = io.StringIO()
+    imported_count, skipped_count, failed_count = import_summary.import_bundles(
+        db_session_maker, bundles, batch_size=4, report_file=report_file)
+
+    assert(imported_count == 6)
+    assert(skipped_count == 0)
+    assert(failed_count == 3)
+
+    report = [json.loads(line) for line in report_file.getvalue().splitlines()]
+    assert(len(report) == 9)
+    assert([r['bundle_id'] for r in report if r['status'] == 'failed'] == [
+        bad_bundle['id'], None, oversized_bundle['id']])
+    assert('malformed bundle at byte' in report[5]['error'])
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(db_session.query(models.Appointment).count() == 6)
+        assert(db_session.query(models.User).filter_by(id=bad_bundle['entry'][0]['resource']['id']).count() == 0)
+
+
+def test_import_ledger_skips_unchanged_bundles(db_session_maker, executed_statements):
+    bundle = _make_bundle(_load_input_bundle())
+
+    def _import(summary_dict):
+        return import_summary.import_bundles(db_session_maker, [('test', copy.deepcopy(summary_dict))])
+
+    assert(_import(bundle) == (1, 0, 0))
+
+    # re-delivery (assembled at a different time) is skipped with a single lookup
+    bundle['timestamp'] = '2021-04-03T08:00:00Z'
+    del executed_statements[:]
+    assert(_import(bundle) == (0, 1, 0))
+    assert([s for s, _ in executed_statements if not s.startswith('SELECT "ImportLedger"')] == [])
+
+    # changed bundles are imported again
+    bundle['entry'][2]['resource']['type'][0]['text'] = 'Follow-up visit'
+    assert(_import(bundle) == (1, 0, 0))
+    assert(_import(bundle) == (0, 1, 0))
+
+    with db.session_scope(db_session_maker) as db_session:
+        appt_obj = db_session.query(models.Appointment).one()
+        assert([reason_obj.reason_text for reason_obj in appt_obj.reasons] == ['Follow-up visit'])
+
+
+def test_parallel_import(db_session_maker):
+    template = _load_input_bundle()
+    bundles = [(f'test:{i}', _make_bundle(template)) for i in range(250)]
+    bundles[100][1]['entry'][3]['resource']['status'] = 'unknown-status'
+
+    report_file = io.StringIO()
+    assert(import_summary.import_bundles(db_session_maker, bundles, batch_size=64, report_file=report_file,
+                                         workers=2) == (249, 0, 1))
+
+    # reported in the order of the input
+    report = [json.loads(line) for line in report_file.getvalue().splitlines()]
+    assert([r['source'] for r in report] == [source for source, _ in bundles])
+    assert(report[100]['status'] == 'failed')
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(db_session.query(models.Appointment).count() == 249)
+        assert(db_session.query(models.ImportLedger).count() == 249)
+
+
+def test_bad_bundles_are_quarantined(db_session_maker, monkeypatch):
+    template = _load_input_bundle()
+    bundles = [(f'test:{i}', _make_bundle(template)) for i in range(5)]
+    bad_bundle = bundles[2][1]
+
+    create_diagnosis_object = import_summary._create_diagnosis_object
+
+    def _create_diagnosis_object(db_session, diagnosis):
+        # fails once the patient, doctor and appointment rows have been queued
+        if diagnosis['id'] == bad_bundle['entry'][3]['resource']['id']:
+            raise ValueError('bad diagnosis')
+        return create_diagnosis_object(db_session, diagnosis)
+
+    monkeypatch.setattr(import_summary, '_create_diagnosis_object', _create_diagnosis_object)
+
+    assert(import_summary.import_bundles(db_session_maker, bundles) == (4, 0, 1))
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(db_session.query(models.Appointment).count() == 4)
+        assert(db_session.query(models.Appointment).filter_by(
+            id=bad_bundle['entry'][2]['resource']['id']).count() == 0)
+        assert(db_session.query(models.ImportLedger).filter_by(bundle_id=bad_bundle['id']).count() == 0)
+
+        quarantined_obj = db_session.query(models.QuarantinedBundle).one()
+        assert(quarantined_obj.bundle_id == bad_bundle['id'])
+        assert(quarantined_obj.source == 'test:2')
+        assert(json.loads(quarantined_obj.bundle_json) == bad_bundle)
+
+
+def _import_interrupted(db_session_maker, paths, checkpoint_path, count, batch_size):
+    # import with a checkpoint, interrupted once count bundles have been read
+    def _interrupted(bundles):
+        for i, item in enumerate(bundles):
+            if i == count:
+                raise KeyboardInterrupt()
+            yield item
+
+    checkpoint = import_summary.ImportCheckpoint(checkpoint_path)
+    try:
+        import_summary.import_bundles(db_session_maker, _interrupted(import_summary._iter_bundles(
+            paths, checkpoint=checkpoint)), batch_size=batch_size, checkpoint=checkpoint)
+    except KeyboardInterrupt:
+        pass
+
+
+def test_import_resumes_from_checkpoint(db_session_maker, tmp_path):
+    template = _load_input_bundle()
+    bundle_path = str(tmp_path / 'bundles.ndjson')
+    with open(bundle_path, 'w') as f:
+        for _ in range(150):
+            f.write(json.dumps(_make_bundle(template)) + '\n')
+
+    checkpoint_path = str(tmp_path / 'checkpoint.json')
+    _import_interrupted(db_session_maker, [bundle_path], checkpoint_path, 100, batch_size=40)
+
+    # the bundles of the committed batches are not read again, the file is read from the end of the last one
+    checkpoint = import_summary.ImportCheckpoint(checkpoint_path)
+    assert((checkpoint.current_file_path, checkpoint.bundle_count) == (bundle_path, 80))
+    with open(bundle_path, 'rb') as f:
+        lines = f.readlines()
+    # (the end of the 80th bundle, before its line ending)
+    assert((checkpoint.offset, checkpoint.skip_count) == (sum(len(line) for line in lines[:80]) - 1, 0))
+    with open(bundle_path, 'r+b') as f:
+        f.write(b'x' * checkpoint.offset)
+
+    assert(import_summary.import_bundles(db_session_maker, import_summary._iter_bundles(
+        [bundle_path], checkpoint=checkpoint), batch_size=40, checkpoint=checkpoint) == (70, 0, 0))
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(db_session.query(models.Appointment).count() == 150)
+
+
+def test_import_resumes_from_checkpoint_across_files(db_session_maker, tmp_path):
+    template = _load_input_bundle()
+
+    def _write_files(dir_name, file_count, bundles_per_file):
+        bundle_dir = tmp_path / dir_name
+        bundle_dir.mkdir()
+        for i in range(file_count):
+            with open(bundle_dir / f'b{i:02d}.ndjson', 'w') as f:
+                for _ in range(bundles_per_file):
+                    f.write(json.dumps(_make_bundle(template)) + '\n')
+        return bundle_dir
+
+    def _resume(bundle_dir, checkpoint_path):
+        checkpoint = import_summary.ImportCheckpoint(checkpoint_path)
+        return import_summary.import_bundles(db_session_maker, import_summary._iter_bundles(
+            [str(bundle_dir)], checkpoint=checkpoint), batch_size=4, checkpoint=checkpoint)
+
+    # several files per batch: the files before the last committed bundle are not read again
+    bundle_dir = _write_files('single', 10, 1)
+    checkpoint_path = str(tmp_path / 'single.checkpoint')
+    _import_interrupted(db_session_maker, [str(bundle_dir)], checkpoint_path, 8, batch_size=4)
+    checkpoint = import_summary.ImportCheckpoint(checkpoint_path)
+    assert((checkpoint.file_index, checkpoint.current_file_path) == (7, str(bundle_dir / 'b07.ndjson')))
+    for i in range(7):
+        (bundle_dir / f'b{i:02d}.ndjson').write_text('not read again')
+    assert(_resume(bundle_dir, checkpoint_path) == (2, 0, 0))
+
+    # a batch that spans several files
+    bundle_dir = _write_files('multiple', 4, 3)
+    checkpoint_path = str(tmp_path / 'multiple.checkpoint')
+    _import_interrupted(db_session_maker, [str(bundle_dir)], checkpoint_path, 5, batch_size=4)
+    checkpoint = import_summary.ImportCheckpoint(checkpoint_path)
+    assert((checkpoint.file_index, checkpoint.bundle_count) == (1, 1))
+    (bundle_dir / 'b00.ndjson').write_text('not read again')
+    assert(_resume(bundle_dir, checkpoint_path) == (8, 0, 0))
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(db_session.query(models.Appointment).count() == 10 + 12)
+        assert(db_session.query(models.QuarantinedBundle).count() == 0)
+
+    # the checkpoint does not apply to other input files
+    with open(checkpoint_path, 'w') as f:
+        json.dump(dict(file_index=3, current_file_path=str(bundle_dir / 'b00.ndjson'), bundle_count=1), f)
+    with pytest.raises(ValueError):
+        _resume(bundle_dir, checkpoint_path)
@@ -0,0 +1,63 @@
+import solution.database as db
+import solution.instrumentation as instrumentation
+from solution.controllers import (
+    PatientController,
+)
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
+
+
+def test_instrumentation_phases(db_session_maker):
+    generator = BundleGenerator(3)
+    bundles = [(f'synthetic:{i}', bundle) for i, bundle in enumerate(generator)]
+    patient_ids = list(generator.iter_patient_ids())
+
+    # nothing is recorded while the instrumentation is disabled
+    import_summary.import_bundles(db_session_maker, bundles[:1])
+    assert(instrumentation.get_stats() == {})
+
+    instrumentation.enable(db_session_maker.kw['bind'])
+    try:
+        import_summary.import_bundles(db_session_maker, bundles[1:])
+        with db.session_scope(db_session_maker) as db_session:
+            PatientController(db_session, patient_ids[0]).get_most_recent_appointment_summary()
+            list(PatientController.iter_most_recent_appointment_summaries(db_session, patient_ids))
+
+        stats = instrumentation.get_stats()
+    finally:
+        instrumentation.disable()
+
+    for name in (instrumentation.PARSE, instrumentation.USER_UPSERT, instrumentation.APPOINTMENT,
+                 instrumentation.DIAGNOSIS, instrumentation.IMPORT_BATCH, instrumentation.APPOINTMENT_SUMMARY,
+                 instrumentation.SERIALIZE):
+        assert(stats[name]['calls'] > 0)
+
+    # every bundle is parsed once
+    assert(stats[instrumentation.PARSE]['calls'] == len(bundles) - 1)
+    # every user is looked up once per bundle, the batched writes are executed on commit
+    assert(stats[instrumentation.USER_UPSERT]['calls'] == 2 * (len(bundles) - 1))
+    assert(stats[instrumentation.USER_UPSERT]['statements'] >= stats[instrumentation.USER_UPSERT]['calls'])
+    assert(stats[instrumentation.IMPORT_BATCH]['rows_written'] > 0)
+    assert(stats[instrumentation.APPOINTMENT_SUMMARY]['calls'] == 2)
+    assert(stats[instrumentation.SERIALIZE]['calls'] == 1 + len(patient_ids))
+
+    prometheus_text = instrumentation.to_prometheus(stats)
+    assert('# TYPE tendo_phase_statements_total counter' in prometheus_text)
+    assert(f'tendo_phase_calls_total{{phase="serialize"}} {1 + len(patient_ids)}' in prometheus_text)
+
+    assert(instrumentation.get_stats() == {})
+
+
+def test_instrumentation_parallel_parse(db_session_maker):
+    bundles = [(f'synthetic:{i}', bundle) for i, bundle in enumerate(BundleGenerator(5))]
+
+    instrumentation.enable(db_session_maker.kw['bind'])
+    try:
+        import_summary.import_bundles(db_session_maker, bundles, workers=2)
+        stats = instrumentation.get_stats()
+    finally:
+        instrumentation.disable()
+
+    # the bundles parsed by the worker processes are reported by the calling process
+    assert(stats[instrumentation.PARSE]['calls'] == len(bundles))
+    assert(stats[instrumentation.PARSE]['secs'] > 0)
@@ -0,0 +1,107 @@
+import uuid
+import sqlalchemy as sa
+from sqlalchemy import create_engine
+import solution.database as db
+import solution.migrations as migrations
+import solution.search as search
+from solution.controllers import (
+    PatientController,
+)
+
+
+def test_convert_uuid_keys(tmp_path):
+    db_engine = create_engine(f'sqlite:///{tmp_path / "legacy.db"}')
+    session_maker = db.get_session_maker(db_engine)
+
+    # rows written by the former String(36) id columns
+    patient_id = str(uuid.uuid4())
+    doctor_id = str(uuid.uuid4())
+    appt_id = str(uuid.uuid4())
+    survey_id = str(uuid.uuid4())
+    with db_engine.begin() as connection:
+        # (the former Appointment table had no end time nor duration class)
+        connection.execute(sa.text('ALTER TABLE Appointment DROP COLUMN end_time_ts'))
+        connection.execute(sa.text('DROP INDEX ix_Appointment_actor_id_duration_class_start_time_ts'))
+        connection.execute(sa.text('ALTER TABLE Appointment DROP COLUMN duration_class'))
+        # (nor a search rowid of the surveys, the full-text index of the surveys was keyed by their rowid)
+        connection.execute(sa.text('DROP INDEX ix_PostAppointmentSurvey_search_rowid'))
+        connection.execute(sa.text('ALTER TABLE PostAppointmentSurvey DROP COLUMN search_rowid'))
+        connection.execute(sa.text('DROP TABLE PostAppointmentSurveySearch'))
+        connection.execute(sa.text(
+            "CREATE VIRTUAL TABLE PostAppointmentSurveySearch USING fts5(diagnosis_feedback, patient_feeling, "
+            "content='PostAppointmentSurvey', content_rowid='rowid')"))
+        connection.execute(sa.text(
+            "INSERT INTO User (id, user_type, is_active) VALUES (:patient_id, 'patient', 1), "
+            "(:doctor_id, 'doctor', 1)"), dict(patient_id=patient_id, doctor_id=doctor_id))
+        connection.execute(sa.text(
+            "INSERT INTO UserName (id, user_id, family_name) VALUES (1, :doctor_id, 'Careful')"),
+            dict(doctor_id=doctor_id))
+        connection.execute(sa.text(
+            "INSERT INTO UserGivenName (user_name_id, given_name) VALUES (1, 'Adam')"))
+        connection.execute(sa.text(
+            "INSERT INTO Appointment (id, start_time_ts, duration_secs, status, actor_id, subject_id) "
+            "VALUES (:appt_id, 1617363000, 1800, 'finished', :doctor_id, :patient_id)"),
+            dict(appt_id=appt_id, doctor_id=doctor_id, patient_id=patient_id))
+        connection.execute(sa.text(
+            "INSERT INTO PostAppointmentSurvey (id, appointment_id, recommendation_rating, is_diagnosis_explained, "
+            "diagnosis_feedback) VALUES (:survey_id, :appt_id, 10, 1, 'Clearly explained')"),
+            dict(survey_id=survey_id, appt_id=appt_id))
+
+    migrated_row_counts = dict(migrations.upgrade(db_engine))
+    assert(migrated_row_counts['binary_uuid_keys'] == 5)
+    assert(migrated_row_counts['appointment_end_time'] == 1)
+    # (a 30 minutes appointment is of duration class 1)
+    assert(migrated_row_counts['appointment_duration_class'] == 1)
+    assert(migrated_row_counts['survey_search_rowid'] == 1)
+    # the existing users, appointment and survey are logged as changed
+    assert(migrated_row_counts['change_log_seed'] == 4)
+    # the existing names and survey are indexed
+    assert(migrated_row_counts['search_indexes'] == 2)
+    assert(migrated_row_counts['patient_lookup_tokens'] == 2)
+    # the weekly and all time rollups of the doctor
+    assert(migrated_row_counts['survey_rollups'] == 2)
+
+    migrated_row_counts = dict(migrations.upgrade(db_engine))
+    assert(migrated_row_counts['binary_uuid_keys'] == 0)
+    assert(migrated_row_counts['appointment_end_time'] == 0)
+    assert(migrated_row_counts['appointment_duration_class'] == 0)
+    assert(migrated_row_counts['survey_search_rowid'] == 0)
+    assert(migrated_row_counts['change_log_seed'] == 0)
+    assert(migrated_row_counts['search_indexes'] == 0)
+    assert(migrated_row_counts['patient_lookup_tokens'] == 0)
+    assert(migrated_row_counts['survey_rollups'] == 0)
+
+    with db_engine.connect() as connection:
+        assert(connection.execute(sa.text("SELECT DISTINCT typeof(user_id) FROM UserName")).scalar() == 'blob')
+
+    with db.session_scope(session_maker) as db_session:
+        appt_summary = PatientController(db_session, patient_id).get_most_recent_appointment_summary()
+
+    assert(appt_summary['appointment']['id'] == appt_id)
+    assert(appt_summary['appointment']['end_time'] == '2021-04-02T12:00:00Z')
+    assert(appt_summary['patient']['id'] == patient_id)
+    assert(appt_summary['doctor']['names'][0]['first_name'] == 'Adam')
+
+    # the survey is indexed by its new key
+    with db.session_scope(session_maker) as db_session:
+        assert([s['survey_id'] for s in search.search_surveys(db_session, 'explained')] == [survey_id])
+
+
+def test_create_missing_indexes(tmp_path):
+    db_engine = create_engine(f'sqlite:///{tmp_path / "legacy.db"}')
+    db.get_session_maker(db_engine)
+
+    # indexes missing from a database created by a former DB Schema
+    with db_engine.begin() as connection:
+        connection.execute(sa.text('DROP INDEX "ix_UserName_user_id"'))
+        connection.execute(sa.text('DROP INDEX "ix_Appointment_subject_id_start_time_ts"'))
+
+    assert(dict(migrations.upgrade(db_engine))['foreign_key_indexes'] == 2)
+    assert(dict(migrations.upgrade(db_engine))['foreign_key_indexes'] == 0)
+
+    with db_engine.connect() as connection:
+        plan = connection.execute(sa.text(
+            'EXPLAIN QUERY PLAN SELECT id FROM Appointment WHERE subject_id = :subject_id '
+            'ORDER BY start_time_ts DESC LIMIT 1'), dict(subject_id=uuid.uuid4().bytes)).fetchall()
+
+    assert(plan[0][-1].startswith('SEARCH Appointment USING'))
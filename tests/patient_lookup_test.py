@@ -0,0 +1,63 @@
+import datetime
+import solution.database as db
+import solution.patient_lookup as patient_lookup
+from solution.enums import (
+    ContactSystem,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+    PatientController,
+)
+
+
+def _find_patient_ids(db_session_maker, **kwargs):
+    with db.session_scope(db_session_maker) as db_session:
+        return [patient['id'] for patient in PatientController.find_patients(db_session, **kwargs)]
+
+
+def test_normalization():
+    assert(patient_lookup.get_name_tokens('Émile Zola-Dupré', None, 'ÉMILE') == ['emile', 'zola', 'dupre'])
+    assert(patient_lookup.get_contact_token(' (555) 555-2021 ') == '5555552021')
+    assert(patient_lookup.get_contact_token('CK.Hsu@Example.com') == 'ck.hsu@example.com')
+
+
+def test_find_patients(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        patient_obj_builder = UserObjectBuilder(db_session)
+        patient_obj_builder.set_birth_date(datetime.date(1985, 4, 1))
+        patient_obj_builder.add_name(family_name='Hsu', name_text='Chia-kai Hsu', given_names=['Chia-kai'])
+        patient_obj_builder.add_contact_info(system=ContactSystem.phone, name='mobile', value='555-555-2021')
+        patient_id = patient_obj_builder.object_id
+
+        other_patient_obj_builder = UserObjectBuilder(db_session)
+        other_patient_obj_builder.set_birth_date(datetime.date(1985, 4, 1))
+        other_patient_obj_builder.add_name(family_name='Hué', name_text='Chiara Hué', given_names=['Chiara'])
+        other_patient_id = other_patient_obj_builder.object_id
+
+    # prefix of every word, case and accent insensitive, combined with the birth date and contact value
+    assert(sorted(_find_patient_ids(db_session_maker, name='chi h')) == sorted([patient_id, other_patient_id]))
+    assert(_find_patient_ids(db_session_maker, name='CHIA HS') == [patient_id])
+    assert(_find_patient_ids(db_session_maker, name='hue') == [other_patient_id])
+    assert(len(_find_patient_ids(db_session_maker, birth_date='1985-04-01')) == 2)
+    assert(_find_patient_ids(db_session_maker, name='chi', contact='(555) 555 2021') == [patient_id])
+    assert(_find_patient_ids(db_session_maker, name='chi', birth_date='1985-04-02') == [])
+    assert(_find_patient_ids(db_session_maker, name='chi', limit=1) in ([patient_id], [other_patient_id]))
+    assert(_find_patient_ids(db_session_maker) == [])
+
+    # the tokens follow the changes of the names and contact info
+    with db.session_scope(db_session_maker) as db_session:
+        patient_obj_builder = UserObjectBuilder(db_session, object_id=patient_id)
+        patient_obj_builder.set_names([
+            dict(family_name='Hsu', name_text='CK Hsu', given_names=['CK']),
+            dict(family_name='Tenderson', name_text='Tendo Tenderson', given_names=['Tendo']),
+        ])
+        patient_obj_builder.set_contact_info([
+            dict(system=ContactSystem.email, name='personal', value='ck@example.com'),
+        ])
+        UserObjectBuilder(db_session, object_id=other_patient_id).clear_names()
+
+    assert(_find_patient_ids(db_session_maker, name='chi') == [])
+    assert(_find_patient_ids(db_session_maker, name='ck hsu') == [patient_id])
+    assert(_find_patient_ids(db_session_maker, name='tend') == [patient_id])
+    assert(_find_patient_ids(db_session_maker, contact='5555552021') == [])
+    assert(_find_patient_ids(db_session_maker, contact='CK@example.com') == [patient_id])
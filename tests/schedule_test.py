@@ -0,0 +1,148 @@
+import pytest
+import sqlalchemy.orm as orm
+import solution.database as db
+import solution.models as models
+import solution.schedule as schedule
+from solution.enums import (
+    UserType,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+    AppointmentObjectBuilder,
+    DoctorScheduleController,
+)
+
+
+HOUR = 3600
+
+
+def _add_appointment(db_session, doctor_id, start_ts, duration_secs):
+    appt_obj_builder = AppointmentObjectBuilder(db_session)
+    appt_obj_builder.set_doctor_id(doctor_id)
+    appt_obj_builder.set_appointment_time(start_ts, duration_secs)
+
+    return appt_obj_builder.object_id
+
+
+def test_get_free_slots():
+    busy_intervals = [(10, 20), (15, 30), (40, 45), (90, 200)]
+    assert(schedule.get_free_slots(busy_intervals, 0, 100, 10) == [(0, 10), (30, 40), (45, 90)])
+    assert(schedule.get_free_slots(busy_intervals, 0, 100, 20) == [(45, 90)])
+    assert(schedule.get_free_slots(busy_intervals, 25, 35, 1) == [(30, 35)])
+    assert(schedule.get_free_slots([], 0, 100, 100) == [(0, 100)])
+
+
+def test_appointment_end_time(db_session_maker):
+    # the end time is derived whenever an appointment is written, with or without the object builder
+    with db.session_scope(db_session_maker) as db_session:
+        appt_obj = models.Appointment(id=models.new_object_id(), start_time_ts=9 * HOUR)
+        db_session.add(appt_obj)
+        db_session.flush()
+        assert(appt_obj.end_time_ts == 9 * HOUR + models.DEFAULT_APPOINTMENT_DURATION_SECS)
+
+        appt_obj.duration_secs = 2 * HOUR
+        db_session.flush()
+        assert(appt_obj.end_time_ts == 11 * HOUR)
+        assert('end_time_ts' not in appt_obj.to_dict(db_session))
+
+
+def test_doctor_schedule(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        doctor_ids = []
+        for _ in range(2):
+            doctor_obj_builder = UserObjectBuilder(db_session)
+            doctor_obj_builder.set_user_type(UserType.doctor)
+            doctor_ids.append(doctor_obj_builder.object_id)
+
+        appt_ids = [
+            _add_appointment(db_session, doctor_ids[0], 9 * HOUR, HOUR),
+            _add_appointment(db_session, doctor_ids[0], 10 * HOUR, 2 * HOUR),
+            # a long appointment, it overlaps ranges that start long after its start time
+            _add_appointment(db_session, doctor_ids[0], 13 * HOUR, 8 * HOUR),
+            _add_appointment(db_session, doctor_ids[1], 9 * HOUR, HOUR),
+        ]
+
+    with db.session_scope(db_session_maker) as db_session:
+        controller = DoctorScheduleController(db_session, doctor_ids[0])
+
+        appts = controller.get_appointments(10 * HOUR, 14 * HOUR)
+        assert([appt['id'] for appt in appts] == appt_ids[1:3])
+        assert(appts[0]['end_time'] == '1970-01-01T12:00:00Z')
+        assert('end_time_ts' not in appts[0])
+        assert([appt['id'] for appt in controller.get_appointments(20 * HOUR, 22 * HOUR)] == [appt_ids[2]])
+        assert(controller.get_appointments(22 * HOUR, 23 * HOUR) == [])
+
+        # the end time is excluded: back to back appointments don't conflict
+        assert(controller.find_conflicts(11 * HOUR, 2 * HOUR) == [appt_ids[1]])
+        assert(controller.find_conflicts(11 * HOUR, 2 * HOUR + 1) == appt_ids[1:3])
+        assert(controller.is_available(12 * HOUR, HOUR))
+        assert(not controller.is_available(8 * HOUR + 1800, HOUR))
+        # an appointment being rescheduled doesn't conflict with itself
+        assert(not controller.is_available(9 * HOUR + 1800, HOUR, appointment_id=appt_ids[1]))
+        assert(controller.is_available(10 * HOUR, 2 * HOUR, appointment_id=appt_ids[1]))
+
+        assert(controller.find_free_slots(8 * HOUR, 18 * HOUR, HOUR) == [(8 * HOUR, 9 * HOUR), (12 * HOUR, 13 * HOUR)])
+        assert(DoctorScheduleController.find_doctors_free_slots(db_session, doctor_ids, 9 * HOUR, 11 * HOUR, HOUR) == {
+            doctor_ids[0]: [],
+            doctor_ids[1]: [(10 * HOUR, 11 * HOUR)],
+        })
+
+        with pytest.raises(orm.exc.NoResultFound):
+            DoctorScheduleController(db_session, appt_ids[0])
+
+    # a rescheduled appointment moves its end time along
+    with db.session_scope(db_session_maker) as db_session:
+        AppointmentObjectBuilder(db_session, object_id=appt_ids[2]).set_appointment_time(15 * HOUR, HOUR)
+        assert(DoctorScheduleController(db_session, doctor_ids[0]).find_free_slots(12 * HOUR, 18 * HOUR, HOUR) == [
+            (12 * HOUR, 15 * HOUR), (16 * HOUR, 18 * HOUR)])
+
+
+def _count_vm_steps(db_session, fn):
+    # number of SQLite virtual machine instructions run by fn, which grows with the number of index entries it reads
+    steps = [0]
+
+    def _progress_handler():
+        steps[0] += 1
+
+    dbapi_connection = db_session.connection().connection
+    dbapi_connection.set_progress_handler(_progress_handler, 1)
+    try:
+        fn()
+    finally:
+        dbapi_connection.set_progress_handler(None, 1)
+
+    return steps[0]
+
+
+def test_doctor_schedule_duration_outlier(db_session_maker):
+    day = 24 * HOUR
+    range_start_ts = 400 * day
+    with db.session_scope(db_session_maker) as db_session:
+        doctor_ids = []
+        for _ in range(2):
+            doctor_obj_builder = UserObjectBuilder(db_session)
+            doctor_obj_builder.set_user_type(UserType.doctor)
+            doctor_ids.append(doctor_obj_builder.object_id)
+
+        # a single appointment of a year, of another doctor
+        outlier_appt_id = _add_appointment(db_session, doctor_ids[1], range_start_ts - 300 * day, 365 * day)
+        appt_id = _add_appointment(db_session, doctor_ids[0], range_start_ts + HOUR, HOUR)
+
+    with db.session_scope(db_session_maker) as db_session:
+        controller = DoctorScheduleController(db_session, doctor_ids[0])
+        assert([appt['id'] for appt in controller.get_appointments(range_start_ts, range_start_ts + day)] == [appt_id])
+        assert([appt['id'] for appt in DoctorScheduleController(db_session, doctor_ids[1]).get_appointments(
+            range_start_ts, range_start_ts + day)] == [outlier_appt_id])
+        steps = _count_vm_steps(db_session, lambda: controller.get_appointments(range_start_ts, range_start_ts + day))
+
+    # the doctor's appointments of the previous months are not read, though the outlier overlaps the range from
+    # the year before
+    with db.session_scope(db_session_maker) as db_session:
+        for i in range(300):
+            _add_appointment(db_session, doctor_ids[0], range_start_ts - 100 * day + i * 8 * HOUR, HOUR)
+
+    with db.session_scope(db_session_maker) as db_session:
+        controller = DoctorScheduleController(db_session, doctor_ids[0])
+        assert([appt['id'] for appt in controller.get_appointments(range_start_ts, range_start_ts + day)] == [appt_id])
+        assert(_count_vm_steps(
+            db_session, lambda: controller.get_appointments(range_start_ts, range_start_ts + day)) < steps + 300)
@@ -0,0 +1,113 @@
+import pytest
+import sqlalchemy as sa
+import solution.database as db
+import solution.batching as batching
+import solution.search as search
+from solution.controllers import (
+    UserObjectBuilder,
+    AppointmentObjectBuilder,
+    PostAppointmentSurveyObjectBuilder,
+)
+
+
+def _check_indexes(db_session_maker):
+    # raises if an index doesn't match its table
+    with db_session_maker.kw['bind'].begin() as connection:
+        for index in search.INDEXES:
+            connection.exec_driver_sql(f"INSERT INTO {index.name}({index.name}) VALUES('integrity-check')")
+
+
+def _add_appointment(db_session, patient_id, start_time_ts, reason_texts):
+    appt_obj_builder = AppointmentObjectBuilder(db_session)
+    appt_obj_builder.set_patient_id(patient_id)
+    appt_obj_builder.set_appointment_time(start_time_ts, 1800)
+    appt_obj_builder.set_reasons(reason_texts)
+
+    return appt_obj_builder.object_id
+
+
+def _search_appointment_ids(db_session_maker, text, **kwargs):
+    with db.session_scope(db_session_maker) as db_session:
+        return [result['appointment_id'] for result in search.search_appointments(db_session, text, **kwargs)]
+
+
+def test_search(db_session_maker):
+    with db.session_scope(db_session_maker) as db_session:
+        patient_obj_builder = UserObjectBuilder(db_session)
+        patient_obj_builder.add_name(family_name='Tenderson', name_text='Tendo Tenderson', given_names=['Tendo'])
+        patient_id = patient_obj_builder.object_id
+
+        old_appt_id = _add_appointment(db_session, patient_id, 1000, ['Endocrinologist referral'])
+        appt_id = _add_appointment(db_session, patient_id, 5000, ['Follow up', 'endocrinologist, endocrinologist'])
+        other_appt_id = _add_appointment(db_session, patient_id, 6000, ['Dentist'])
+
+        survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+        survey_obj_builder.set_appointment_id(appt_id)
+        survey_obj_builder.set_diagnosis_feedback('The diagnosis was clearly explained', True)
+        survey_id = survey_obj_builder.object_id
+
+    _check_indexes(db_session_maker)
+
+    # ranked (best match first), by word prefix, filtered by start time and paginated
+    assert(_search_appointment_ids(db_session_maker, 'ENDOCRINO') == [appt_id, old_appt_id])
+    assert(_search_appointment_ids(db_session_maker, 'endocrinologist', since_ts=2000) == [appt_id])
+    assert(_search_appointment_ids(db_session_maker, 'endocrinologist', page=2, page_size=1) == [old_appt_id])
+    assert(_search_appointment_ids(db_session_maker, 'follow up') == [appt_id])
+    assert(_search_appointment_ids(db_session_maker, '"*') == [])
+
+    with db.session_scope(db_session_maker) as db_session:
+        patients = search.search_patients(db_session, 'tendo')
+        assert([(p['user_id'], p['name_text']) for p in patients] == [(patient_id, 'Tendo Tenderson')])
+        surveys = search.search_surveys(db_session, 'explained')
+        assert([(s['survey_id'], s['appointment_id']) for s in surveys] == [(survey_id, appt_id)])
+
+    # changed rows are indexed again, the changes of a rolled back savepoint are not
+    with db.session_scope(db_session_maker) as db_session:
+        AppointmentObjectBuilder(db_session, object_id=old_appt_id).set_reasons(['Annual checkup'])
+        AppointmentObjectBuilder(db_session, object_id=other_appt_id).add_reason('Endocrinologist')
+        PostAppointmentSurveyObjectBuilder(db_session, object_id=survey_id).set_patient_feeling('Relieved')
+
+        with pytest.raises(ValueError):
+            with batching.savepoint(db_session):
+                AppointmentObjectBuilder(db_session, object_id=appt_id).clear_reasons()
+                UserObjectBuilder(db_session, object_id=patient_id).clear_names()
+                raise ValueError()
+
+    _check_indexes(db_session_maker)
+    assert(_search_appointment_ids(db_session_maker, 'endocrinologist') == [appt_id, other_appt_id])
+    assert(_search_appointment_ids(db_session_maker, 'checkup') == [old_appt_id])
+    with db.session_scope(db_session_maker) as db_session:
+        assert([p['user_id'] for p in search.search_patients(db_session, 'tenderson')] == [patient_id])
+        assert([s['survey_id'] for s in search.search_surveys(db_session, 'relieved explained')] == [survey_id])
+
+    # the rows written without the object builders are indexed by a rebuild
+    with db_session_maker.kw['bind'].begin() as connection:
+        connection.execute(sa.text("UPDATE AppointmentReason SET reason_text = 'Cardiologist'"))
+        assert(search.rebuild_indexes(connection)[search.APPOINTMENT_REASONS.name] == 5)
+
+    _check_indexes(db_session_maker)
+    assert(_search_appointment_ids(db_session_maker, 'endocrinologist') == [])
+    assert(len(_search_appointment_ids(db_session_maker, 'cardiologist')) == 3)
+
+
+def test_search_surveys_after_rowid_change(tmp_path):
+    db_engine = db.create_engine(f'sqlite:///{tmp_path / "surveys.db"}')
+    session_maker = db.get_session_maker(db_engine)
+    with db.session_scope(session_maker) as db_session:
+        survey_ids = []
+        for feeling in ('Anxious', 'Relieved', 'Relieved and grateful'):
+            survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+            survey_obj_builder.set_patient_feeling(feeling)
+            survey_ids.append(survey_obj_builder.object_id)
+
+    # the rowids of a table without an integer primary key may be renumbered (e.g. by VACUUM), the index entries
+    # are keyed by a column of their own
+    with db_engine.begin() as connection:
+        connection.execute(sa.text('UPDATE PostAppointmentSurvey SET rowid = 100 - rowid'))
+    with db_engine.connect() as connection:
+        connection.exec_driver_sql('VACUUM')
+
+    _check_indexes(session_maker)
+    with db.session_scope(session_maker) as db_session:
+        assert(sorted(s['survey_id'] for s in search.search_surveys(db_session, 'relieved')) == sorted(survey_ids[1:]))
+        assert([s['survey_id'] for s in search.search_surveys(db_session, 'grateful')] == [survey_ids[2]])
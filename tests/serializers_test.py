@@ -0,0 +1,80 @@
+import datetime
+import sqlalchemy as sa
+import solution.database as db
+import solution.models as models
+import solution.serializers as serializers
+from solution.controllers import (
+    PostAppointmentSurveyObjectBuilder,
+)
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
+
+
+def _utc_datetime(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc)
+
+
+def _reference_to_dict(obj):
+    # the former (introspecting) DBObjectBase.to_dict and its overrides
+    result = {c.key: getattr(obj, c.key) for c in sa.inspect(obj).mapper.column_attrs}
+    if isinstance(obj, models.User):
+        result.update(dict(
+            birth_date=obj.birth_date.strftime('%Y-%m-%d') if obj.birth_date else '',
+            names=[
+                dict(last_name=n.family_name, first_name=g.given_name, name_text=n.name_text)
+                for n in obj.names for g in n.given_names
+            ],
+            contact_info=[dict(system=c.system, name=c.name, value=c.value) for c in obj.contact_info],
+        ))
+    elif isinstance(obj, models.Appointment):
+        # (derived for the time range queries, not part of the API)
+        del result['end_time_ts']
+        del result['duration_class']
+        result.update(dict(
+            start_time=_utc_datetime(obj.start_time_ts).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            end_time=_utc_datetime(
+                obj.start_time_ts + obj.duration_secs).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            reasons=[r.reason_text for r in obj.reasons],
+        ))
+    elif isinstance(obj, models.PostAppointmentSurvey):
+        # (the key of the full-text index entries, not part of the API)
+        del result['search_rowid']
+    elif isinstance(obj, models.Diagnosis):
+        result.update(dict(
+            last_updated_time=_utc_datetime(obj.last_updated_ts).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            codes=[_reference_to_dict(d.code) for d in obj.details if d.code],
+        ))
+
+    return result
+
+
+def test_serializers(db_session_maker):
+    generator = BundleGenerator(20)
+    import_summary.import_bundles(db_session_maker, [(f'synthetic:{i}', b) for i, b in enumerate(generator)])
+    with db.session_scope(db_session_maker) as db_session:
+        survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+        survey_obj_builder.set_appointment_id(db_session.query(models.Appointment.id).limit(1).scalar())
+        survey_obj_builder.set_diagnosis_feedback('Clear', is_diagnosis_explained=True)
+
+    with db.session_scope(db_session_maker) as db_session:
+        for model in (models.User, models.Appointment, models.Diagnosis, models.DiagnosisCode,
+                      models.PostAppointmentSurvey, models.ImportLedger):
+            objs = db_session.query(model).all()
+            assert(objs)
+            expected_dicts = [_reference_to_dict(obj) for obj in objs]
+
+            # same output (keys in the same order) from ORM objects and from result rows
+            obj_dicts = [obj.to_dict(db_session) for obj in objs]
+            assert([list(d.items()) for d in obj_dicts] == [list(d.items()) for d in expected_dicts])
+
+            serializer = serializers.get_serializer(model)
+            rows = db_session.execute(serializer.select()).all()
+            row_dicts = {str(d[sa.inspect(model).primary_key[0].key]): d
+                         for d in serializers.serialize_rows(db_session, model, rows)}
+            for expected_dict in expected_dicts:
+                expected_id = str(expected_dict[sa.inspect(model).primary_key[0].key])
+                assert(list(row_dicts[expected_id].items()) == list(expected_dict.items()))
+
+    for ts in (0, 1617363000, 1617363000 + 1800, 2 ** 31 + 1):
+        assert(serializers.timestamp_to_utc_datetime_str(ts) ==
+               _utc_datetime(ts).strftime('%Y-%m-%dT%H:%M:%SZ'))
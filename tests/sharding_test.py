@@ -0,0 +1,84 @@
+import copy
+import collections
+import sqlalchemy as sa
+import solution.database as db
+import solution.models as models
+import solution.sharding as sharding
+from solution.enums import (
+    UserType,
+)
+from solution.controllers import (
+    PatientController,
+)
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
+
+
+def test_get_shard_index():
+    patient_ids = list(BundleGenerator(1000).iter_patient_ids())
+    shard_counts = collections.Counter(sharding.get_shard_index(patient_id, 4) for patient_id in patient_ids)
+
+    assert(sorted(shard_counts) == [0, 1, 2, 3])
+    assert(min(shard_counts.values()) > 200)
+    # stable
+    assert([sharding.get_shard_index(patient_id, 4) for patient_id in patient_ids[:10]] == [
+        sharding.get_shard_index(patient_id.upper(), 4) for patient_id in patient_ids[:10]])
+
+
+def test_sharded_import(db_session_maker, tmp_path):
+    generator = BundleGenerator(40, doctor_count=3)
+    bundles = [(f'synthetic:{i}', b) for i, b in enumerate(generator)]
+    patient_ids = list(generator.iter_patient_ids())
+
+    # a bundle whose diagnosis code can't be written to the reference database (a code without name)
+    bad_bundle = copy.deepcopy(bundles[5][1])
+    bad_bundle['id'] = 'bad-bundle'
+    for entry in bad_bundle['entry']:
+        if entry['resource']['resourceType'] == 'Diagnosis':
+            entry['resource']['code']['coding'] = [dict(system='icd-10', code='X99')]
+    bundles[5] = ('synthetic:5', bad_bundle)
+
+    sharded_db = sharding.ShardedDatabase.from_url_template(
+        f'sqlite:///{tmp_path}/shard{{shard}}.db', 3, f'sqlite:///{tmp_path}/reference.db', 'bulk_load')
+    assert(import_summary.import_sharded_bundles(sharded_db, bundles, batch_size=10) == (len(bundles) - 1, 0, 1))
+    import_summary.import_bundles(db_session_maker, bundles)
+
+    # the bad bundle is quarantined in the shard of its patient, the other bundles of its batch are imported
+    resources = {entry['resource']['resourceType']: entry['resource'] for entry in bad_bundle['entry']}
+    with sharded_db.session_scope(resources['Patient']['id']) as db_session:
+        assert([q.bundle_id for q in db_session.query(models.QuarantinedBundle)] == ['bad-bundle'])
+        assert(db_session.get(models.Appointment, resources['Appointment']['id']) is None)
+
+    # every patient (and their appointments) lives in the shard of the patient only
+    for shard_index, session_maker in enumerate(sharded_db.shard_session_makers):
+        with db.session_scope(session_maker) as db_session:
+            subject_ids = db_session.execute(sa.select(models.Appointment.subject_id).distinct()).scalars().all()
+        assert(subject_ids)
+        assert({sharded_db.get_shard_index(subject_id) for subject_id in subject_ids} == {shard_index})
+
+    # the doctors and diagnosis codes are in the reference database
+    with db.session_scope(db_session_maker) as db_session:
+        doctor_count = db_session.query(models.User).filter_by(user_type=UserType.doctor).count()
+        code_count = db_session.query(models.DiagnosisCode).count()
+    with db.session_scope(sharded_db.reference_session_maker) as db_session:
+        assert(db_session.query(models.User).count() == doctor_count == 3)
+        assert(db_session.query(models.DiagnosisCode).count() == code_count)
+
+    # the requests are routed to the shard of the patient
+    with db.session_scope(db_session_maker) as db_session:
+        expected_summaries = list(PatientController.iter_most_recent_appointment_summaries(db_session, patient_ids))
+    summaries = list(PatientController.iter_sharded_most_recent_appointment_summaries(
+        sharded_db, patient_ids, batch_size=7))
+    with PatientController.sharded(sharded_db, patient_ids[0]) as patient_controller:
+        summary = patient_controller.get_most_recent_appointment_summary()
+
+    # the shards hold the diagnosis codes with their ids in the reference database
+    with db.session_scope(sharded_db.reference_session_maker) as db_session:
+        code_ids = dict(db_session.execute(sa.select(models.DiagnosisCode.code, models.DiagnosisCode.id)).all())
+    for _, expected_summary in expected_summaries:
+        for code in expected_summary['diagnosis']['codes']:
+            code['id'] = code_ids[code['code']]
+    assert(summaries == expected_summaries)
+    assert(summary == expected_summaries[0][1])
+
+    sharded_db.dispose()
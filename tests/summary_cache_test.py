@@ -0,0 +1,58 @@
+import solution.database as db
+import solution.summary_cache as summary_cache
+from solution.controllers import (
+    UserObjectBuilder,
+    PostAppointmentSurveyObjectBuilder,
+    PatientController,
+)
+from benchmarks.synthetic_data import BundleGenerator
+import import_summary
+
+
+def _get_summary(db_session_maker, patient_id):
+    with db.session_scope(db_session_maker) as db_session:
+        return PatientController(db_session, patient_id).get_most_recent_appointment_summary()
+
+
+def test_summary_cache(db_session_maker, executed_statements, tmp_path):
+    generator = BundleGenerator(3)
+    import_summary.import_bundles(db_session_maker, [(f'synthetic:{i}', b) for i, b in enumerate(generator)])
+    patient_ids = list(generator.iter_patient_ids())
+
+    cache = summary_cache.configure(db_session_maker.kw['bind'], max_size=100)
+
+    # repeat reads are served from the cache (the patient is only looked up)
+    summary = _get_summary(db_session_maker, patient_ids[0])
+    del executed_statements[:]
+    assert(_get_summary(db_session_maker, patient_ids[0]) == summary)
+    assert(not [s for s, _ in executed_statements if '"Appointment"' in s])
+    assert(cache.get_stats()['hits'] == 1)
+
+    # a session with uncommitted changes sees them, the summary is invalidated on commit
+    with db.session_scope(db_session_maker) as db_session:
+        survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+        survey_obj_builder.set_appointment_id(summary['appointment']['id'])
+        survey_obj_builder.set_recommendation_rating(9)
+
+        summary = PatientController(db_session, patient_ids[0]).get_most_recent_appointment_summary()
+        assert(summary['survey']['recommendation_rating'] == 9)
+
+    assert(len(cache) == 0)
+    assert(_get_summary(db_session_maker, patient_ids[0]) == summary)
+
+    # changes of a doctor invalidate the summaries of the doctor's patients
+    for patient_id in patient_ids:
+        _get_summary(db_session_maker, patient_id)
+    doctor_id = summary['doctor']['id']
+    with db.session_scope(db_session_maker) as db_session:
+        UserObjectBuilder(db_session, object_id=doctor_id).set_is_active(False)
+
+    assert(len(cache) == 0)
+    assert(_get_summary(db_session_maker, patient_ids[0])['doctor']['is_active'] is False)
+
+    # the cache can be persisted between runs
+    cache.save(str(tmp_path / 'summaries.cache'))
+    cache = summary_cache.configure(db_session_maker.kw['bind'], file_path=str(tmp_path / 'summaries.cache'))
+    assert(len(cache) == 1)
+    assert(_get_summary(db_session_maker, patient_ids[0])['doctor']['is_active'] is False)
+    assert(cache.get_stats()['hit_rate'] == 1.0)
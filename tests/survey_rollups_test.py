@@ -0,0 +1,100 @@
+import pytest
+import sqlalchemy as sa
+import solution.database as db
+import solution.models as models
+import solution.batching as batching
+import solution.survey_rollups as survey_rollups
+from solution.enums import (
+    UserType,
+)
+from solution.controllers import (
+    UserObjectBuilder,
+    AppointmentObjectBuilder,
+    PostAppointmentSurveyObjectBuilder,
+)
+
+
+WEEK = survey_rollups.BUCKET_SECS
+# a Monday, 00:00 UTC
+MONDAY_TS = 1617580800
+
+
+def _add_survey(db_session, appt_id, rating, is_diagnosis_explained):
+    survey_obj_builder = PostAppointmentSurveyObjectBuilder(db_session)
+    survey_obj_builder.set_appointment_id(appt_id)
+    survey_obj_builder.set_recommendation_rating(rating)
+    survey_obj_builder.set_diagnosis_feedback(None, is_diagnosis_explained)
+
+    return survey_obj_builder.object_id
+
+
+def _get_rollups(db_session):
+    table = models.DoctorSurveyRollup.__table__
+    return {
+        (row['doctor_id'], row['bucket_ts']): tuple(row[key] for key in survey_rollups._COUNT_KEYS)
+        for row in db_session.execute(sa.select(table).where(table.c.survey_count != 0)).mappings()
+    }
+
+
+def test_survey_rollups(db_session_maker):
+    assert(survey_rollups.get_bucket_ts(MONDAY_TS + WEEK - 1) == MONDAY_TS)
+
+    with db.session_scope(db_session_maker) as db_session:
+        doctor_ids = []
+        for _ in range(2):
+            doctor_obj_builder = UserObjectBuilder(db_session)
+            doctor_obj_builder.set_user_type(UserType.doctor)
+            doctor_ids.append(doctor_obj_builder.object_id)
+
+        appt_ids = []
+        for start_ts in (MONDAY_TS + 3600, MONDAY_TS + WEEK + 3600):
+            appt_obj_builder = AppointmentObjectBuilder(db_session)
+            appt_obj_builder.set_doctor_id(doctor_ids[0])
+            appt_obj_builder.set_appointment_time(start_ts, 1800)
+            appt_ids.append(appt_obj_builder.object_id)
+
+        survey_ids = [
+            _add_survey(db_session, appt_ids[0], 10, True),
+            _add_survey(db_session, appt_ids[0], 5, False),
+            _add_survey(db_session, appt_ids[1], 8, True),
+        ]
+
+    with db.session_scope(db_session_maker) as db_session:
+        scores = survey_rollups.get_doctor_scores(db_session, doctor_ids)
+        assert(scores[doctor_ids[0]]['survey_count'] == 3)
+        assert(scores[doctor_ids[0]]['average_rating'] == 23 / 3)
+        assert(scores[doctor_ids[0]]['net_promoter_score'] == 0)
+        assert(scores[doctor_ids[0]]['explained_rate'] == 2 / 3)
+        assert(scores[doctor_ids[1]]['survey_count'] == 0)
+        assert(scores[doctor_ids[1]]['net_promoter_score'] is None)
+
+        weekly_scores = survey_rollups.get_doctor_weekly_scores(db_session, doctor_ids[0])
+        assert([(s['bucket_ts'], s['survey_count'], s['promoter_count']) for s in weekly_scores] == [
+            (MONDAY_TS, 2, 1), (MONDAY_TS + WEEK, 1, 0)])
+        assert([s['bucket_ts'] for s in survey_rollups.get_doctor_weekly_scores(
+            db_session, doctor_ids[0], since_ts=MONDAY_TS + WEEK + 1)] == [MONDAY_TS + WEEK])
+
+    # changed surveys and appointments move their contributions
+    with db.session_scope(db_session_maker) as db_session:
+        PostAppointmentSurveyObjectBuilder(db_session, object_id=survey_ids[1]).set_recommendation_rating(9)
+        PostAppointmentSurveyObjectBuilder(db_session, object_id=survey_ids[1]).set_diagnosis_feedback(None, True)
+        AppointmentObjectBuilder(db_session, object_id=appt_ids[1]).set_doctor_id(doctor_ids[1])
+        # the changes of a rolled back savepoint are left out
+        with pytest.raises(ValueError):
+            with batching.savepoint(db_session):
+                PostAppointmentSurveyObjectBuilder(db_session, object_id=survey_ids[0]).set_appointment_id(appt_ids[1])
+                raise ValueError()
+
+    with db.session_scope(db_session_maker) as db_session:
+        scores = survey_rollups.get_doctor_scores(db_session, doctor_ids)
+        assert(scores[doctor_ids[0]]['survey_count'] == 2)
+        assert(scores[doctor_ids[0]]['net_promoter_score'] == 100)
+        assert(scores[doctor_ids[0]]['explained_rate'] == 1)
+        assert(scores[doctor_ids[1]]['survey_count'] == 1)
+        assert(survey_rollups.get_doctor_scores(db_session, [doctor_ids[1]], bucket_ts=MONDAY_TS + WEEK)[
+            doctor_ids[1]]['rating_sum'] == 8)
+
+        # the rollups maintained by the object builders are the ones rebuilt from the surveys
+        rollups = _get_rollups(db_session)
+        assert(survey_rollups.rebuild_rollups(db_session.connection()) == 4)
+        assert(_get_rollups(db_session) == rollups)
@@ -0,0 +1,39 @@
+import itertools
+import solution.database as db
+import solution.models as models
+from solution.controllers import (
+    PatientController,
+)
+from benchmarks.synthetic_data import BundleGenerator
+from benchmarks.run_benchmarks import find_regressions
+import import_summary
+
+
+def test_bundle_generator_is_deterministic():
+    assert(list(BundleGenerator(20, seed=1)) == list(BundleGenerator(20, seed=1)))
+    assert(list(BundleGenerator(20, seed=1)) != list(BundleGenerator(20, seed=2)))
+
+    patient_ids = list(BundleGenerator(20).iter_patient_ids())
+    bundle_patient_ids = [bundle['entry'][0]['resource']['id'] for bundle in BundleGenerator(20)]
+    assert([patient_id for patient_id, _ in itertools.groupby(bundle_patient_ids)] == patient_ids)
+
+
+def test_generated_bundles_import(db_session_maker):
+    generator = BundleGenerator(10)
+    bundles = [(f'synthetic:{i}', bundle) for i, bundle in enumerate(generator)]
+
+    assert(import_summary.import_bundles(db_session_maker, bundles) == (len(bundles), 0, 0))
+
+    with db.session_scope(db_session_maker) as db_session:
+        assert(db_session.query(models.Appointment).count() == len(bundles))
+        for patient_id in generator.iter_patient_ids():
+            assert(PatientController(db_session, patient_id).get_most_recent_appointment_summary() is not None)
+
+
+def test_find_regressions():
+    baseline = dict(import_bundles_per_sec=1000, summary_p99_msecs=10, peak_rss_mb=100)
+    results = dict(import_bundles_per_sec=700, summary_p99_msecs=11, peak_rss_mb=150)
+
+    assert(find_regressions(results, baseline, 0.2) == [('import_bundles_per_sec', 1000, 700),
+                                                         ('peak_rss_mb', 100, 150)])
+    assert(find_regressions(results, baseline, 0.6) == [])